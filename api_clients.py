@@ -0,0 +1,117 @@
+import threading, time
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+import httpx, requests
+from requests.adapters import HTTPAdapter
+from openai import OpenAI
+
+# Long-lived API clients, one per endpoint, so every turn reuses warm keep-alive connections instead of
+# paying for a new pool (and TCP/TLS handshakes) each time. Connect and time-to-first-byte are recorded per provider.
+
+POOL_CONNECTIONS = 10      # Keep-alive connections per endpoint
+POOL_KEEPALIVE_EXPIRY = 60 # seconds an idle connection is kept open
+CONNECT_TIMEOUT = 5        # seconds
+READ_TIMEOUT = 60          # seconds
+MAX_RETRIES = 1
+
+def provider_name(url: str) -> str:
+    host = urlparse(url).hostname or url
+    for provider in ('openai', 'groq', 'perplexity', 'elevenlabs'):
+        if provider in host: return provider
+    return host
+
+class ProviderTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connect = defaultdict(lambda: deque(maxlen=200))
+        self.ttfb = defaultdict(lambda: deque(maxlen=200))
+        self.requests = defaultdict(int)
+
+    def record(self, provider: str, connect: float = None, ttfb: float = None):
+        with self.lock:
+            self.requests[provider] += 1
+            if connect is not None: self.connect[provider].append(connect)
+            if ttfb is not None: self.ttfb[provider].append(ttfb)
+
+    def stats(self) -> dict:
+        def summary(samples):
+            ordered = sorted(samples)
+            return {'count': len(ordered), 'mean': round(sum(ordered) / len(ordered), 4), 'p50': round(ordered[len(ordered) // 2], 4), 'max': round(ordered[-1], 4)} if ordered else None
+
+        with self.lock:
+            return {provider: {'requests': count, 'connect': summary(self.connect[provider]), 'ttfb': summary(self.ttfb[provider])}
+                    for provider, count in self.requests.items()}
+
+timings = ProviderTimings()
+
+def traced_request(provider: str):
+    # httpx request hook: attaches an httpcore trace callback that separates connection setup from time-to-first-byte
+    def attach_trace(request: httpx.Request):
+        marks = {}
+        def trace(event_name: str, info: dict):
+            now = time.perf_counter()
+            if event_name == 'connection.connect_tcp.started':
+                marks['connect_started'] = now
+            elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+                marks['connected'] = now
+            elif event_name.endswith('send_request_headers.started'):
+                marks['sent'] = now
+            elif event_name.endswith('receive_response_headers.complete'):
+                connect = marks['connected'] - marks['connect_started'] if 'connect_started' in marks and 'connected' in marks else None
+                timings.record(provider, connect = connect, ttfb = now - marks.get('sent', now))
+        request.extensions['trace'] = trace
+    return attach_trace
+
+class ClientRegistry:
+    def __init__(self):
+        self.openai_clients = {}
+        self.http_clients = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def openai_client(self, endpoint: str, api_key: str) -> OpenAI:
+        key = (endpoint, api_key)
+        with self.lock:
+            if key not in self.openai_clients:
+                http_client = httpx.Client(
+                    limits = httpx.Limits(max_connections = POOL_CONNECTIONS, max_keepalive_connections = POOL_CONNECTIONS, keepalive_expiry = POOL_KEEPALIVE_EXPIRY),
+                    timeout = httpx.Timeout(READ_TIMEOUT, connect = CONNECT_TIMEOUT),
+                    event_hooks = {'request': [traced_request(provider_name(endpoint))]}
+                    )
+                self.http_clients[key] = http_client
+                self.openai_clients[key] = OpenAI(api_key = api_key, base_url = endpoint, http_client = http_client, max_retries = MAX_RETRIES)
+            return self.openai_clients[key]
+
+    def http_session(self, provider: str) -> requests.Session:
+        # Pooled requests session for REST APIs without an httpx-based SDK (e.g. ElevenLabs)
+        with self.lock:
+            if provider not in self.sessions:
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_connections = POOL_CONNECTIONS, pool_maxsize = POOL_CONNECTIONS))
+                session.mount('http://', HTTPAdapter(pool_connections = POOL_CONNECTIONS, pool_maxsize = POOL_CONNECTIONS))
+                self.sessions[provider] = session
+            return self.sessions[provider]
+
+    def warm(self, endpoint: str, api_key: str):
+        # Opens a connection to the endpoint ahead of the first real request (any response will do)
+        self.openai_client(endpoint, api_key)
+        try:
+            self.http_clients[(endpoint, api_key)].get(endpoint.rstrip('/') + '/models', headers = {'Authorization': f"Bearer {api_key}"})
+        except httpx.HTTPError:
+            pass
+
+    def warm_in_background(self, endpoint: str, api_key: str):
+        threading.Thread(target = self.warm, args = (endpoint, api_key), daemon = True).start()
+
+clients = ClientRegistry()
+
+def timed_post(provider: str, url: str, **kwargs) -> requests.Response:
+    response = clients.http_session(provider).post(url, timeout = (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+    timings.record(provider, ttfb = response.elapsed.total_seconds()) # requests can't split connect from TTFB
+    return response
+
+def timed_get(provider: str, url: str, **kwargs) -> requests.Response:
+    response = clients.http_session(provider).get(url, timeout = (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+    timings.record(provider, ttfb = response.elapsed.total_seconds())
+    return response
@@ -1,8 +1,10 @@
 import sys,os
 sys.path.append(os.path.expanduser('~'))
-from my_env import API_KEY_OPENAI, API_KEY_GROQ
+from my_env import API_KEY_OPENAI, API_KEY_GROQ, API_KEY_PERPLEXITY
 
-from openai import OpenAI
+from api_clients import clients
+import api_ollama
+from api_ollama import OLLAMA_ENDPOINT, OllamaStream, request_response_ollama
 
 SYSTEM_PROMPT = \
 f"You are a charismatic and personal, albeit efficient and professional, personal assistant. " \
@@ -10,90 +12,165 @@ f"You are a charismatic and personal, albeit efficient and professional, persona
 "You have recently been upgraded to a \"droid\" with full speech capabilities (both recognition and generation). " \
 "Your text responses will be read aloud to the user by an integrated TTS engine and your input prompts come to you by way of a speech recognition system, so be alert for any non-sequiturs, inconsistencies, errors or other discrepancies that may occasionally occur with speech recognition.\n\n"
 
+# Provider endpoints can be redirected (e.g. to a proxy, or to bench/mock_servers.py) through the environment
+OPENAI_ENDPOINT = os.environ.get('TURK_OPENAI_ENDPOINT', 'https://api.openai.com/v1')
+GROQ_ENDPOINT = os.environ.get('TURK_GROQ_ENDPOINT', 'https://api.groq.com/openai/v1')
+PERPLEXITY_ENDPOINT = os.environ.get('TURK_PERPLEXITY_ENDPOINT', 'https://api.perplexity.ai')
+
 MODELS = [
     {
         'label': 'GPT4',
         'provider': 'OpenAI',
         'model_name': 'gpt-4-1106-preview',
-        'endpoint': 'https://api.openai.com/v1',
+        'endpoint': OPENAI_ENDPOINT,
         'prompt_token_cost': 0.01 / 1000,   # USD
         'response_token_cost': 0.03 / 1000, # USD
         'token_limit': 128000,
+        'prompt_budget': 16000,  # Tokens of history sent per request; older turns are summarised
         'request_fee': 0
     },
     {
         'label': 'GPT3.5',
         'provider': 'OpenAI',
         'model_name': 'gpt-3.5-turbo-1106',
-        'endpoint': 'https://api.openai.com/v1',
+        'endpoint': OPENAI_ENDPOINT,
         'prompt_token_cost': 0.01 / 1000,   # USD
         'response_token_cost': 0.02 / 1000, # USD
         'token_limit': 16000,
+        'prompt_budget': 4000,
         'request_fee': 0
     },
     {
         'label': 'Groq-Mixtral',
         'provider': 'Groq',
         'model_name': 'mixtral-8x7b-32768',
-        'endpoint': 'https://api.groq.com/openai/v1',
+        'endpoint': GROQ_ENDPOINT,
         'prompt_token_cost': 0.27 / 1000 / 1000,   # USD
         'response_token_cost': 0.27 / 1000 / 1000, # USD
         'token_limit': 32768,
+        'prompt_budget': 8000,
         'request_fee': 0
     },
     {
         'label': 'Perplexity-M',
         'provider': 'Pplx',
         'model_name': 'sonar-medium-online',
-        'endpoint': 'https://api.perplexity.ai',
+        'endpoint': PERPLEXITY_ENDPOINT,
         'prompt_token_cost': 0.00,              # USD
         'response_token_cost': 5.00 / 1000,     # USD
         'token_limit': 12000,
+        'prompt_budget': 4000,
         'request_fee': 1.80 / 1000 / 1000       # USD
     },   
     {
         'label': 'TinyDolphin',
         'provider': 'Ollama',
         'model_name': 'tinydolphin',
-        'endpoint': 'http://localhost:11434/api/chat',
+        'endpoint': OLLAMA_ENDPOINT, # Native API (api_ollama.py): model kept loaded, timings reported
         'prompt_token_cost': 0,
         'response_token_cost': 0,
         'token_limit': 12000,
+        'prompt_budget': 2000,
         'request_fee': 0
     },
         {
         'label': 'Gemma',
         'provider': 'Ollama',
         'model_name': 'gemma',
-        'endpoint': 'http://localhost:11434/api/chat',
+        'endpoint': OLLAMA_ENDPOINT,
         'prompt_token_cost': 0,
         'response_token_cost': 0,
         'token_limit': 12000,
+        'prompt_budget': 3000,
         'request_fee': 0
     }
 ]
 
+ENDPOINT_KEYS = {OPENAI_ENDPOINT: API_KEY_OPENAI, GROQ_ENDPOINT: API_KEY_GROQ, PERPLEXITY_ENDPOINT: API_KEY_PERPLEXITY}
+
 def get_model_index(label):
     return next((i for i, d in enumerate(MODELS) if d.get('label') == label), None)
 
-def request_response_openai(model_name: str, messages, endpoint: str = 'https://api.openai.com/v1'):
-    # Groq, Perplexity and Ollama now all support the OpenAI completion standard
-
-    if 'groq.com' in endpoint: 
-        api_key = API_KEY_GROQ
+def api_key_for_endpoint(endpoint: str) -> str:
+    if endpoint in ENDPOINT_KEYS:
+        return ENDPOINT_KEYS[endpoint]
+    elif 'groq.com' in endpoint: 
+        return API_KEY_GROQ
     elif 'perplexity.ai' in endpoint:
-        api_key = API_KEY_PERPLEXITY
+        return API_KEY_PERPLEXITY
     elif 'openai.com' in endpoint:
-        api_key = API_KEY_OPENAI
-    else: api_key = 'no_key_supplied'
+        return API_KEY_OPENAI
+    return 'no_key_supplied'
+
+def warm_model_connection(model: dict):
+    # Open a keep-alive connection to the model's provider before the user's first turn with it
+    # (for a local Ollama model, load the model itself)
+    if model['provider'] == 'Ollama':
+        api_ollama.preload_in_background(model['model_name'], model['endpoint'])
+        return
+    clients.warm_in_background(model['endpoint'], api_key_for_endpoint(model['endpoint']))
+
+def request_response(model: dict, messages):
+    # (response_text, prompt_tokens, response_tokens, total_tokens) from whichever API serves the model
+    if model['provider'] == 'Ollama': return request_response_ollama(model['model_name'], messages, model['endpoint'])
+    return request_response_openai(model['model_name'], messages, model['endpoint'])
+
+def response_stream(model: dict, messages):
+    # A ResponseStream, or the equivalent OllamaStream for local models
+    if model['provider'] == 'Ollama': return OllamaStream(model['model_name'], messages, model['endpoint'])
+    return ResponseStream(model['model_name'], messages, model['endpoint'])
 
-    openai_client = OpenAI(api_key=api_key, base_url = endpoint)
+def request_response_openai(model_name: str, messages, endpoint: str = OPENAI_ENDPOINT):
+    # Groq and Perplexity support the OpenAI completion standard (Ollama models go through api_ollama)
+    openai_client = clients.openai_client(endpoint, api_key_for_endpoint(endpoint))
     response_object = openai_client.chat.completions.create(model = model_name, messages=messages)
     response_text = response_object.choices[0].message.content
     prompt_tokens, response_tokens, total_tokens = response_object.usage.prompt_tokens, response_object.usage.completion_tokens, response_object.usage.total_tokens
 
     return response_text, prompt_tokens, response_tokens, total_tokens
 
+class ResponseStream:
+    # Iterates over completion text deltas as they arrive; usage is filled in once the stream is exhausted.
+    # Most providers don't report usage on streamed completions, so token counts fall back to a rough estimate.
+
+    def __init__(self, model_name: str, messages, endpoint: str = OPENAI_ENDPOINT):
+        self.model_name = model_name
+        self.messages = messages
+        self.endpoint = endpoint
+        self.text = ''
+        self.prompt_tokens, self.response_tokens, self.total_tokens = 0, 0, 0
+        self.estimated_usage = False
+        self.cancelled = False
+        self.stream = None
+
+    def close(self):
+        # Abandon the completion (e.g. a hedged request that lost); safe to call from another thread
+        self.cancelled = True
+        if self.stream is not None: self.stream.close()
+
+    def __iter__(self):
+        openai_client = clients.openai_client(self.endpoint, api_key_for_endpoint(self.endpoint))
+        self.stream = stream = openai_client.chat.completions.create(model = self.model_name, messages=self.messages, stream=True)
+        if self.cancelled: stream.close()
+        usage = None
+        for chunk in stream:
+            if self.cancelled: break
+            if getattr(chunk, 'usage', None): usage = chunk.usage
+            if not chunk.choices: continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                self.text += delta
+                yield delta
+
+        if usage:
+            self.prompt_tokens, self.response_tokens, self.total_tokens = usage.prompt_tokens, usage.completion_tokens, usage.total_tokens
+        else:
+            # ~4 characters per token is close enough for cost and token level reporting
+            self.prompt_tokens = sum(len(str(m['content'])) for m in self.messages) // 4
+            self.response_tokens = len(self.text) // 4
+            self.total_tokens = self.prompt_tokens + self.response_tokens
+            self.estimated_usage = True
+
 # def request_response_groq(model_name: str, messages, endpoint: str = 'https://api.groq.com/openai/v1/chat/completions'):
 #     client = Groq(api_key = API_KEY_GROQ)
 #     response = client.chat.completions.create(
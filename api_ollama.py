@@ -0,0 +1,142 @@
+import json, os, threading, time
+from collections import deque
+
+from turk_lib import print_log
+from api_clients import timed_post, timed_get
+
+# Ollama's native chat API (/api/chat) rather than its OpenAI-compatible one, for what only the native API offers:
+# keep_alive, so the local model stays loaded between turns instead of paying a multi-second reload; a fixed context
+# window, so the server's KV cache of the conversation so far is reused across turns; and per-request load,
+# prompt-eval and eval timings. Models are preloaded as soon as they're selected.
+
+OLLAMA_ENDPOINT = os.environ.get('TURK_OLLAMA_ENDPOINT', 'http://localhost:11434')
+OLLAMA_KEEP_ALIVE = os.environ.get('TURK_OLLAMA_KEEP_ALIVE', '30m')    # How long an idle model stays loaded (-1: forever)
+OLLAMA_NUM_CTX = int(os.environ.get('TURK_OLLAMA_NUM_CTX', 4096))      # Context window; changing it forces a reload
+STATS_WINDOW = 50
+
+class OllamaStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completions = {}   # model name -> recent completion timings
+        self.preloads = {}      # model name -> {'seconds', 'load_seconds', 'at'} of the last preload
+
+    def record(self, model_name: str, final: dict):
+        # Durations are reported in nanoseconds
+        timing = {
+            'load': final.get('load_duration', 0) / 1e9,
+            'prompt_eval': final.get('prompt_eval_duration', 0) / 1e9,
+            'prompt_eval_count': final.get('prompt_eval_count', 0),
+            'eval': final.get('eval_duration', 0) / 1e9,
+            'eval_count': final.get('eval_count', 0),
+            'total': final.get('total_duration', 0) / 1e9
+        }
+        with self.lock:
+            self.completions.setdefault(model_name, deque(maxlen=STATS_WINDOW)).append(timing)
+        return timing
+
+    def preloaded(self, model_name: str, seconds: float, load_seconds: float):
+        with self.lock:
+            self.preloads[model_name] = {'seconds': round(seconds, 3), 'load_seconds': round(load_seconds, 3), 'at': time.time()}
+
+    def as_dict(self) -> dict:
+        def mean(values):
+            return round(sum(values) / len(values), 4) if values else None
+
+        with self.lock:
+            models = {}
+            for model_name, timings in self.completions.items():
+                timings = list(timings)
+                eval_seconds = sum(t['eval'] for t in timings)
+                models[model_name] = {
+                    'completions': len(timings),
+                    'cold_loads': sum(t['load'] > 1 for t in timings),
+                    'load': mean([t['load'] for t in timings]),
+                    'prompt_eval': mean([t['prompt_eval'] for t in timings]),
+                    'prompt_eval_count': mean([t['prompt_eval_count'] for t in timings]),
+                    'eval': mean([t['eval'] for t in timings]),
+                    'tokens_per_second': round(sum(t['eval_count'] for t in timings) / eval_seconds, 2) if eval_seconds else None
+                }
+            return {'keep_alive': OLLAMA_KEEP_ALIVE, 'num_ctx': OLLAMA_NUM_CTX, 'models': models, 'preloads': dict(self.preloads)}
+
+stats = OllamaStats()
+
+def chat_request(model_name: str, messages: list, stream: bool) -> dict:
+    return {'model': model_name, 'messages': messages, 'stream': stream, 'keep_alive': OLLAMA_KEEP_ALIVE, 'options': {'num_ctx': OLLAMA_NUM_CTX}}
+
+def preload(model_name: str, endpoint: str = OLLAMA_ENDPOINT):
+    # An empty chat loads the model (or just renews its keep-alive if it's already loaded)
+    started = time.perf_counter()
+    try:
+        response = timed_post('ollama', endpoint.rstrip('/') + '/api/chat', json = chat_request(model_name, [], False))
+        response.raise_for_status()
+        load_seconds = response.json().get('load_duration', 0) / 1e9
+    except Exception as e:
+        print_log(f"Ollama preload of {model_name} failed: {e}")
+        return
+    stats.preloaded(model_name, time.perf_counter() - started, load_seconds)
+    if load_seconds > 1: print_log(f"Ollama loaded {model_name} in {load_seconds:.2f}s (kept for {OLLAMA_KEEP_ALIVE}).")
+
+def preload_in_background(model_name: str, endpoint: str = OLLAMA_ENDPOINT):
+    threading.Thread(target = preload, args = (model_name, endpoint), name = f"ollama-preload-{model_name}", daemon = True).start()
+
+def loaded_models(endpoint: str = OLLAMA_ENDPOINT) -> list:
+    # What the Ollama server currently has in memory, and until when
+    response = timed_get('ollama', endpoint.rstrip('/') + '/api/ps')
+    response.raise_for_status()
+    return [{'name': model.get('name'), 'expires_at': model.get('expires_at'), 'size_vram': model.get('size_vram')} for model in response.json().get('models', [])]
+
+def log_timing(model_name: str, timing: dict):
+    rate = f" ({timing['eval_count'] / timing['eval']:.1f} tokens/s)" if timing['eval'] else ''
+    print_log(f"Ollama {model_name}: load {timing['load']:.2f}s | prompt {timing['prompt_eval_count']} tokens in {timing['prompt_eval']:.2f}s | reply {timing['eval_count']} tokens in {timing['eval']:.2f}s{rate}", stage = 'llm', model = model_name, **timing)
+
+def request_response_ollama(model_name: str, messages, endpoint: str = OLLAMA_ENDPOINT):
+    # Non-streaming equivalent of request_response_openai
+    response = timed_post('ollama', endpoint.rstrip('/') + '/api/chat', json = chat_request(model_name, messages, False))
+    response.raise_for_status()
+    final = response.json()
+    stats.record(model_name, final)
+    prompt_tokens, response_tokens = final.get('prompt_eval_count', 0), final.get('eval_count', 0)
+    return final['message']['content'], prompt_tokens, response_tokens, prompt_tokens + response_tokens
+
+class OllamaStream:
+    # Same interface as api_llm.ResponseStream, over Ollama's newline-delimited JSON stream.
+    # Usage comes from the final message's counts, so it's never estimated.
+
+    def __init__(self, model_name: str, messages, endpoint: str = OLLAMA_ENDPOINT):
+        self.model_name = model_name
+        self.messages = messages
+        self.endpoint = endpoint
+        self.text = ''
+        self.prompt_tokens, self.response_tokens, self.total_tokens = 0, 0, 0
+        self.estimated_usage = False
+        self.timing = None
+        self.cancelled = False
+        self.response = None
+
+    def close(self):
+        # Abandon the completion; safe to call from another thread (Ollama stops generating when the connection drops)
+        self.cancelled = True
+        if self.response is not None: self.response.close()
+
+    def __iter__(self):
+        self.response = response = timed_post('ollama', self.endpoint.rstrip('/') + '/api/chat', json = chat_request(self.model_name, self.messages, True), stream = True)
+        if self.cancelled: response.close()
+        response.raise_for_status()
+        try:
+            for line in response.iter_lines():
+                if self.cancelled: return
+                if not line: continue
+                chunk = json.loads(line)
+                if 'error' in chunk: raise RuntimeError(f"Ollama: {chunk['error']}")
+                delta = chunk.get('message', {}).get('content')
+                if delta:
+                    self.text += delta
+                    yield delta
+                if chunk.get('done'):
+                    self.timing = stats.record(self.model_name, chunk)
+                    self.prompt_tokens, self.response_tokens = chunk.get('prompt_eval_count', 0), chunk.get('eval_count', 0)
+                    self.total_tokens = self.prompt_tokens + self.response_tokens
+                    log_timing(self.model_name, self.timing)
+                    return
+        finally:
+            response.close()
@@ -0,0 +1,226 @@
+import os, queue, threading, time
+from collections import defaultdict, deque
+
+from turk_lib import print_log
+from api_llm import MODELS, response_stream
+
+# Chooses which MODELS entry answers a turn. Rolling first-token latency and error rates are kept per model.
+# With the pinned policy (the default) only the selected model is used. The latency and cost policies may use other
+# models too: if the chosen one hasn't produced a first token after HEDGE_DELAY a second one is started alongside it,
+# the first to answer wins and the other is cancelled; errors and first-token timeouts fall through to the next one.
+# A conversation with a local (Ollama) model is never sent to a cloud provider unless ROUTE_LOCAL_TO_CLOUD is set.
+
+ROUTING_POLICY = os.environ.get('TURK_ROUTING_POLICY', 'pinned')          # pinned | latency | cost
+HEDGE_DELAY = float(os.environ.get('TURK_HEDGE_DELAY', 0))                # seconds; 0 disables hedging
+FIRST_TOKEN_TIMEOUT = float(os.environ.get('TURK_FIRST_TOKEN_TIMEOUT', 10)) # seconds before a provider is given up on (if there's another)
+ROUTE_PROVIDERS = os.environ.get('TURK_ROUTE_PROVIDERS', 'OpenAI,Groq').split(',') # Eligible as hedges/fallbacks
+ROUTE_LOCAL_TO_CLOUD = os.environ.get('TURK_ROUTE_LOCAL_TO_CLOUD', '0') == '1' # Local selections may use cloud hedges
+LOCAL_PROVIDERS = ('Ollama',)
+MAX_CANDIDATES = 3          # Models tried per turn, including the selected one
+
+STATS_WINDOW = 50           # Recent requests kept per model
+UNKNOWN_LATENCY = 1.0       # seconds; assumed for models with no samples yet, so they get tried
+ERROR_PENALTY = 10.0        # seconds added to a model's expected latency at a 100% error rate
+NOMINAL_PROMPT_TOKENS = 2000    # Turn size used to compare model costs
+NOMINAL_RESPONSE_TOKENS = 200
+
+def turn_cost(model: dict) -> float:
+    return NOMINAL_PROMPT_TOKENS * model['prompt_token_cost'] + NOMINAL_RESPONSE_TOKENS * model['response_token_cost'] + model['request_fee']
+
+class ModelStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: deque(maxlen=STATS_WINDOW))   # Time to first token of successful requests
+        self.failures = defaultdict(lambda: deque(maxlen=STATS_WINDOW))  # True per failed/timed-out request
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def record(self, label: str, latency: float = None, failed: bool = False, outcome: str = None):
+        with self.lock:
+            if outcome: self.counts[label][outcome] += 1
+            if outcome == 'cancelled': return
+            self.failures[label].append(failed)
+            if latency is not None: self.latency[label].append(latency)
+
+    def error_rate(self, label: str) -> float:
+        with self.lock:
+            failures = self.failures[label]
+            return sum(failures) / len(failures) if failures else 0
+
+    def expected_latency(self, label: str) -> float:
+        # Median first-token latency, penalised by the recent error rate
+        with self.lock:
+            ordered = sorted(self.latency[label])
+        median = ordered[len(ordered) // 2] if ordered else UNKNOWN_LATENCY
+        return median + ERROR_PENALTY * self.error_rate(label)
+
+    def as_dict(self) -> dict:
+        def summary(samples):
+            ordered = sorted(samples)
+            return {'count': len(ordered), 'p50': round(ordered[len(ordered) // 2], 4), 'p95': round(ordered[int(len(ordered) * 0.95)], 4)} if ordered else None
+
+        labels = [model['label'] for model in MODELS]
+        return {label: {'first_token': summary(self.latency[label]), 'error_rate': round(self.error_rate(label), 4), **self.counts[label]}
+                for label in labels if self.counts[label]}
+
+class Attempt:
+    def __init__(self, index: int, messages: list, hedged: bool):
+        self.model = MODELS[index]
+        self.stream = response_stream(self.model, messages)
+        self.hedged = hedged
+        self.started = time.perf_counter()
+        self.live = True
+
+    def cancel(self):
+        self.live = False
+        try:
+            self.stream.close()
+        except Exception:
+            pass
+
+class RoutedStream:
+    # Iterates over completion deltas like ResponseStream, from whichever candidate model answers first.
+    # Once a model has produced its first token the turn is committed to it; .model is the model that answered.
+
+    def __init__(self, router, candidates: list, prompt_for):
+        self.router = router
+        self.candidates = list(candidates)
+        self.prompt_for = prompt_for
+        self.events = queue.Queue()
+        self.attempts = []
+        self.model = None
+        self.text = ''
+        self.prompt_tokens, self.response_tokens, self.total_tokens = 0, 0, 0
+        self.estimated_usage = False
+        self.cancelled = False
+
+    def cancel(self):
+        # Abandons the reply (e.g. the user has spoken again): live requests are closed and iteration stops
+        self.cancelled = True
+        for attempt in self._live(): attempt.cancel()
+        self.events.put((None, 'cancelled', None))
+
+    def _launch(self, hedged: bool = False):
+        index = self.candidates.pop(0)
+        attempt = Attempt(index, self.prompt_for(MODELS[index]), hedged)
+        self.attempts.append(attempt)
+        if hedged: print_log(f"No reply from {self.attempts[0].model['label']} yet; hedging with {attempt.model['label']}.", stage = 'router', model = attempt.model['label'])
+        threading.Thread(target = self._run, args = (attempt,), name = f"llm-{attempt.model['label']}", daemon = True).start()
+
+    def _run(self, attempt: Attempt):
+        try:
+            for delta in attempt.stream:
+                self.events.put((attempt, 'delta', delta))
+            self.events.put((attempt, 'end', None))
+        except Exception as e:
+            self.events.put((attempt, 'error', e))
+
+    def _live(self) -> list:
+        return [attempt for attempt in self.attempts if attempt.live]
+
+    def _fail(self, attempt: Attempt, outcome: str, detail: str = ''):
+        attempt.cancel()
+        self.router.stats.record(attempt.model['label'], failed = True, outcome = outcome)
+        print_log(f"{attempt.model['label']} {outcome.replace('_', ' ')}{' (hedge)' if attempt.hedged else ''}{': ' + detail if detail else ''}.", stage = 'router', model = attempt.model['label'], outcome = outcome)
+
+    def _abandon(self):
+        for attempt in self._live(): attempt.cancel()
+        return None, 'cancelled', None
+
+    def _first_event(self):
+        # Race candidates until one produces output; returns that attempt and its first event (no attempt if cancelled)
+        if not self.cancelled: self._launch()
+        last_error = None
+        while True:
+            if self.cancelled: return self._abandon()
+            live = self._live()
+            if not live:
+                if not self.candidates: raise last_error or TimeoutError('No model produced a response')
+                self._launch()
+                continue
+
+            # A slow first token is only given up on if another model could still answer (never under pinned, so a
+            # cold local model or a long prompt-eval is waited out, as before routing)
+            now = time.perf_counter()
+            deadlines = [attempt.started + self.router.first_token_timeout for attempt in live] if self.candidates or len(live) > 1 else []
+            hedge_at = live[-1].started + self.router.hedge_delay if self.router.hedge_delay > 0 and self.candidates else None
+            wake_at = min(deadlines + ([hedge_at] if hedge_at else []), default = None)
+
+            try:
+                attempt, kind, payload = self.events.get(timeout = max(0, wake_at - now) if wake_at else None)
+            except queue.Empty:
+                now = time.perf_counter()
+                for attempt, deadline in zip(live, deadlines):
+                    if now >= deadline and (self.candidates or len(self._live()) > 1): self._fail(attempt, 'timed_out')
+                if hedge_at and now >= hedge_at and self._live(): self._launch(hedged = True)
+                continue
+
+            if kind == 'cancelled': return self._abandon()
+            if not attempt.live: continue
+            if kind == 'error':
+                last_error = payload
+                self._fail(attempt, 'failed', str(payload))
+                continue
+            return attempt, kind, payload
+
+    def __iter__(self):
+        winner, kind, payload = self._first_event()
+        if winner is None: return
+        self.model = winner.model
+        latency = time.perf_counter() - winner.started
+        self.router.stats.record(winner.model['label'], latency = latency, outcome = 'hedge_won' if winner.hedged else 'answered')
+        for attempt in self._live():
+            if attempt is not winner:
+                attempt.cancel()
+                self.router.stats.record(attempt.model['label'], outcome = 'cancelled')
+        if winner is not self.attempts[0] or winner.hedged:
+            print_log(f"Routed to {winner.model['label']} (first token after {latency:.2f}s).", stage = 'router', model = winner.model['label'], first_token = round(latency, 4))
+
+        while kind != 'end':
+            if kind == 'cancelled': return
+            if kind == 'error': raise payload
+            self.text += payload
+            yield payload
+            attempt, kind, payload = self.events.get()
+            while attempt is not winner and kind != 'cancelled':
+                attempt, kind, payload = self.events.get()
+
+        stream = winner.stream
+        self.prompt_tokens, self.response_tokens, self.total_tokens = stream.prompt_tokens, stream.response_tokens, stream.total_tokens
+        self.estimated_usage = stream.estimated_usage
+
+class ModelRouter:
+    def __init__(self, policy: str = ROUTING_POLICY, hedge_delay: float = HEDGE_DELAY, first_token_timeout: float = FIRST_TOKEN_TIMEOUT):
+        if policy not in ('pinned', 'latency', 'cost'): raise ValueError(f"Unknown routing policy: {policy}")
+        self.policy = policy
+        self.hedge_delay = hedge_delay
+        self.first_token_timeout = first_token_timeout
+        self.stats = ModelStats()
+
+    def candidates(self, selected_index: int) -> list:
+        # Model indices in the order they'd be tried; pinned is the selected model alone
+        if self.policy == 'pinned': return [selected_index]
+        by_latency = lambda i: self.stats.expected_latency(MODELS[i]['label'])
+        local = MODELS[selected_index]['provider'] in LOCAL_PROVIDERS
+        others = [i for i, model in enumerate(MODELS) if i != selected_index and model['provider'] in ROUTE_PROVIDERS
+                  and (not local or ROUTE_LOCAL_TO_CLOUD or model['provider'] in LOCAL_PROVIDERS)]
+
+        if self.policy == 'latency':
+            ordered = sorted([selected_index] + others, key = by_latency)
+        else:
+            ordered = sorted([selected_index] + others, key = lambda i: (turn_cost(MODELS[i]), by_latency(i)))
+        return ordered[:MAX_CANDIDATES]
+
+    def stream(self, selected_index: int, prompt_for) -> RoutedStream:
+        # prompt_for(model) builds the messages for a given model (prompt budgets differ between models)
+        return RoutedStream(self, self.candidates(selected_index), prompt_for)
+
+    def request(self, selected_index: int, prompt_for):
+        # Non-streaming equivalent: (response_text, prompt_tokens, response_tokens, total_tokens, model)
+        stream = self.stream(selected_index, prompt_for)
+        response_text = ''.join(stream)
+        return response_text, stream.prompt_tokens, stream.response_tokens, stream.total_tokens, stream.model
+
+    def status(self) -> dict:
+        return {'policy': self.policy, 'hedge_delay': self.hedge_delay, 'first_token_timeout': self.first_token_timeout, 'models': self.stats.as_dict()}
+
+router = ModelRouter()
@@ -1,13 +1,22 @@
-from openai import OpenAI
+import os
 from my_env import API_KEY_OPENAI
+from api_clients import clients
 WHISPER_API_MODEL_NAME = 'whisper-1'  
+WHISPER_API_ENDPOINT = os.environ.get('TURK_OPENAI_ENDPOINT', 'https://api.openai.com/v1')
 
-whisper_client = OpenAI(api_key = API_KEY_OPENAI)
+whisper_client = clients.openai_client(WHISPER_API_ENDPOINT, API_KEY_OPENAI)
 
-def api_transcribe(filename):
-    audio_file = open(filename, "rb")
-    transcript_text = str(whisper_client.audio.transcriptions.create(
+def api_transcribe(audio, filename: str = 'speech.wav'):
+    # `audio` is either a file name or the clip's bytes (sent as `filename`, which sets the format)
+    if isinstance(audio, (bytes, bytearray)):
+        audio_file = (filename, bytes(audio))
+        return request_transcription(audio_file), 0
+
+    with open(audio, "rb") as audio_file:
+        return request_transcription(audio_file), 0
+
+def request_transcription(audio_file) -> str:
+    return str(whisper_client.audio.transcriptions.create(
         model=WHISPER_API_MODEL_NAME,
         file=audio_file,
         response_format="text" )).rstrip()
-    return transcript_text, 0
\ No newline at end of file
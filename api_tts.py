@@ -0,0 +1,94 @@
+import json, os, threading, time
+from my_env import API_KEY_ELEVENLABS
+from api_clients import timed_get, timed_post
+
+from turk_lib import print_log
+import turk_trace
+from turk_audio import pcm16_wav
+
+# ElevenLabs voices are listed from an on-disk snapshot so startup never waits on (or dies with) the network;
+# a stale or missing snapshot is refreshed in the background.
+
+ELEVENLABS_API_BASE = os.environ.get('TURK_ELEVENLABS_ENDPOINT', "https://api.elevenlabs.io/v1")
+ELEVENLABS_API_URL = ELEVENLABS_API_BASE + "/voices"
+ELEVENLABS_TTS_URL = ELEVENLABS_API_BASE + "/text-to-speech/{voice_id}"
+ELEVENLABS_HEADERS = {"xi-api-key": API_KEY_ELEVENLABS}
+ELEVENLABS_MODEL = "eleven_turbo_v2"
+# MP3 is what ElevenLabs produces natively (and the smaller download); WAV is its raw PCM with a header added
+AUDIO_FORMATS = ('mp3', 'wav')
+ELEVENLABS_OUTPUT_FORMATS = {'mp3': 'mp3_44100_128', 'wav': 'pcm_24000'}
+ELEVENLABS_PCM_RATE = 24000
+VOICE_LIST_SNAPSHOT = 'elevenlabs_voices.json'
+VOICE_LIST_TTL = 60 * 60 # seconds
+
+voice_list = []
+voice_list_fetched = 0
+voice_list_lock = threading.Lock()
+voice_list_refreshing = False
+
+def load_voice_snapshot() -> bool:
+    global voice_list, voice_list_fetched
+    try:
+        with open(VOICE_LIST_SNAPSHOT, 'r') as json_file:
+            voice_list = json.load(json_file)
+        voice_list_fetched = os.path.getmtime(VOICE_LIST_SNAPSHOT)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def refresh_voice_list():
+    global voice_list, voice_list_fetched
+    response = timed_get('elevenlabs', ELEVENLABS_API_URL, headers=ELEVENLABS_HEADERS)
+    response.raise_for_status()
+    fetched_voices = response.json()['voices']
+
+    temp_filename = VOICE_LIST_SNAPSHOT + '.tmp'
+    with open(temp_filename, 'w') as json_file:
+        json.dump(fetched_voices, json_file)
+    os.replace(temp_filename, VOICE_LIST_SNAPSHOT)
+    voice_list, voice_list_fetched = fetched_voices, time.time()
+
+def refresh_voice_list_if_stale():
+    if not voice_list: load_voice_snapshot()
+    if time.time() - voice_list_fetched > VOICE_LIST_TTL:
+        refresh_voice_list()
+        print_log(f"ElevenLabs voice list refreshed ({len(voice_list)} voices).")
+
+def background_refresh():
+    global voice_list_refreshing
+    try:
+        refresh_voice_list_if_stale()
+    except Exception as e:
+        print_log(f"ElevenLabs voice list refresh failed: {e}")
+    finally:
+        voice_list_refreshing = False
+
+def get_voice_list() -> list:
+    # Never blocks on the network: a stale list triggers a background refresh
+    global voice_list_refreshing
+    with voice_list_lock:
+        if time.time() - voice_list_fetched > VOICE_LIST_TTL and not voice_list_refreshing:
+            voice_list_refreshing = True
+            threading.Thread(target=background_refresh, daemon=True).start()
+    return voice_list
+
+def find_voice(voice_name: str):
+    # Last voice whose name contains voice_name (case-insensitive), or None
+    chosen_voice = None
+    for voice in get_voice_list():
+        if voice_name.upper() in voice['name'].upper(): chosen_voice = voice
+    return chosen_voice
+
+def elevenlabs_to_audio_bytes(text: str, voice: dict, audio_format: str = 'mp3') -> bytes:
+    # Direct REST call over the pooled keep-alive session (the SDK opens a new connection per request)
+    with turk_trace.span('tts_synthesis', engine = 'elevenlabs'):
+        response = timed_post('elevenlabs', ELEVENLABS_TTS_URL.format(voice_id = voice['voice_id']),
+            headers = ELEVENLABS_HEADERS,
+            params = {'output_format': ELEVENLABS_OUTPUT_FORMATS[audio_format]},
+            json = {'text': text, 'model_id': ELEVENLABS_MODEL}
+            )
+    response.raise_for_status()
+    if audio_format == 'wav': return pcm16_wav(response.content, ELEVENLABS_PCM_RATE)
+    return response.content
+
+load_voice_snapshot()
@@ -0,0 +1,149 @@
+import os, sys, re, time, random, tempfile
+
+# Micro-benchmark: the single-pass SpeechNormalizer against the previous multi-pass filter chain
+# (message_filter -> extract_codeblocks -> URL regex -> convert_complete_number_string), on long replies,
+# both whole and streamed in small deltas. Outputs are checked for equivalence along the way. (The one deliberate
+# difference: the old chain spoke '=' before stripping URLs, so "?page=2" in a link came out as "equals two".)
+#   python bench/bench_normalizer.py [replies] [paragraphs_per_reply]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from turk_lib import SpeechNormalizer, SentenceChunker, convert_to_words, ONES
+
+SANDBOX_DIR = tempfile.mkdtemp(prefix='turk_bench_')
+
+# --- Previous implementation (as it was in turk_flask.py / turk_lib.py) ---
+
+def legacy_number_to_words(input_str: str) -> str:
+    if input_str.startswith('-'):
+        if_negative = 'minus '
+        input_str = input_str.lstrip('-')
+    else:
+        if_negative = ''
+        if ',' not in input_str and '.' not in input_str and len(input_str) == 4:
+            year = int(input_str)
+            if year < 2000 or year > 2009:
+                return legacy_number_to_words(input_str[:2]) + ' ' + legacy_number_to_words(input_str[-2:])
+
+    parts = input_str.replace(',', '').split('.')
+    integer_part = int(parts[0])
+    words = if_negative + convert_to_words(integer_part)
+
+    if len(parts) > 1:
+        decimal_digits = [ONES[int(digit)] if digit != '0' else 'zero' for digit in parts[1]]
+        words += ' point ' + ' '.join(decimal_digits)
+
+    return words
+
+def legacy_convert_complete_number_string(number_string: str) -> str:
+    number_regex = r'(?<!\d)-?\d+(?:,\d{3})*(?:\.\d+)?|\b-?\d*\.\d+\b'
+    return re.sub(number_regex, lambda match: legacy_number_to_words(match.group(0)), number_string)
+
+def legacy_extract_codeblocks(text, first_index: int = 1):
+    strings = []
+    replaced_text = text
+    index = 0
+    while True:
+        start_index = replaced_text.find('```', index)
+        if start_index == -1: break
+        end_index = replaced_text.find('```', start_index + 3)
+        if end_index == -1: break
+        extracted_string = replaced_text[start_index + 3:end_index]
+        strings.append(extracted_string)
+        block_number = first_index + len(strings) - 1
+        replacement_string = f"\n(See code-block number {block_number:02d})\n"
+        with open(os.path.join(SANDBOX_DIR, f"cb_{int(time.time()//60)}_{block_number:02d}.txt"), 'w') as snippet:
+            snippet.write(extracted_string)
+        replaced_text = replaced_text[:start_index] + replacement_string + replaced_text[end_index + 3:]
+        index = start_index + len(replacement_string)
+    return strings, replaced_text
+
+def legacy_message_filter(msg: str = '', codeblock_offset: int = 0):
+    r = msg.replace('an AI language model, ', 'a droid ')
+    codeblocks, cleaned_text = legacy_extract_codeblocks(r, codeblock_offset + 1)
+    if len(codeblocks) > 0: r = cleaned_text
+    r = r.replace('=', ' equals ')
+    r = re.sub(r'\(?https?:\/\/[^\s)]*\)?', '', r)
+    return r
+
+def legacy_voice(text: str) -> str:
+    return legacy_convert_complete_number_string(legacy_message_filter(text))
+
+# --- Workload ---
+
+SENTENCES = [
+    "The population grew from 1,250,000 in 1987 to 3,400,000 by 2023, an increase of roughly 172.4 percent.",
+    "If x = 42 and y = -7.5, then x + y = 34.5, which is easy to check.",
+    "You can read more at (https://en.wikipedia.org/wiki/Speech_synthesis) or https://example.com/docs later.",
+    "As an AI language model, I'd suggest brewing at 93 degrees for 4 minutes.",
+    "Version 2.0 shipped in 2005, and the 1900s saw 12 major revisions.",
+    "Nothing numeric here, just a reasonably long sentence to pad out the reply with ordinary prose.",
+]
+CODE = "```python\ndef area(r):\n    return 3.14159 * r ** 2  # see https://example.com\n\nprint(area(10))\n```"
+
+def make_reply(paragraphs: int, rng: random.Random) -> str:
+    parts = []
+    for _ in range(paragraphs):
+        parts.append(' '.join(rng.choice(SENTENCES) for _ in range(5)))
+        if rng.random() < 0.3: parts.append(CODE)
+    return '\n\n'.join(parts)
+
+def deltas(text: str, rng: random.Random) -> list:
+    # Roughly token-sized pieces, as a streamed completion arrives
+    pieces, i = [], 0
+    while i < len(text):
+        step = rng.randint(1, 6)
+        pieces.append(text[i:i + step])
+        i += step
+    return pieces
+
+def legacy_streamed(pieces: list) -> str:
+    # Previous streaming path: chunk raw text into sentences, filter each sentence separately
+    chunker, out, codeblocks = SentenceChunker(), [], 0
+    def voice(sentence):
+        nonlocal codeblocks
+        out.append(legacy_convert_complete_number_string(legacy_message_filter(sentence, codeblocks)))
+        codeblocks += sentence.count('```') // 2
+    for piece in pieces:
+        for sentence in chunker.feed(piece): voice(sentence)
+    for sentence in chunker.flush(): voice(sentence)
+    return ' '.join(out)
+
+def normalizer_streamed(pieces: list) -> str:
+    chunker, normalizer, out = SentenceChunker(), SpeechNormalizer(), []
+    for piece in pieces:
+        out.extend(chunker.feed(normalizer.feed(piece)))
+    out.extend(chunker.feed(normalizer.flush()) + chunker.flush())
+    return ' '.join(out)
+
+def fed_in_pieces(pieces: list) -> str:
+    normalizer = SpeechNormalizer()
+    return ''.join(normalizer.feed(piece) for piece in pieces) + normalizer.flush()
+
+def timed(function, inputs, repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in inputs: function(item)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+if __name__ == '__main__':
+    reply_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rng = random.Random(1)
+    replies = [make_reply(paragraphs, rng) for _ in range(reply_count)]
+    streamed = [deltas(reply, rng) for reply in replies]
+
+    mismatches = sum(legacy_voice(reply) != SpeechNormalizer().normalize(reply) for reply in replies)
+    stream_mismatches = sum(SpeechNormalizer().normalize(reply) != fed_in_pieces(pieces) for reply, pieces in zip(replies, streamed))
+
+    whole_legacy = timed(legacy_voice, replies)
+    whole_new = timed(lambda reply: SpeechNormalizer().normalize(reply), replies)
+    stream_legacy = timed(legacy_streamed, streamed)
+    stream_new = timed(normalizer_streamed, streamed)
+
+    characters = sum(len(reply) for reply in replies)
+    print(f"{reply_count} replies, {characters / reply_count:,.0f} characters each on average")
+    print(f"Whole reply     legacy {whole_legacy * 1000:8.1f} ms   single-pass {whole_new * 1000:8.1f} ms   ({whole_legacy / whole_new:.1f}x)")
+    print(f"Streamed deltas legacy {stream_legacy * 1000:8.1f} ms   single-pass {stream_new * 1000:8.1f} ms   ({stream_legacy / stream_new:.1f}x)")
+    print(f"Output mismatches against the previous filter chain: {mismatches}; streamed vs whole: {stream_mismatches}")
@@ -0,0 +1,222 @@
+import argparse, glob, json, os, random, re, socket, subprocess, sys, tempfile, threading, time
+import numpy as np
+import requests
+
+# End-to-end pipeline benchmark: runs the Flask app against local mock OpenAI/ElevenLabs servers and drives N
+# concurrent synthetic conversations through /upload -> job events -> audio retrieval, reporting turn latency
+# and time-to-first-audio percentiles and turns per second. Results are saved as JSON for comparing commits.
+#   python bench/bench_pipeline.py --conversations 8 --turns 5
+#   python bench/bench_pipeline.py --corpus ~/clips --baseline bench/results/pipeline-abc1234-....json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from turk_audio import encode_wav, encode_with_pyav, resample
+from mock_servers import start_mock_server, add_mock_arguments, mock_config
+
+STARTUP_TIMEOUT = 120   # seconds for the app to start serving and finish warming up
+SUMMARY_KEYS = ('p50', 'p95', 'p99')
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+UPLOAD_FORMATS = ('wav', 'opus', 'wav48') # As the browser uploads: 16 kHz WAV, 16 kHz Ogg Opus, or the old 48 kHz WAV
+
+def synthetic_clip(rng: np.random.Generator, seconds: float, upload: str = 'wav', sample_rate: int = 48000):
+    # Syllable-rate modulated noise, padded with lead-in and trailing silence the way the browser's VAD sends clips
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    speech = rng.standard_normal(len(t)) * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)) ** 2 * 0.2
+    lead_in, tail = rng.standard_normal(sample_rate // 2) * 1e-4, rng.standard_normal(int(sample_rate * 1.5)) * 1e-4
+    samples = np.concatenate([lead_in, speech, tail])
+    if upload == 'wav48': return encode_wav(samples, sample_rate), '.wav'
+    samples = resample(samples.astype(np.float32), sample_rate, 16000)
+    if upload == 'opus': return encode_with_pyav((np.clip(samples, -1, 1) * 32767).astype(np.int16), 16000, 'ogg', 'libopus', 16000, 24000), '.ogg'
+    return encode_wav(samples, 16000), '.wav'
+
+def load_corpus(corpus_dir: str, seed: int, upload: str) -> list:
+    # (audio bytes, extension) pairs
+    if corpus_dir:
+        clips = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir, '*.wav'))):
+            with open(path, 'rb') as f:
+                clips.append((f.read(), '.wav'))
+        if not clips: raise SystemExit(f"No .wav files in {corpus_dir}")
+        return clips
+    rng = np.random.default_rng(seed)
+    return [synthetic_clip(rng, seconds, upload) for seconds in (1.0, 1.5, 2.0, 3.0, 4.5)]
+
+def start_app(mock_url: str, work_dir: str, port: int, log_file):
+    # The app runs in its own working directory (sessions, caches and archives land there) with mock keys
+    with open(os.path.join(work_dir, 'my_env.py'), 'w') as f:
+        for key in ('API_KEY_OPENAI', 'API_KEY_ELEVENLABS', 'API_KEY_GROQ', 'API_KEY_PERPLEXITY'):
+            f.write(f"{key} = 'mock'\n")
+
+    env = dict(os.environ,
+        PYTHONPATH = os.pathsep.join([work_dir, REPO_DIR, os.environ.get('PYTHONPATH', '')]),
+        TURK_OPENAI_ENDPOINT = mock_url + '/openai/v1',
+        TURK_GROQ_ENDPOINT = mock_url + '/openai/v1',
+        TURK_PERPLEXITY_ENDPOINT = mock_url + '/openai/v1',
+        TURK_ELEVENLABS_ENDPOINT = mock_url + '/elevenlabs/v1',
+        TURK_OLLAMA_ENDPOINT = mock_url + '/ollama')
+    return subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'serve_app.py'), '--port', str(port)],
+                            cwd = work_dir, env = env, stdout = log_file, stderr = subprocess.STDOUT)
+
+def wait_until_ready(app, base_url: str, log_path: str):
+    # Serving, and every engine has either warmed up or given up (local engines may not be installed)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if app.poll() is not None: raise SystemExit(f"The app exited during startup (code {app.returncode}); see {log_path}")
+        try:
+            engines = requests.get(base_url + '/ready', timeout=2).json()['engines']
+            if all(engine['state'] in ('ready', 'failed') for engine in engines.values()):
+                return {name: engine['state'] for name, engine in engines.items()}
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.25)
+    raise SystemExit('Timed out waiting for the app to start.')
+
+def run_turn(http: requests.Session, base_url: str, clip: tuple, label: str, form: dict) -> dict:
+    started = time.perf_counter()
+    audio, extension = clip
+    response = http.post(base_url + '/upload', files = {'audio': (label + extension, audio, 'audio/ogg' if extension == '.ogg' else 'audio/wav')}, data = form)
+    response.raise_for_status()
+    job_id = response.json()['job_id']
+
+    since, first_audio, segments, finished = 0, None, 0, False
+    while not finished:
+        poll = http.get(f"{base_url}/jobs/{job_id}", params = {'since': since}).json()
+        for event in poll['events']:
+            if event['stage'] == 'audio':
+                http.get(f"{base_url}/{event['file']}").raise_for_status()
+                if first_audio is None: first_audio = time.perf_counter() - started
+                segments += 1
+            elif event['stage'] == 'failed':
+                raise RuntimeError(event.get('error', 'turn failed'))
+            since = event['seq'] + 1
+        finished = poll['finished']
+    return {'latency': time.perf_counter() - started, 'first_audio': first_audio, 'segments': segments}
+
+def run_conversation(index: int, args, base_url: str, clips: list, start: threading.Barrier, turns: list, failures: list):
+    rng = random.Random(args.seed + index)
+    http = requests.Session() # Own cookie jar, so each conversation is its own session
+    form = {'voice_name': args.voice, 'model_ID': str(args.model), 'sr_host': 'on' if args.local_sr else 'off'}
+    if args.accept: form['audio_accept'] = args.accept
+    http.post(base_url + '/models/select', data = {'model_ID': str(args.model)}) # As the page does: warms the provider, or loads a local model
+    start.wait()
+    for turn in range(args.turns):
+        try:
+            turns.append(run_turn(http, base_url, rng.choice(clips), f"bench{index:03d}t{turn:03d}", form))
+        except Exception as e:
+            failures.append(f"conversation {index}, turn {turn}: {e}")
+        if args.think: time.sleep(args.think)
+
+def percentiles(values: list) -> dict:
+    if not values: return None
+    return {'mean': round(float(np.mean(values)), 4), **{key: round(float(np.percentile(values, int(key[1:]))), 4) for key in SUMMARY_KEYS}}
+
+def server_stage_means(base_url: str) -> dict:
+    # Mean seconds per pipeline stage, from the app's Prometheus histograms
+    sums, counts = {}, {}
+    for line in requests.get(base_url + '/metrics').text.splitlines():
+        match = re.match(r'turk_stage_duration_seconds_(sum|count)\{(.*)\} (\S+)', line)
+        if not match: continue
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+        key = labels.pop('stage') + ''.join(f"[{value}]" for _, value in sorted(labels.items()))
+        (sums if match.group(1) == 'sum' else counts)[key] = float(match.group(3))
+    return {key: round(sums[key] / counts[key], 4) for key in sorted(sums) if counts.get(key)}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = REPO_DIR, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nAgainst {baseline_path} ({baseline['commit']}):")
+    for metric in ('turn_latency', 'time_to_first_audio'):
+        for key in SUMMARY_KEYS:
+            old, new = (baseline['results'][metric] or {}).get(key), (results['results'][metric] or {}).get(key)
+            if old and new: print(f"  {metric} {key}: {old:.3f}s -> {new:.3f}s ({(new - old) / old * 100:+.1f}%)")
+    old, new = baseline['results']['turns_per_second'], results['results']['turns_per_second']
+    if old: print(f"  turns/s: {old:.2f} -> {new:.2f} ({(new - old) / old * 100:+.1f}%)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the turk-chat pipeline against mock APIs')
+    parser.add_argument('--conversations', type=int, default=4, help='concurrent conversations')
+    parser.add_argument('--turns', type=int, default=5, help='turns per conversation')
+    parser.add_argument('--think', type=float, default=0, help='seconds between turns')
+    parser.add_argument('--corpus', help='directory of .wav clips (synthetic clips if omitted)')
+    parser.add_argument('--upload', choices=UPLOAD_FORMATS, default='wav', help='upload encoding for synthetic clips')
+    parser.add_argument('--voice', default='Bench', help="mock ElevenLabs voice, or '<LOCAL>' for local TTS")
+    parser.add_argument('--local-sr', action='store_true', help='use local faster-whisper instead of the (mock) Whisper API')
+    parser.add_argument('--model', type=int, default=0, help='MODELS index')
+    parser.add_argument('--accept', help="playback formats sent with each upload, e.g. 'audio/wav' (the app's default, MP3, if omitted)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='results file (default bench/results/pipeline-<commit>-<time>.json)')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    clips = load_corpus(args.corpus, args.seed, args.upload)
+    mock_server, mock_url = start_mock_server(mock_config(args))
+
+    work_dir = tempfile.mkdtemp(prefix='turk_bench_')
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with open(os.path.join(work_dir, 'app.log'), 'w') as app_log:
+        app = start_app(mock_url, work_dir, port, app_log)
+        try:
+            engines = wait_until_ready(app, base_url, app_log.name)
+            turns, failures = [], []
+            start = threading.Barrier(args.conversations + 1)
+            threads = [threading.Thread(target=run_conversation, args=(i, args, base_url, clips, start, turns, failures)) for i in range(args.conversations)]
+            for thread in threads: thread.start()
+            start.wait()
+            started = time.perf_counter()
+            for thread in threads: thread.join()
+            wall_seconds = time.perf_counter() - started
+            stages = server_stage_means(base_url)
+            local_models = requests.get(base_url + '/ollama/stats').json()['models']
+        finally:
+            app.terminate()
+            app.wait()
+            mock_server.shutdown()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'engines': engines,
+        'results': {
+            'turns': len(turns),
+            'failures': len(failures),
+            'wall_seconds': round(wall_seconds, 3),
+            'turns_per_second': round(len(turns) / wall_seconds, 3) if wall_seconds else 0,
+            'turn_latency': percentiles([turn['latency'] for turn in turns]),
+            'time_to_first_audio': percentiles([turn['first_audio'] for turn in turns if turn['first_audio'] is not None]),
+            'segments_per_turn': round(float(np.mean([turn['segments'] for turn in turns])), 2) if turns else 0
+        },
+        'server_stage_means': stages,
+        'ollama': local_models or None,
+        'failure_messages': failures[:20],
+        'app_log': os.path.join(work_dir, 'app.log')
+    }
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', f"pipeline-{results['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    summary = results['results']
+    print(f"{summary['turns']} turns ({summary['failures']} failed) in {summary['wall_seconds']}s: {summary['turns_per_second']} turns/s")
+    for metric in ('turn_latency', 'time_to_first_audio'):
+        if summary[metric]: print(f"  {metric}: " + '  '.join(f"{key} {summary[metric][key]:.3f}s" for key in SUMMARY_KEYS))
+    for failure in failures[:5]: print(f"  {failure}")
+    print(f"Saved {output}")
+    if args.baseline: compare(results, args.baseline)
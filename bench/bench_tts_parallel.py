@@ -0,0 +1,67 @@
+import argparse, importlib.util, multiprocessing, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+
+# Local TTS: one balacoon call for the whole reply against the reply split into sentence/clause pieces and
+# synthesised across the worker pool (joined with crossfades), for a range of reply lengths and pool sizes.
+# Both run in forked worker processes, as in the app, so the baseline pays the same IPC costs.
+# Needs balacoon_tts (and the model, downloaded on first use).
+#   python bench/bench_tts_parallel.py --workers 2,4,8 --lengths 250,750,2000
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import local_tts
+
+SENTENCES = [
+    "The population grew from one million in the early years to well over three million by the end of the century.",
+    "If you'd like, I can go into more detail on any of these points, or suggest some further reading.",
+    "Brew it at around ninety degrees, for three to four minutes, and taste it before adding milk.",
+    "A hash table stores values under keys, so a lookup takes about the same time however much you've stored.",
+    "In short, it depends on the weather, the traffic and, to some extent, on how early you set off.",
+    "Nothing surprising here; just a reasonably long sentence, with a couple of clauses, to pad out the reply.",
+]
+
+def make_text(characters: int) -> str:
+    sentences, length = [], 0
+    while length < characters:
+        sentences.append(SENTENCES[len(sentences) % len(SENTENCES)])
+        length += len(sentences[-1]) + 1
+    return ' '.join(sentences)
+
+def sampling_rate() -> int:
+    return local_tts.get_tts().get_sampling_rate()
+
+def best_time(function, repeat: int):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Single-call vs pooled local TTS synthesis')
+    parser.add_argument('--workers', default=f"2,{max(2, local_tts.CPU_COUNT // 2)}", help='comma-separated pool sizes')
+    parser.add_argument('--lengths', default='250,750,2000', help='comma-separated reply lengths (characters)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if importlib.util.find_spec('balacoon_tts') is None: raise SystemExit("Local TTS isn't available: balacoon_tts isn't installed")
+    texts = [make_text(int(length)) for length in args.lengths.split(',')]
+
+    single = []
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork')) as baseline:
+        sample_rate = baseline.submit(sampling_rate).result()
+        for text in texts:
+            seconds, samples = best_time(lambda: baseline.submit(local_tts._synthesize_piece, text).result(), args.repeat)
+            single.append((seconds, len(samples) / sample_rate))
+
+    print(f"{local_tts.CPU_COUNT} CPUs, {sample_rate} Hz; best of {args.repeat}")
+    print(f"{'chars':>6} {'workers':>7} {'pieces':>6} {'single s':>9} {'pooled s':>9} {'speedup':>8} {'audio s':>8} {'length diff':>11}")
+    for workers in sorted({int(count) for count in args.workers.split(',')}):
+        local_tts.start_pool(workers)
+        local_tts.wait_for_pool()
+        for text, (single_seconds, single_audio) in zip(texts, single):
+            pieces = local_tts.split_for_synthesis(text)
+            seconds, samples = best_time(lambda: local_tts.synthesize_in_pool(pieces, sample_rate), args.repeat)
+            audio = len(samples) / sample_rate
+            print(f"{len(text):>6} {workers:>7} {len(pieces):>6} {single_seconds:>9.3f} {seconds:>9.3f} {single_seconds / seconds:>7.2f}x {audio:>8.2f} {(audio - single_audio) / single_audio * 100:>+10.1f}%")
+        local_tts.stop_pool()
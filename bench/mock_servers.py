@@ -0,0 +1,242 @@
+import argparse, json, random, re, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the OpenAI (chat completions, streamed or not, and Whisper transcription), ElevenLabs
+# (voice list, text-to-speech) and Ollama (native /api/chat with keep_alive, /api/ps) APIs, with configurable latency,
+# so the pipeline can be benchmarked offline. OpenAI is served under /openai/v1, ElevenLabs under /elevenlabs/v1 and
+# Ollama under /ollama:
+#   python bench/mock_servers.py --port 8700 --llm-first-token 0.4 --tts-latency 0.2
+
+TRANSCRIPTS = [
+    "What's the weather going to be like this weekend?",
+    "Remind me how many ounces there are in a pound.",
+    "Can you explain what a hash table is in simple terms?",
+    "Tell me something interesting about the year 1969.",
+    "How long would it take to drive 250 miles at 60 miles an hour?",
+]
+
+REPLY_SENTENCES = [
+    "That's a good question, and the short answer is that it depends.",
+    "There are 16 ounces in a pound, or roughly 453.6 grams.",
+    "In 1969, Apollo 11 landed on the moon on July 20th.",
+    "At 60 miles an hour, 250 miles takes a little over 4 hours.",
+    "A hash table stores values under keys, so lookups take about the same time however much you store.",
+    "If x = 3 and y = 4, the hypotenuse is 5.",
+    "I'd keep an umbrella handy, just in case.",
+    "Let me know if you'd like me to go into more detail.",
+]
+
+# One silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz); repeated to roughly match the length of the speech
+MP3_FRAME = b'\xff\xfb\x90\x64' + bytes(413)
+FRAMES_PER_CHARACTER = 0.5
+PCM_SECONDS_PER_CHARACTER = 0.06 # For output_format=pcm_<rate> requests: 16-bit mono silence at that rate
+
+class MockConfig:
+    def __init__(self, llm_first_token: float = 0.4, llm_token_delay: float = 0.02, llm_tokens: int = 60,
+                 sr_latency: float = 0.3, tts_latency: float = 0.2, tts_per_character: float = 0.002, jitter: float = 0.2,
+                 ollama_load: float = 3.0):
+        self.llm_first_token = llm_first_token      # seconds before the first streamed token (or whole non-streamed reply)
+        self.llm_token_delay = llm_token_delay      # seconds between streamed tokens
+        self.llm_tokens = llm_tokens                # approximate reply length in tokens (words)
+        self.sr_latency = sr_latency
+        self.tts_latency = tts_latency
+        self.tts_per_character = tts_per_character
+        self.jitter = jitter                        # +/- fraction applied to every delay
+        self.ollama_load = ollama_load              # seconds to load a local model that isn't (still) in memory
+        self.ollama_loaded = {}                     # model name -> time its keep_alive runs out
+        self.ollama_lock = threading.Lock()
+
+    def delay(self, seconds: float):
+        if seconds > 0: time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def ollama_load_time(self, model: str, keep_alive) -> float:
+        # Seconds spent loading `model` for this request (0 if it's still loaded); renews its keep-alive either way
+        seconds = ollama_duration(keep_alive)
+        with self.ollama_lock:
+            expires = self.ollama_loaded.get(model)
+            cold = expires is None or expires < time.time()
+            load = self.ollama_load if cold else 0
+            self.ollama_loaded[model] = float('inf') if seconds < 0 else time.time() + load + seconds
+        return load
+
+    def reply(self) -> str:
+        words = []
+        while len(words) < self.llm_tokens:
+            words += random.choice(REPLY_SENTENCES).split(' ')
+        return ' '.join(words)
+
+def ollama_duration(keep_alive) -> float:
+    # Ollama keep_alive values: seconds, or a duration string like '30m' ('-1' / negative: forever); default 5 minutes
+    if keep_alive is None: return 300
+    if isinstance(keep_alive, (int, float)): return keep_alive
+    match = re.fullmatch(r'(-?[\d.]+)([smh]?)', str(keep_alive).strip())
+    if not match: return 300
+    return float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real APIs
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status: int = 200):
+        self.send_body(json.dumps(data).encode(), 'application/json', status)
+
+    def do_GET(self):
+        if self.path.startswith('/openai/v1/models'):
+            self.send_json({'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}]})
+        elif self.path.startswith('/ollama/api/ps'):
+            with self.config.ollama_lock:
+                loaded = [{'name': name, 'model': name, 'expires_at': 'never' if expires == float('inf') else time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expires))}
+                          for name, expires in self.config.ollama_loaded.items() if expires > time.time()]
+            self.send_json({'models': loaded})
+        elif self.path.startswith('/elevenlabs/v1/voices'):
+            self.send_json({'voices': [{'name': 'Bench', 'voice_id': 'bench'}, {'name': 'Mock', 'voice_id': 'mock'}]})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.startswith('/openai/v1/chat/completions'):
+            self.chat_completion(json.loads(body))
+        elif self.path.startswith('/ollama/api/chat'):
+            self.ollama_chat(json.loads(body))
+        elif self.path.startswith('/openai/v1/audio/transcriptions'):
+            self.config.delay(self.config.sr_latency)
+            self.send_body(random.choice(TRANSCRIPTS).encode(), 'text/plain')
+        elif re.match(r'/elevenlabs/v1/text-to-speech/\w+', self.path):
+            text = json.loads(body)['text']
+            self.config.delay(self.config.tts_latency + self.config.tts_per_character * len(text))
+            pcm_format = re.search(r'output_format=pcm_(\d+)', self.path)
+            if pcm_format:
+                self.send_body(bytes(2 * int(int(pcm_format.group(1)) * PCM_SECONDS_PER_CHARACTER * max(1, len(text)))), 'audio/pcm')
+            else:
+                self.send_body(MP3_FRAME * max(1, int(len(text) * FRAMES_PER_CHARACTER)), 'audio/mpeg')
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def chat_completion(self, request: dict):
+        reply = self.config.reply()
+        prompt_tokens = sum(len(str(m['content'])) for m in request['messages']) // 4
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(reply) // 4, 'total_tokens': prompt_tokens + len(reply) // 4}
+        self.config.delay(self.config.llm_first_token)
+
+        if not request.get('stream'):
+            self.send_json({'id': 'mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': request['model'],
+                            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                            'usage': usage})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send_event(data: str):
+            self.send_chunk(f"data: {data}\n\n".encode())
+
+        def chunk(delta: dict, finish_reason = None):
+            return json.dumps({'id': 'mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': request['model'],
+                               'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+
+        words = reply.split(' ')
+        for i, word in enumerate(words):
+            if i: self.config.delay(self.config.llm_token_delay)
+            send_event(chunk({'content': word if i == 0 else ' ' + word}))
+        send_event(chunk({}, 'stop'))
+        send_event('[DONE]')
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def ollama_chat(self, request: dict):
+        # Native Ollama chat: an empty message list just loads the model; otherwise a newline-delimited JSON stream
+        # (or one object) ending in a done message with load / prompt-eval / eval durations in nanoseconds
+        started = time.perf_counter()
+        load = self.config.ollama_load_time(request['model'], request.get('keep_alive'))
+        self.config.delay(load)
+        load_ns = int((time.perf_counter() - started) * 1e9)
+        def message(content: str, done: bool = False, **extra) -> dict:
+            return {'model': request['model'], 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'message': {'role': 'assistant', 'content': content}, 'done': done, **extra}
+
+        if not request['messages']:
+            self.send_json(message('', True, done_reason = 'load', load_duration = load_ns, total_duration = load_ns))
+            return
+
+        reply = self.config.reply()
+        prompt_eval_started = time.perf_counter()
+        self.config.delay(self.config.llm_first_token)
+        prompt_eval_ns = int((time.perf_counter() - prompt_eval_started) * 1e9)
+        prompt_tokens = sum(len(str(m['content'])) for m in request['messages']) // 4
+        words = reply.split(' ')
+        def final(eval_ns: int) -> dict:
+            return message('', True, done_reason = 'stop', total_duration = int((time.perf_counter() - started) * 1e9), load_duration = load_ns,
+                           prompt_eval_count = prompt_tokens, prompt_eval_duration = prompt_eval_ns, eval_count = len(words), eval_duration = eval_ns)
+
+        if not request.get('stream', True):
+            self.send_json({**final(0), 'message': {'role': 'assistant', 'content': reply}})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        eval_started = time.perf_counter()
+        for i, word in enumerate(words):
+            if i: self.config.delay(self.config.llm_token_delay)
+            self.send_chunk((json.dumps(message(word if i == 0 else ' ' + word)) + '\n').encode())
+        self.send_chunk((json.dumps(final(int((time.perf_counter() - eval_started) * 1e9))) + '\n').encode())
+        self.wfile.write(b"0\r\n\r\n")
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients abandoning streams (cancelled hedges, the app shutting down) aren't worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError): super().handle_error(request, client_address)
+
+def start_mock_server(config: MockConfig, host: str = '127.0.0.1', port: int = 0):
+    # Serves in a background thread; returns the server and its base URL
+    handler = type('ConfiguredMockHandler', (MockHandler,), {'config': config})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='mock-apis', daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    parser.add_argument('--llm-first-token', type=float, default=defaults.llm_first_token, help='seconds to the first completion token')
+    parser.add_argument('--llm-token-delay', type=float, default=defaults.llm_token_delay, help='seconds between streamed tokens')
+    parser.add_argument('--llm-tokens', type=int, default=defaults.llm_tokens, help='reply length in words')
+    parser.add_argument('--sr-latency', type=float, default=defaults.sr_latency, help='seconds per Whisper API transcription')
+    parser.add_argument('--tts-latency', type=float, default=defaults.tts_latency, help='seconds per ElevenLabs request')
+    parser.add_argument('--tts-per-character', type=float, default=defaults.tts_per_character, help='additional TTS seconds per character')
+    parser.add_argument('--jitter', type=float, default=defaults.jitter, help='+/- fraction applied to every delay')
+    parser.add_argument('--ollama-load', type=float, default=defaults.ollama_load, help='seconds for Ollama to load a model that has been unloaded')
+
+def mock_config(args) -> MockConfig:
+    return MockConfig(args.llm_first_token, args.llm_token_delay, args.llm_tokens, args.sr_latency, args.tts_latency, args.tts_per_character, args.jitter, args.ollama_load)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock OpenAI and ElevenLabs APIs')
+    parser.add_argument('--port', type=int, default=8700)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    server, base_url = start_mock_server(mock_config(args), port=args.port)
+    print(f"OpenAI:     {base_url}/openai/v1\nElevenLabs: {base_url}/elevenlabs/v1\nOllama:     {base_url}/ollama")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,18 @@
+import argparse, os, sys
+
+# Runs the turk-chat app over plain HTTP without the debug reloader, for benchmarking.
+# API endpoints are taken from the TURK_*_ENDPOINT environment variables (see bench_pipeline.py).
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    args = parser.parse_args()
+
+    # Engine log, audio and session state all live in the working directory (the benchmark's scratch directory)
+    sys.argv[0] = 'turk_flask.py'
+    import turk_flask
+    turk_flask.app.root_path = os.getcwd()
+    turk_flask.app.run(host=args.host, port=args.port, threaded=True, debug=False)
@@ -0,0 +1,80 @@
+// Microphone capture and sound detection, run on the audio rendering thread (loaded by startRecording in turk-chat.js)
+// Samples go into a preallocated ring buffer; each finished utterance is bulk-copied out and transferred to the page
+const BLOCK_SIZE = 4096; // Samples per level measurement
+const PRE_ROLL = BLOCK_SIZE * 3; // Amount of preroll before the threshold is crossed
+const END_PERSIST_PERIOD = 18; // How long (in blocks) to ignore silence when determining end of audio
+const BUFFER_DURATION = 60; // seconds
+
+class CaptureProcessor extends AudioWorkletProcessor {
+    constructor() {
+        super();
+        this.ringBuffer = new Float32Array(sampleRate * BUFFER_DURATION);
+        this.ringBufferHead = 0;
+        this.blockLength = 0;
+        this.blockSum = 0;
+        this.isAboveThreshold = false;
+        this.startMarker = 0;
+        this.endPersistCounter = 0;
+        this.listening = false;
+        this.threshold = 1;
+        // The page sets {listening, threshold} whenever its recording/processing state changes
+        this.port.onmessage = (event) => {
+            Object.assign(this, event.data);
+            if (!this.listening) this.isAboveThreshold = false;
+        };
+    }
+
+    process(inputs) {
+        const input = inputs[0][0];
+        if (!input || !this.listening) return true;
+
+        const ring = this.ringBuffer;
+        const head = this.ringBufferHead;
+        const first = Math.min(input.length, ring.length - head);
+        ring.set(first === input.length ? input : input.subarray(0, first), head);
+        if (first < input.length) ring.set(input.subarray(first), 0);
+        this.ringBufferHead = (head + input.length) % ring.length;
+
+        let sum = 0;
+        for (let i = 0; i < input.length; ++i) sum += input[i] * input[i];
+        this.blockSum += sum;
+        this.blockLength += input.length;
+        if (this.blockLength >= BLOCK_SIZE) {
+            this.detectSound(Math.sqrt(this.blockSum / this.blockLength));
+            this.blockSum = 0;
+            this.blockLength = 0;
+        }
+        return true;
+    }
+
+    detectSound(volume) {
+        const length = this.ringBuffer.length;
+        if (volume > this.threshold && !this.isAboveThreshold) {
+            this.isAboveThreshold = true;
+            this.startMarker = (this.ringBufferHead + length - PRE_ROLL) % length;
+            this.port.postMessage({ type: 'start' });
+
+        } else if (volume < this.threshold && this.isAboveThreshold) {
+            if (this.endPersistCounter >= END_PERSIST_PERIOD) {
+                this.isAboveThreshold = false;
+                this.endPersistCounter = 0;
+                const samples = this.extract(this.startMarker, this.ringBufferHead);
+                this.port.postMessage({ type: 'utterance', samples: samples, sampleRate: sampleRate }, [samples.buffer]);
+            } else {
+                this.endPersistCounter++;
+            }
+        }
+    }
+
+    extract(start, end) {
+        // Ring buffer contents from start up to end, in at most two bulk copies
+        const ring = this.ringBuffer;
+        const samples = new Float32Array((end - start + ring.length) % ring.length);
+        const first = Math.min(samples.length, ring.length - start);
+        samples.set(ring.subarray(start, start + first));
+        if (first < samples.length) samples.set(ring.subarray(0, samples.length - first), first);
+        return samples;
+    }
+}
+
+registerProcessor('turk-capture', CaptureProcessor);
@@ -1,43 +1,43 @@
 // v0.8.0
 // TODO: Ignore audio level trigger unless: flagged as ALWAYS_READY, ready_button/PTT is held down, or face detected and looking into camera
 let audioContext;
+let captureNode; // AudioWorklet node doing capture and sound detection off the main thread (capture-worklet.js)
 let isRecording = false;
 let isProcessing = false; // Flag to indicate audio processing is ongoing
-let isAboveThreshold = false;
-let ringBuffer = [];
-let ringBufferHead = 0;
-let startMarker = 0;
-let endMarker = 0;
-let endPersistCounter = 0;
 let startTime = 0;
-const END_PERSIST_PERIOD = 18; // How long to ignore silence when determining end of audio
-const BUFFER_SIZE = 4096;
-const PRE_ROLL = BUFFER_SIZE * 3; // Amount of preroll before the threshold is crossed
-const SAMPLE_RATE = 48000; // or use audioContext.sampleRate
+let uploadCount = 0; // Only the latest upload's turn hands the microphone back when it ends
+const CAPTURE_WORKLET = 'capture-worklet.js';
 const THRESHOLD = 0.04; // Microphone volume threshold for speech detection
-const BUFFER_DURATION = 60; // seconds
-const MAX_RING_BUFFER_LENGTH = SAMPLE_RATE * BUFFER_DURATION; // Total samples for the duration
+const BARGE_IN = true; // Keep listening while a reply is on its way or playing, so speaking again interrupts it
+const BARGE_IN_THRESHOLD = 0.08; // Higher than THRESHOLD so the reply's own playback doesn't trip it
 const MINIMUM_SIGNAL_LENGTH = 2.25; // Sounds below this duration threshold are ignored
+const UPLOAD_SAMPLE_RATE = 16000; // Speech recognition runs at 16 kHz, so nothing above that is worth uploading
+const UPLOAD_OPUS = true; // Upload Ogg Opus where the browser can encode it (WebCodecs); otherwise 16-bit WAV
+const UPLOAD_OPUS_BITRATE = 24000;
+const OPUS_PRE_SKIP = 312; // Encoder lookahead at 48 kHz, dropped by the decoder
 const ENDPOINT = '/upload'
 const statusDiv = document.getElementById('status');
 
 
-const RETRY_TIMEOUT = 1000 // Keep checking for responses at this frequency if first check failed
-const RESPONSE_DELAY = 5000 // How long to wait before checking for a response after submission
-const RESPONSE_FETCH_RETRY_LIMIT = 120 // How many times to check for a response before giving up.
+const JOB_EVENTS_ENDPOINT = 'events/' // Server-Sent Events for each submitted turn
+const CANCEL_ENDPOINT = 'cancel' // Abandons this session's unfinished turns
+const PLAYBACK_FORMATS = ['audio/wav', 'audio/ogg; codecs=opus', 'audio/mpeg']; // Offered with each upload; the server voices replies in one it can produce cheaply
 
-const MESSAGE_LOG_FILENAME = 'messages.json'
-const ENGINE_LOG_FILENAME = 'turk_flask.log'
+const MESSAGE_LOG_FILENAME = 'messages' // This session's conversation history
+const ENGINE_LOG_ENDPOINT = 'log/tail' // Recent engine log records, from the server's in-memory ring
 const ENGINE_LOG_LINES_LIMIT = 20 // How much of the engine log tail to show
 
 window.addEventListener('load', function() {
     fetchVoiceList();
     fetchModelList();
     loadAndDisplayChatLog(MESSAGE_LOG_FILENAME);
-    loadAndDisplayEngineLog(ENGINE_LOG_FILENAME);
+    loadAndDisplayEngineLog(ENGINE_LOG_ENDPOINT);
     scanner_paused = true;
 });
 
+// Stopping, refreshing or leaving the page abandons any turn still in progress
+window.addEventListener('pagehide', () => navigator.sendBeacon(CANCEL_ENDPOINT));
+
 function initAudioContext() {
     audioContext = new (window.AudioContext || window.webkitAudioContext)();
 }
@@ -47,14 +47,15 @@ function startRecording() {
         initAudioContext();
     }
 
-    navigator.mediaDevices.getUserMedia({ audio: true })
-        .then(stream => {
-            isRecording = true;
+    Promise.all([navigator.mediaDevices.getUserMedia({ audio: true }), audioContext.audioWorklet.addModule(CAPTURE_WORKLET)])
+        .then(([stream]) => {
             let microphone = audioContext.createMediaStreamSource(stream);
-            let scriptProcessor = audioContext.createScriptProcessor(BUFFER_SIZE, 1, 1);
-            microphone.connect(scriptProcessor);
-            scriptProcessor.connect(audioContext.destination);
-            scriptProcessor.onaudioprocess = processAudio;
+            captureNode = new AudioWorkletNode(audioContext, 'turk-capture', { numberOfInputs: 1, numberOfOutputs: 1, channelCount: 1 });
+            captureNode.port.onmessage = onCaptureMessage;
+            microphone.connect(captureNode);
+            captureNode.connect(audioContext.destination); // Silent; keeps the node pulled in every browser
+            isRecording = true;
+            updateCaptureState();
             updateStatus("Listening...", [1, 0, 0], 75, 'Kitt');
 
             document.getElementById("startButton").style.visibility = "hidden";
@@ -68,20 +69,19 @@ function startRecording() {
         });
 }
 
-function processAudio(audioProcessingEvent) {
-    if (!isRecording || isProcessing) return; // Don't process new audio if currently processing or not recording
-
-    let inputData = audioProcessingEvent.inputBuffer.getChannelData(0);
-    let sum = 0;
-
-    for (let i = 0; i < inputData.length; ++i) {
-        sum += inputData[i] * inputData[i];
-        ringBuffer[ringBufferHead] = inputData[i]; // Save data to ring buffer
-        ringBufferHead = (ringBufferHead + 1) % MAX_RING_BUFFER_LENGTH; // Circular increment
-    }
+function updateCaptureState() {
+    // Tell the capture worklet whether to listen (while processing, only for barge-in) and at what threshold
+    if (!captureNode) return;
+    captureNode.port.postMessage({
+        listening: isRecording || (BARGE_IN && isProcessing),
+        threshold: isProcessing ? BARGE_IN_THRESHOLD : THRESHOLD
+    });
+}
 
-    let volume = Math.sqrt(sum / inputData.length);
-    detectSound(volume);
+function setListening() {
+    isRecording = true;
+    isProcessing = false;
+    updateCaptureState();
 }
 
 function getStrength(array) {
@@ -92,87 +92,203 @@ function getStrength(array) {
     return sum / array.length;
 }
 
-function detectSound(volume) {
-    if (volume > THRESHOLD && !isAboveThreshold) {
-        isAboveThreshold = true;
-        startMarker = (ringBufferHead + MAX_RING_BUFFER_LENGTH - PRE_ROLL) % MAX_RING_BUFFER_LENGTH;
+function onCaptureMessage(event) {
+    if (event.data.type === 'start') {
         startTime = Date.now();
+        if (activeTurn) activeTurn.pause(); // Hold the reply while the user speaks over it
         updateStatus("Sound detected...", [0, 1, 0], 75, 'Cylon');
+        return;
+    }
 
-    } else if (volume < THRESHOLD && isAboveThreshold) {
-        if (endPersistCounter >= END_PERSIST_PERIOD) {
-            isAboveThreshold = false;
-            endMarker = ringBufferHead;
-            let sampleLength = (endMarker - startMarker + MAX_RING_BUFFER_LENGTH) % MAX_RING_BUFFER_LENGTH;
-
-            let audioData = new Float32Array(sampleLength);
-            for (let i = 0; i < sampleLength; i++) {
-                audioData[i] = ringBuffer[(startMarker + i) % MAX_RING_BUFFER_LENGTH];
-            }
-
-            if ( audioData.length < (SAMPLE_RATE * MINIMUM_SIGNAL_LENGTH) ) { // Check if the audio duration is too short for speech
-                // Reset and return to listening state without processing
-                isAboveThreshold = false;
-                endPersistCounter = 0;
-                updateStatus( `Short sound ignored (${audioData.length} / ${SAMPLE_RATE * MINIMUM_SIGNAL_LENGTH} @ ${getStrength(audioData).toFixed(4)}).  Listening...`, [1, 0, 0], 75, 'Kitt' );
-                return;
-            } else {
-                console.warn( `Sound length: ${audioData.length}   Strength: ${getStrength(audioData).toFixed(4)}`)
-            }
-
-            let audioBuffer = audioContext.createBuffer(1, audioData.length, SAMPLE_RATE);
-            audioBuffer.copyToChannel(audioData, 0);
+    let audioData = event.data.samples;
+    let sampleRate = event.data.sampleRate;
+    if ( audioData.length < (sampleRate * MINIMUM_SIGNAL_LENGTH) ) { // Check if the audio duration is too short for speech
+        // Return to listening state without processing
+        if (activeTurn) activeTurn.resume();
+        updateStatus( `Short sound ignored (${audioData.length} / ${sampleRate * MINIMUM_SIGNAL_LENGTH} @ ${getStrength(audioData).toFixed(4)}).  Listening...`, [1, 0, 0], 75, 'Kitt' );
+        return;
+    } else {
+        console.warn( `Sound length: ${audioData.length}   Strength: ${getStrength(audioData).toFixed(4)}`)
+    }
 
-            isRecording = false; 
-            isProcessing = true;
-            updateStatus("Silence detected, processing...", [1, 0, 1], 60, 'Cylon');
-            convertToWav(audioBuffer, startTime);
+    if (activeTurn) activeTurn.cancel(); // Barge-in: the upload below supersedes the turn on the server too
+
+    isRecording = false; 
+    isProcessing = true;
+    updateCaptureState();
+    updateStatus("Silence detected, processing...", [1, 0, 1], 60, 'Cylon');
+    encodeUpload(audioData, sampleRate)
+        .then(([blob, extension]) => uploadAudio(blob, startTime + extension))
+        .catch((error) => {
+            console.error('Error:', error);
+            updateStatus('Failed to encode audio.', [1, 1, 0], 5, 'Cylon');
+            setListening();
+        });
+}
 
-            endPersistCounter = 0;
-        } else {
-            endPersistCounter++;
+async function encodeUpload(samples, sampleRate) {
+    // 16 kHz mono, as Ogg Opus if possible (~3 kB/s) or 16-bit WAV (32 kB/s)
+    samples = await downsample(samples, sampleRate, UPLOAD_SAMPLE_RATE);
+    if (UPLOAD_OPUS) {
+        try {
+            const opus = await encodeOggOpus(samples, UPLOAD_SAMPLE_RATE);
+            if (opus) return [opus, '.ogg'];
+        } catch (error) {
+            console.warn('Opus encoding failed; uploading WAV.', error);
         }
     }
+    return [encodeWav(samples, UPLOAD_SAMPLE_RATE), '.wav'];
 }
 
-function convertToWav(audioBuffer, label) {
-    let numChannels = audioBuffer.numberOfChannels;
-    let numSamples = audioBuffer.length;
-    let buffer = new ArrayBuffer(44 + numSamples * 2 * numChannels);
-    let view = new DataView(buffer);
+async function downsample(samples, sampleRate, targetRate) {
+    // Resampled (and band-limited) by the browser's own offline renderer
+    if (sampleRate === targetRate) return samples;
+    let offline = new OfflineAudioContext(1, Math.ceil(samples.length * targetRate / sampleRate), targetRate);
+    let audioBuffer = offline.createBuffer(1, samples.length, sampleRate);
+    audioBuffer.copyToChannel(samples, 0);
+    let source = offline.createBufferSource();
+    source.buffer = audioBuffer;
+    source.connect(offline.destination);
+    source.start();
+    return (await offline.startRendering()).getChannelData(0);
+}
 
-    function writeDataString(view, offset, string) {
-        for (let i = 0; i < string.length; i++) {
-            view.setUint8(offset + i, string.charCodeAt(i));
-        }
+function writeDataString(view, offset, string) {
+    for (let i = 0; i < string.length; i++) {
+        view.setUint8(offset + i, string.charCodeAt(i));
     }
+}
+
+function encodeWav(samples, sampleRate) {
+    let buffer = new ArrayBuffer(44 + samples.length * 2);
+    let view = new DataView(buffer, 0, 44);
 
     // Writing the WAV container
     writeDataString(view, 0, 'RIFF');
-    view.setUint32(4, 36 + numSamples * 2, true);
+    view.setUint32(4, 36 + samples.length * 2, true);
     writeDataString(view, 8, 'WAVE');
     writeDataString(view, 12, 'fmt ');
     view.setUint32(16, 16, true);
     view.setUint16(20, 1, true);
-    view.setUint16(22, numChannels, true);
-    view.setUint32(24, SAMPLE_RATE, true);
-    view.setUint32(28, SAMPLE_RATE * numChannels * 2, true);
-    view.setUint16(32, numChannels * 2, true);
+    view.setUint16(22, 1, true);
+    view.setUint32(24, sampleRate, true);
+    view.setUint32(28, sampleRate * 2, true);
+    view.setUint16(32, 2, true);
     view.setUint16(34, 16, true);
     writeDataString(view, 36, 'data');
-    view.setUint32(40, numSamples * 2, true);
+    view.setUint32(40, samples.length * 2, true);
 
-    let index = 44;
-    let volume = 1;
-    for (let i = 0; i < numSamples; i++) {
-        view.setInt16(index, audioBuffer.getChannelData(0)[i] * (0x7FFF * volume), true);
-        index += 2;
+    let pcm = new Int16Array(buffer, 44);
+    for (let i = 0; i < samples.length; i++) {
+        pcm[i] = Math.max(-1, Math.min(1, samples[i])) * 0x7FFF;
     }
+    return new Blob([buffer], { type: 'audio/wav' });
+}
 
-    let blob = new Blob([view], { type: 'audio/wav' });
-    
+async function encodeOggOpus(samples, sampleRate) {
+    // Opus packets from WebCodecs, wrapped in an Ogg container; null if the browser can't encode Opus
+    if (typeof AudioEncoder === 'undefined') return null;
+    const config = { codec: 'opus', sampleRate: sampleRate, numberOfChannels: 1, bitrate: UPLOAD_OPUS_BITRATE };
+    if (!(await AudioEncoder.isConfigSupported(config)).supported) return null;
+
+    let packets = [];
+    let failure = null;
+    const encoder = new AudioEncoder({
+        output: (chunk) => {
+            let data = new Uint8Array(chunk.byteLength);
+            chunk.copyTo(data);
+            packets.push({ data: data, duration: chunk.duration });
+        },
+        error: (error) => failure = error
+    });
+    encoder.configure(config);
+    encoder.encode(new AudioData({ format: 'f32', sampleRate: sampleRate, numberOfFrames: samples.length, numberOfChannels: 1, timestamp: 0, data: samples }));
+    await encoder.flush();
+    encoder.close();
+    if (failure) throw failure;
+    return new Blob(oggOpusPages(packets, samples.length * 48000 / sampleRate, sampleRate), { type: 'audio/ogg; codecs=opus' });
+}
+
+const OGG_CRC_TABLE = (() => {
+    let table = new Uint32Array(256);
+    for (let i = 0; i < 256; i++) {
+        let r = i << 24;
+        for (let j = 0; j < 8; j++) r = (r & 0x80000000) ? ((r << 1) ^ 0x04C11DB7) : (r << 1);
+        table[i] = r >>> 0;
+    }
+    return table;
+})();
+
+function oggPage(packets, granule, serial, sequence, headerType) {
+    // One Ogg page holding whole packets (each laced into 255-byte segments)
+    let lacing = [];
+    for (const packet of packets) {
+        for (let length = packet.length; ; length -= 255) {
+            lacing.push(Math.min(length, 255));
+            if (length < 255) break;
+        }
+    }
+    let bodyLength = packets.reduce((total, packet) => total + packet.length, 0);
+    let page = new Uint8Array(27 + lacing.length + bodyLength);
+    let view = new DataView(page.buffer);
+    writeDataString(view, 0, 'OggS');
+    view.setUint8(5, headerType);
+    view.setUint32(6, granule % 0x100000000, true);
+    view.setUint32(10, Math.floor(granule / 0x100000000), true);
+    view.setUint32(14, serial, true);
+    view.setUint32(18, sequence, true);
+    view.setUint8(26, lacing.length);
+    page.set(lacing, 27);
+    let offset = 27 + lacing.length;
+    for (const packet of packets) {
+        page.set(packet, offset);
+        offset += packet.length;
+    }
+    let crc = 0;
+    for (let i = 0; i < page.length; i++) crc = ((crc << 8) ^ OGG_CRC_TABLE[((crc >>> 24) ^ page[i]) & 0xFF]) >>> 0;
+    view.setUint32(22, crc, true);
+    return page;
+}
+
+function oggOpusPages(packets, length48k, inputRate) {
+    // Ogg Opus (RFC 7845): identification and comment header pages, then the audio packets, up to 250 segments a page
+    // Granule positions count 48 kHz samples, including the pre-skip; the last page's trims the encoder's padding
+    const serial = Math.floor(Math.random() * 0x100000000);
+    let head = new Uint8Array(19);
+    let headView = new DataView(head.buffer);
+    writeDataString(headView, 0, 'OpusHead');
+    head[8] = 1;
+    head[9] = 1;
+    headView.setUint16(10, OPUS_PRE_SKIP, true);
+    headView.setUint32(12, inputRate, true);
+    let vendor = 'turk-chat';
+    let tags = new Uint8Array(8 + 4 + vendor.length + 4);
+    let tagsView = new DataView(tags.buffer);
+    writeDataString(tagsView, 0, 'OpusTags');
+    tagsView.setUint32(8, vendor.length, true);
+    writeDataString(tagsView, 12, vendor);
+
+    let pages = [oggPage([head], 0, serial, 0, 0x02), oggPage([tags], 0, serial, 1, 0)];
+    let granule = OPUS_PRE_SKIP, end = OPUS_PRE_SKIP + Math.round(length48k);
+    let page = [], segments = 0;
+    packets.forEach((packet, i) => {
+        page.push(packet.data);
+        segments += Math.floor(packet.data.length / 255) + 1;
+        granule += Math.round((packet.duration || 20000) * 48000 / 1e6);
+        const last = i === packets.length - 1;
+        if (last || segments > 250 - Math.floor(packets[i + 1].data.length / 255) - 1) {
+            pages.push(oggPage(page, last ? Math.min(granule, end) : granule, serial, pages.length, last ? 0x04 : 0));
+            page = [];
+            segments = 0;
+        }
+    });
+    return pages;
+}
+
+function uploadAudio(blob, filename) {
+    const upload = ++uploadCount;
     let formData = new FormData();
-    formData.append("audio", blob, label + '.wav');
+    formData.append("audio", blob, filename);
 
     let selectedName = document.getElementById('nameDropdown').value;
     formData.append("voice_name", selectedName);
@@ -183,6 +299,8 @@ function convertToWav(audioBuffer, label) {
     var srValue = document.getElementById('sr-switch').checked ? 'on' : 'off';
     formData.set('sr_host', srValue);
 
+    formData.append('audio_accept', playableAudioTypes());
+
     fetch(ENDPOINT, {
         method: 'POST',
         body: formData
@@ -192,10 +310,10 @@ function convertToWav(audioBuffer, label) {
         console.log('Success:', data);
         updateStatus('File uploaded successfully!', [1, 0, 0], 20, 'Cylon');
 
-        loadAndPlayMP3(`${label}`.substring(0,10) + '.mp3').then(() => {
+        followTurnJob(data.job_id).then((outcome) => {
+            if (outcome === 'superseded' || upload !== uploadCount) return; // A newer utterance has taken over
             // After playback is complete, resume listening
-            isRecording = true;
-            isProcessing = false;
+            setListening();
             updateStatus("Listening...", [1, 0, 0], 75);
         });
 
@@ -203,8 +321,7 @@ function convertToWav(audioBuffer, label) {
     .catch((error) => {
         console.error('Error:', error);
         updateStatus('Failed to upload file.', [1, 1, 0], 5, 'Cylon');
-        isRecording = true;
-        isProcessing = false;
+        setListening();
     });
 }
 
@@ -236,86 +353,152 @@ function formatReportString(input) {
     }
 }
 
-function loadAndPlayMP3(mp3_filename) {
-    return new Promise((resolve, reject) => {
-        let hasPlayed = false;
-        let attempts = 0;
-        let audioContext = new (window.AudioContext || window.webkitAudioContext)();
-        let analyser = audioContext.createAnalyser();
+function playableAudioTypes() {
+    // The PLAYBACK_FORMATS this browser can play, as an Accept-style list
+    const probe = new Audio();
+    return PLAYBACK_FORMATS.filter(type => probe.canPlayType(type) !== '').join(', ');
+}
 
-        function updateUIAfterPlayback() {
-            document.getElementById('status').textContent = 'Playback finished';
-            console.log('Playback finished');
-            resolve(); // Resolve the promise indicating the MP3 has finished playing
-        }
+let playbackContext;
+let playbackAnalyser;
+let playbackElement = null; // The clip currently playing
+let stopPlayback = null;
+
+function playAudioBlob(blob) {
+    // Plays one clip through the shared analyser; resolves when playback has ended
+    if (!playbackContext) {
+        playbackContext = new (window.AudioContext || window.webkitAudioContext)();
+        playbackAnalyser = playbackContext.createAnalyser();
+        playbackAnalyser.connect(playbackContext.destination);
+        drawVUMeter();
+    }
 
-        const drawVUMeter = () => {
+    return new Promise((resolve) => {
+        let audioSrc = playbackContext.createMediaElementSource(new Audio(URL.createObjectURL(blob)));
+        audioSrc.connect(playbackAnalyser);
+        const finish = () => {
+            playbackElement = stopPlayback = null;
+            URL.revokeObjectURL(audioSrc.mediaElement.src);
+            audioSrc.disconnect();
+            resolve();
+        };
+        audioSrc.mediaElement.addEventListener('ended', finish);
+        playbackElement = audioSrc.mediaElement;
+        stopPlayback = () => { audioSrc.mediaElement.pause(); finish(); };
+        audioSrc.mediaElement.play();
+    });
+}
 
-            requestAnimationFrame(drawVUMeter);
-            let dataArray = new Uint8Array(analyser.frequencyBinCount);
-            analyser.getByteFrequencyData(dataArray);
+function drawVUMeter() {
 
-            let canvas = document.getElementById('vuMeter');
-            if (canvas != null) {
+    requestAnimationFrame(drawVUMeter);
+    let analyser = playbackAnalyser;
+    let dataArray = new Uint8Array(analyser.frequencyBinCount);
+    analyser.getByteFrequencyData(dataArray);
 
-                let ctx = canvas.getContext('2d');
-                ctx.clearRect(0, 0, canvas.width, canvas.height);
+    let canvas = document.getElementById('vuMeter');
+    if (canvas != null) {
 
-                let barWidth = (canvas.width / dataArray.length);
-                let barHeight;
-                let x = 0;
-                for(let i = 0; i < dataArray.length; i++) {
-                    barHeight = dataArray[i]/2;
-                    ctx.fillStyle = 'rgb(' + (barHeight+150) + ',50,50)';
-                    ctx.fillRect(x, canvas.height - barHeight, barWidth, barHeight);
+        let ctx = canvas.getContext('2d');
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
 
-                    x += barWidth + 1;
-                }
-            } else {
-                let mean = dataArray.reduce((a, b) => a + b, 0) / dataArray.length;
-                let normalizedMean = (mean / Math.max(...dataArray)) * 10;
-                drawKittFrame(Math.floor(normalizedMean * 10));
-            }
-        };
+        let barWidth = (canvas.width / dataArray.length);
+        let barHeight;
+        let x = 0;
+        for(let i = 0; i < dataArray.length; i++) {
+            barHeight = dataArray[i]/2;
+            ctx.fillStyle = 'rgb(' + (barHeight+150) + ',50,50)';
+            ctx.fillRect(x, canvas.height - barHeight, barWidth, barHeight);
 
-        const tryFetch = () => {
-            fetch(mp3_filename)
-                .then(response => {
-                    if(response.ok) return response.blob();
-                    throw new Error('File not found');
-                })
-                .then(blob => {
-                    let audioSrc = audioContext.createMediaElementSource(new Audio(URL.createObjectURL(blob)));
-                    audioSrc.connect(analyser);
-                    analyser.connect(audioContext.destination);
-
-                    audioSrc.mediaElement.play();
-                    hasPlayed = true;
-                    drawVUMeter();
-
-                    audioSrc.mediaElement.addEventListener('ended', updateUIAfterPlayback);
-
-                    loadAndDisplayChatLog(MESSAGE_LOG_FILENAME)
-                    loadAndDisplayEngineLog(ENGINE_LOG_FILENAME)
-                    
-                })
-                .catch(error => {
-                    console.error('Fetch failed', error);
-                    reject(error);
-                });
+            x += barWidth + 1;
+        }
+    } else {
+        let mean = dataArray.reduce((a, b) => a + b, 0) / dataArray.length;
+        let normalizedMean = (mean / Math.max(...dataArray)) * 10;
+        drawKittFrame(Math.floor(normalizedMean * 10));
+    }
+}
+
+let activeTurn = null; // The turn being followed, so that speaking again can hold or interrupt it
+
+function followTurnJob(job_id) {
+    // Plays each voiced segment of a turn as soon as the server announces it; resolves once the turn
+    // has finished and everything queued has been played ('superseded' if it was interrupted)
+    return new Promise((resolve) => {
+        let queue = [];
+        let playing = false;
+        let finished = false;
+        let cancelled = false;
+        let events = new EventSource(JOB_EVENTS_ENDPOINT + job_id);
+
+        function stop(outcome) {
+            // Drops everything still queued for this turn and stops the clip that's playing
+            cancelled = finished = true;
+            queue.length = 0;
+            events.close();
+            if (activeTurn === turn) activeTurn = null;
+            if (stopPlayback) stopPlayback();
+            resolve(outcome);
+        }
+
+        const turn = {
+            pause: () => { if (playbackElement) playbackElement.pause(); },
+            resume: () => { if (playbackElement) playbackElement.play(); },
+            cancel: () => stop('superseded')
         };
+        activeTurn = turn;
 
-        setTimeout(() => {
-            tryFetch();
-            let interval = setInterval(() => {
-                if(!hasPlayed && attempts < RESPONSE_FETCH_RETRY_LIMIT) {
-                    tryFetch();
-                    attempts++;
-                } else {
-                    clearInterval(interval);
+        function finishIfIdle() {
+            if (!finished || playing || queue.length > 0 || cancelled) return;
+            if (activeTurn === turn) activeTurn = null;
+            document.getElementById('status').textContent = 'Playback finished';
+            loadAndDisplayChatLog(MESSAGE_LOG_FILENAME);
+            loadAndDisplayEngineLog(ENGINE_LOG_ENDPOINT);
+            resolve();
+        }
+
+        async function playQueue() {
+            if (playing) return;
+            playing = true;
+            while (queue.length > 0) {
+                try {
+                    const response = await fetch(queue.shift());
+                    if (response.ok && !cancelled) await playAudioBlob(await response.blob());
+                } catch (error) {
+                    console.error('Playback failed', error);
                 }
-            }, RETRY_TIMEOUT);
-        }, RESPONSE_DELAY);
+            }
+            playing = false;
+            finishIfIdle();
+        }
+
+        events.addEventListener('transcribed', (e) => {
+            updateStatus(`Heard: ${JSON.parse(e.data).text}`, [1, 0, 1], 40, 'Cylon');
+        });
+        events.addEventListener('audio', (e) => {
+            queue.push(JSON.parse(e.data).file);
+            playQueue();
+        });
+        events.addEventListener('done', () => {
+            events.close();
+            finished = true;
+            finishIfIdle();
+        });
+        events.addEventListener('cancelled', (e) => {
+            // Cancelled on the server (e.g. from another tab); nothing more is coming
+            console.warn('Turn cancelled:', JSON.parse(e.data).reason);
+            stop('cancelled');
+        });
+        events.addEventListener('failed', (e) => {
+            console.error('Turn failed:', JSON.parse(e.data).error);
+            events.close();
+            finished = true;
+            finishIfIdle();
+        });
+        events.onerror = () => {
+            // The server closes the stream after the final event; anything else is a lost connection
+            if (!finished) console.warn('Turn event stream interrupted; reconnecting...');
+        };
     });
 }
 
@@ -331,62 +514,74 @@ function htmlCodeBlock(text) {
     return convertedText;
 }
 
-async function loadAndDisplayChatLog(message_log_filename) {
+let chatLogNextSeq = 0; // Messages before this sequence number are already on screen
+
+function formatChatEntry(entry) {
+    switch (entry.role) {
+        case 'system':
+            return `<div class="message system-message"><pre>${entry.content}</pre></div>`;
+        case 'user':
+            return `<div class="message user-message">${entry.content}</div>`;
+        case 'assistant':
+            if (String(entry.content).includes("```")) {
+                return `<div class="message assistant-message">${htmlCodeBlock(entry.content)}</div>`;
+            } else {
+                return `<div class="message assistant-message">${entry.content}</div>`;
+            }
+        default:
+            return `<div class="message">${entry.content}</div>`;
+    }
+}
+
+async function loadAndDisplayChatLog(message_log_endpoint) {
+    // Fetches and renders only the messages added since the last call (newest first)
     chatLogElement = document.getElementById('messages');
     if (chatLogElement == null) return;
 
     try {
-        const response = await fetch(message_log_filename);
+        const response = await fetch(`${message_log_endpoint}?since=${chatLogNextSeq}`);
         if (!response.ok) {
             console.warn('Failed to fetch chat log:');
             return;
         }
 
         const chatLog = await response.json();
-        chatLog.reverse()
+        if (chatLog.reset) chatLogElement.innerHTML = '';
 
         let formattedHtml = '';
-        chatLog.forEach(entry => {
-            switch (entry.role) {
-                case 'system':
-                    formattedHtml += `<div class="message system-message"><pre>${entry.content}</pre></div>`;
-                    break;
-                case 'user':
-                    formattedHtml += `<div class="message user-message">${entry.content}</div>`;
-                    break;
-                case 'assistant':
-                    if (String(entry.content).includes("```")) {
-                        formattedHtml += `<div class="message assistant-message">${htmlCodeBlock(entry.content)}</div>`;
-                    } else {
-                        formattedHtml += `<div class="message assistant-message">${entry.content}</div>`;
-                    }
-                    break;
-                default:
-                    formattedHtml += `<div class="message">${entry.content}</div>`;
-            }
+        chatLog.messages.forEach(entry => {
+            formattedHtml = formatChatEntry(entry) + formattedHtml;
         });
 
-        chatLogElement.innerHTML = formattedHtml;
+        chatLogElement.insertAdjacentHTML('afterbegin', formattedHtml);
+        chatLogNextSeq = chatLog.next_seq;
 
     } catch (error) {
         console.error('Failed to parse chat log:', error);
     }
 }
 
-async function loadAndDisplayEngineLog(engine_log_filename) {
+function engineLogTimestamp(seconds) {
+    // As written to the log file: mm/dd/yy  HH:MM:SS
+    const d = new Date(seconds * 1000);
+    const pad = (n) => String(n).padStart(2, '0');
+    return `${pad(d.getMonth() + 1)}/${pad(d.getDate())}/${pad(d.getFullYear() % 100)}  ${pad(d.getHours())}:${pad(d.getMinutes())}:${pad(d.getSeconds())}`;
+}
+
+async function loadAndDisplayEngineLog(engine_log_endpoint) {
     engineLogElement = document.getElementById('engine-log');
     if (engineLogElement == null) return;
 
     try {
-        const response = await fetch(engine_log_filename);
+        const response = await fetch(`${engine_log_endpoint}?n=${ENGINE_LOG_LINES_LIMIT}`);
         if (!response.ok) {
             console.warn('Failed to fetch engine log.');
             return;
         }
 
-        const engineLog = await response.text()
+        const engineLog = await response.json();
 
-        var lines = engineLog.split('\n').slice(-ENGINE_LOG_LINES_LIMIT);
+        var lines = engineLog.entries.map(entry => `[ ${engineLogTimestamp(entry.time)} ] ${entry.message}`);
         lines.reverse();
 
         for (let i = 0; i < lines.length; i++) {
@@ -463,6 +658,22 @@ async function fetchModelList() {
             modelDropdown.options[0].selected = true;
         }
 
+        // Show the session's saved model (the server warms it) rather than resetting the choice to the first
+        try {
+            const selected = await (await fetch('models/select')).json();
+            if (selected.model_ID < modelDropdown.options.length) modelDropdown.selectedIndex = selected.model_ID;
+        } catch (error) {
+            console.warn('Failed to fetch the selected model.', error);
+        }
+
+        // Warm a connection to the newly chosen model's provider before the next turn needs it
+        modelDropdown.addEventListener('change', () => {
+            let formData = new FormData();
+            formData.append('model_ID', modelDropdown.selectedIndex);
+            fetch('models/select', { method: 'POST', body: formData })
+                .catch(error => console.warn('Failed to pre-select model.', error));
+        });
+
     } catch (error) {
         console.error('Failed to parse LLM list.', error);
     }      
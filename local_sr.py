@@ -1,18 +1,150 @@
-from faster_whisper import WhisperModel
+import os, queue, threading, time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
 
 # model_size = "large-v3"
 # model_size = "medium.en"
-# model_size = "small.en" 
-# model_size = "tiny.en" 
+# model_size = "small.en"
+# model_size = "tiny.en"
 
 # model_size = "distil-large-v2"
 model_size = "distil-medium.en"
 
-# Running on CPU with INT8
-model = WhisperModel(model_size, device="cpu", compute_type="int8")
+# Per-deployment tuning (environment variables override the defaults below)
+CPU_COUNT = os.cpu_count() or 1
+MODEL_SIZE = os.environ.get('TURK_SR_MODEL_SIZE', model_size)
+DEVICE = os.environ.get('TURK_SR_DEVICE', 'cpu')
+COMPUTE_TYPE = os.environ.get('TURK_SR_COMPUTE_TYPE', 'int8')
+BEAM_SIZE = int(os.environ.get('TURK_SR_BEAM_SIZE', 5))
+SR_WORKERS = int(os.environ.get('TURK_SR_WORKERS', max(1, CPU_COUNT // 4)))                # Concurrent transcriptions
+SR_CPU_THREADS = int(os.environ.get('TURK_SR_CPU_THREADS', max(1, CPU_COUNT // SR_WORKERS))) # Threads per transcription
+BATCH_MAX = int(os.environ.get('TURK_SR_BATCH_MAX', 4))                        # Short utterances decoded together
+BATCH_MAX_SECONDS = float(os.environ.get('TURK_SR_BATCH_MAX_SECONDS', 8))      # Only utterances this short are batched
+BATCH_GAP_SECONDS = 1.0
+BATCH_WINDOW_SECONDS = 30       # Whisper's input window; a batch (utterances plus gaps) never exceeds it
+SAMPLE_RATE = 16000
+
+# One model shared by SR_WORKERS threads: CTranslate2 runs up to num_workers transcriptions in parallel
+# on a single copy of the weights, each with SR_CPU_THREADS threads, so load scales across cores without
+# oversubscribing them. The model is loaded on first use (or by a background warm-up), not at import.
+model = None
+model_lock = threading.Lock()
+
+def get_model():
+    global model
+    if model is None:
+        with model_lock:
+            if model is None:
+                from faster_whisper import WhisperModel
+                model = WhisperModel(MODEL_SIZE, device=DEVICE, compute_type=COMPUTE_TYPE, cpu_threads=SR_CPU_THREADS, num_workers=SR_WORKERS)
+    return model
+
+class SRPool:
+    def __init__(self, workers: int = SR_WORKERS):
+        self.requests = queue.Queue()
+        self.workers = workers
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.utterances, self.batches, self.batched_utterances, self.unbatched = 0, 0, 0, 0
+        self.audio_seconds, self.processing_seconds, self.queue_wait_seconds = 0.0, 0.0, 0.0
+        self.recent_rtf = deque(maxlen=200) # Per-utterance real-time factor (processing time / audio duration)
+
+    def submit(self, audio) -> Future:
+        self._start()
+        future = Future()
+        samples = load_audio(audio)
+        self.requests.put((samples, future, time.perf_counter()))
+        return future
+
+    def _start(self):
+        with self.start_lock:
+            if self.started: return
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"sr-worker-{i}", daemon=True).start()
+            self.started = True
+
+    def _work(self):
+        carried = None # A long utterance picked up while filling a batch; it's decoded next, on its own
+        while True:
+            batch = [carried or self.requests.get()]
+            carried = None
+            # Pick up other short utterances that are already waiting and decode them in one pass, within one window
+            if duration(batch[0][0]) <= BATCH_MAX_SECONDS:
+                window = duration(batch[0][0]) + BATCH_GAP_SECONDS
+                while len(batch) < BATCH_MAX:
+                    try:
+                        request = self.requests.get_nowait()
+                    except queue.Empty:
+                        break
+                    window += duration(request[0]) + BATCH_GAP_SECONDS
+                    if duration(request[0]) > BATCH_MAX_SECONDS or window > BATCH_WINDOW_SECONDS:
+                        carried = request
+                        break
+                    batch.append(request)
+
+            started = time.perf_counter()
+            try:
+                results = transcribe_batch([samples for samples, _, _ in batch]) if len(batch) > 1 else [transcribe_samples(batch[0][0])]
+                if results is None:
+                    # A word couldn't be placed in a single utterance; decode them one at a time instead
+                    results = [transcribe_samples(samples) for samples, _, _ in batch]
+                    with self.stats_lock: self.unbatched += len(batch)
+            except Exception as e:
+                for _, future, _ in batch: future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - started
+
+            self._record(batch, elapsed)
+            for (_, future, _), result in zip(batch, results): future.set_result(result)
+
+    def _record(self, batch, elapsed: float):
+        batch_seconds = sum(duration(samples) for samples, _, _ in batch) or 1e-6
+        decode_started = time.perf_counter() - elapsed
+        with self.stats_lock:
+            self.queue_wait_seconds += sum(decode_started - enqueued for _, _, enqueued in batch)
+            self.utterances += len(batch)
+            self.batches += 1
+            if len(batch) > 1: self.batched_utterances += len(batch)
+            self.audio_seconds += batch_seconds
+            self.processing_seconds += elapsed
+            # Utterances decoded together share the batch's real-time factor
+            self.recent_rtf.extend([elapsed / batch_seconds] * len(batch))
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            rtf = sorted(self.recent_rtf)
+            return {
+                'model_size': MODEL_SIZE,
+                'workers': self.workers,
+                'cpu_threads': SR_CPU_THREADS,
+                'beam_size': BEAM_SIZE,
+                'queue_depth': self.requests.qsize(),
+                'utterances': self.utterances,
+                'batches': self.batches,
+                'batched_utterances': self.batched_utterances,
+                'unbatched_utterances': self.unbatched,
+                'audio_seconds': round(self.audio_seconds, 3),
+                'processing_seconds': round(self.processing_seconds, 3),
+                'queue_wait_mean': round(self.queue_wait_seconds / self.utterances, 4) if self.utterances else None,
+                'rtf_mean': round(self.processing_seconds / self.audio_seconds, 4) if self.audio_seconds else None,
+                'rtf_p50': round(rtf[len(rtf) // 2], 4) if rtf else None,
+                'rtf_p95': round(rtf[int(len(rtf) * 0.95)], 4) if rtf else None
+            }
 
-def fast_transcribe(filename):
-    segments, info = model.transcribe(filename, beam_size=5, vad_filter=True)
+def load_audio(audio) -> np.ndarray:
+    # 16 kHz mono float32 samples from a file name or an already-decoded array
+    if isinstance(audio, np.ndarray): return audio.astype(np.float32, copy=False)
+    from faster_whisper.audio import decode_audio
+    return decode_audio(audio, sampling_rate=SAMPLE_RATE)
+
+def duration(samples: np.ndarray) -> float:
+    return len(samples) / SAMPLE_RATE
+
+def transcribe_samples(samples: np.ndarray):
+    segments, info = get_model().transcribe(samples, beam_size=BEAM_SIZE, vad_filter=True)
 
     transcription = ""
     no_speech_prob = 0
@@ -27,13 +159,46 @@ def fast_transcribe(filename):
 
     # Average probability that transcription engine identified no speech across all segments:
     if segment_count > 0:
-        no_speech_prob = no_speech_prob / segment_count 
+        no_speech_prob = no_speech_prob / segment_count
     else: no_speech_prob = 1
 
     return transcription, no_speech_prob
 
+def transcribe_batch(batch: list):
+    # Decode several short utterances (from any sessions) in one pass: join them with silence gaps, then hand each
+    # word back to the utterance it lies within. Previous-text conditioning is off so utterances can't leak, and if
+    # any word doesn't lie wholly within one utterance (give or take half a gap) the batch is refused (None).
+    gap = np.zeros(int(BATCH_GAP_SECONDS * SAMPLE_RATE), dtype=np.float32)
+    spans, offset = [], 0.0
+    for samples in batch:
+        spans.append((offset, offset + duration(samples)))
+        offset += duration(samples) + BATCH_GAP_SECONDS
+    joined = np.concatenate([part for samples in batch for part in (samples, gap)])
+
+    segments, info = get_model().transcribe(joined, beam_size=BEAM_SIZE, vad_filter=True, word_timestamps=True, condition_on_previous_text=False)
+
+    margin = BATCH_GAP_SECONDS / 2
+    words = [[] for _ in batch]
+    no_speech = [[] for _ in batch]
+    for segment in segments:
+        for word in segment.words or []:
+            owner = next((i for i, (start, end) in enumerate(spans) if start - margin <= word.start and word.end <= end + margin), None)
+            if owner is None: return None
+            words[owner].append(word.word)
+            if not no_speech[owner] or no_speech[owner][-1] is not segment: no_speech[owner].append(segment)
+
+    return [(''.join(words[i]).strip(), sum(s.no_speech_prob for s in no_speech[i]) / len(no_speech[i]) if no_speech[i] else 1) for i in range(len(batch))]
+
+sr_pool = SRPool()
+
+def fast_transcribe(audio):
+    # Transcribe a file name or 16 kHz float32 samples on the shared worker pool
+    return sr_pool.submit(audio).result()
+
+def sr_stats() -> dict:
+    return sr_pool.stats()
+
 if __name__ == '__main__':
     name = input('Go\n')
     transcribed_result = fast_transcribe('test.wav')[0]
     print('\n' + transcribed_result)
-
@@ -1,37 +1,131 @@
-import io, wave
-from balacoon_tts import TTS
-import numpy as np
-from pydub import AudioSegment
-from huggingface_hub import hf_hub_download
+import multiprocessing, os, re, threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import turk_trace
+from turk_lib import print_log
+from turk_audio import encode_audio, crossfade_join, PYAV_AVAILABLE
+
+# Formats this engine can hand over, cheapest first: WAV needs no encoding at all
+AUDIO_FORMATS = ('wav', 'opus', 'mp3') if PYAV_AVAILABLE else ('wav', 'mp3')
 
 MODEL = 'en_us_hifi92_light_cpu.addon'
-model_path = hf_hub_download(repo_id="balacoon/tts", filename=MODEL)
+SPEAKER_INDEX = -1
 
-tts = TTS(model_path)
-supported_speakers = tts.get_speakers()
-speaker = supported_speakers[-1]
+# Long replies are split at sentence (then clause) boundaries and synthesised across a pool of worker processes,
+# each with its own model, then joined back in order with short crossfades. Short text stays in-process.
+CPU_COUNT = os.cpu_count() or 1
+TTS_WORKERS = int(os.environ.get('TURK_TTS_WORKERS', max(1, min(4, CPU_COUNT // 2))))          # 1 disables the pool
+PARALLEL_MIN_CHARACTERS = int(os.environ.get('TURK_TTS_PARALLEL_MIN_CHARACTERS', 240))  # Shorter text isn't worth splitting
+PIECE_CHARACTERS = int(os.environ.get('TURK_TTS_PIECE_CHARACTERS', 160))                # Target size of each worker's piece
+CROSSFADE_MS = 15
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+')
+CLAUSE_BREAK = re.compile(r'(?<=[,;:\u2013\u2014])\s+')
 
-def text_to_mp3(text: str, tts_filename: str = 'fltts_result') -> None:
-    if not text.strip(): return
+# The model is downloaded and loaded on first use (or by a background warm-up), not at import
+tts = None
+speaker = None
+tts_lock = threading.Lock()
+
+def get_tts():
+    global tts, speaker
+    if tts is None:
+        with tts_lock:
+            if tts is None:
+                from balacoon_tts import TTS
+                from huggingface_hub import hf_hub_download
+                model_path = hf_hub_download(repo_id="balacoon/tts", filename=MODEL)
+                loaded_tts = TTS(model_path)
+                supported_speakers = loaded_tts.get_speakers()
+                speaker = supported_speakers[SPEAKER_INDEX]
+                tts = loaded_tts
+    return tts
+
+pool = None
+pool_warmup = []
+pool_lock = threading.Lock()
+
+def start_pool(workers: int = TTS_WORKERS):
+    # Forks the synthesis workers and has each load its model. Called before the app starts any threads: forking a
+    # threaded process isn't safe, and spawned workers would re-import (and re-run) the app's main module
+    global pool, pool_warmup
+    with pool_lock:
+        if pool is None and workers > 1:
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+            pool_warmup = [pool.submit(_warm_worker) for _ in range(workers)]
+    return pool
+
+def wait_for_pool():
+    for future in pool_warmup: future.result()
 
-    samples = tts.synthesize(text, speaker)
+def stop_pool():
+    global pool
+    with pool_lock:
+        if pool: pool.shutdown(cancel_futures=True)
+        pool = None
 
-    # Convert the numpy array to bytes
-    raw_audio_data = samples.tobytes()
+def _warm_worker() -> int:
+    get_tts()
+    return os.getpid()
 
-    # Create an AudioSegment instance from the raw audio data
-    audio_segment = AudioSegment(
-        data=raw_audio_data,
-        sample_width=2,  # 2 bytes as it's 16-bit audio
-        frame_rate=tts.get_sampling_rate(),
-        channels=1
-    )
+def _synthesize_piece(text: str):
+    return get_tts().synthesize(text, speaker)
 
-    buffer = io.BytesIO()
-    audio_segment.export(buffer, format="mp3")
+def split_for_synthesis(text: str, piece_characters: int = PIECE_CHARACTERS) -> list:
+    # Sentences (overlong ones cut at clauses, then between words), packed into pieces of up to about piece_characters
+    units = []
+    for sentence in SENTENCE_BREAK.split(text.strip()):
+        for clause in ([sentence] if len(sentence) <= piece_characters else CLAUSE_BREAK.split(sentence)):
+            while len(clause) > piece_characters:
+                cut = clause.rfind(' ', 0, piece_characters)
+                if cut <= 0: break
+                units.append(clause[:cut])
+                clause = clause[cut + 1:]
+            units.append(clause)
+
+    pieces = []
+    for unit in units:
+        if not unit.strip(): continue
+        if pieces and len(pieces[-1]) + 1 + len(unit) <= piece_characters: pieces[-1] += ' ' + unit
+        else: pieces.append(unit)
+    return pieces
+
+def synthesize_in_pool(pieces: list, sample_rate: int):
+    # Joined samples, or None if the pool has failed (long replies then fall back to a single call until restart)
+    global pool
+    workers = pool
+    if workers is None: return None
+    try:
+        clips = list(workers.map(_synthesize_piece, pieces))
+    except BrokenProcessPool as e:
+        print_log(f"TTS worker pool failed ({e}); synthesising in-process from now on.")
+        pool = None
+        return None
+    return crossfade_join(clips, sample_rate * CROSSFADE_MS // 1000)
+
+def text_to_samples(text: str):
+    # int16 NumPy samples and their rate, straight from the model
+    tts_engine = get_tts()
+    sample_rate = tts_engine.get_sampling_rate()
+    pieces = split_for_synthesis(text) if pool and len(text) >= PARALLEL_MIN_CHARACTERS else [text]
+    with turk_trace.span('tts_synthesis', engine = 'balacoon', pieces = len(pieces) if len(pieces) > 1 else None):
+        if len(pieces) > 1:
+            samples = synthesize_in_pool(pieces, sample_rate)
+            if samples is not None: return samples, sample_rate
+        samples = tts_engine.synthesize(text, speaker)
+    return samples, sample_rate
+
+def text_to_audio_bytes(text: str, audio_format: str = 'mp3') -> bytes:
+    # WAV wraps the samples as they are; Opus and MP3 are encoded in-process (MP3 falls back to pydub/ffmpeg without PyAV)
+    if not text.strip(): return b''
+    samples, sample_rate = text_to_samples(text)
+    return encode_audio(samples, sample_rate, audio_format)
+
+def text_to_file(text: str, tts_filename: str = 'fltts_result', audio_format: str = 'mp3') -> None:
+    if not text.strip(): return
 
-    with open(tts_filename + '.mp3', "wb") as f:
-        f.write(buffer.getvalue())
+    with open(f"{tts_filename}.{audio_format}", "wb") as f:
+        f.write(text_to_audio_bytes(text, audio_format))
 
 if __name__ == '__main__':
-    text_to_mp3("In the quiet moonlight, a gentle breeze rustles through the leaves, whispering secrets of the ancient forest. The air is crisp and fresh, filled with the subtle scent of pine and earth. Somewhere in the distance, an owl hoots solemnly, its call echoing through the trees. Each sound, from the rustling leaves to the soft footfalls on the forest floor, creates a symphony of natural tranquility, inviting a moment of serene reflection.")
+    text_to_file("In the quiet moonlight, a gentle breeze rustles through the leaves, whispering secrets of the ancient forest. The air is crisp and fresh, filled with the subtle scent of pine and earth. Somewhere in the distance, an owl hoots solemnly, its call echoing through the trees. Each sound, from the rustling leaves to the soft footfalls on the forest floor, creates a symphony of natural tranquility, inviting a moment of serene reflection.")
@@ -0,0 +1,329 @@
+import argparse, glob, io, json, os, queue, re, struct, threading, time, zipfile, zlib
+
+from turk_lib import print_log
+import turk_trace
+
+# Artifact archive: recorded uploads, played speech and code blocks are packed into rolling segment files instead
+# of one file each. A background thread takes them off a queue and appends each one as a record (compressed when
+# that helps) to the current segment. It also appends an index line (turn id, kind, name -> offset) to the segment's
+# .idx file. Retention drops whole segments by age and total size, so the store stays a few hundred files at most
+# however busy the install. Each process writes its own segments, so several web workers can share one store.
+#   python turk_archive.py --import audio_in audio_out sandbox   (packs loose files from before the store)
+
+ARCHIVE_STORE_DIR = os.environ.get('TURK_ARCHIVE_DIR', 'archive/segments/')
+ARCHIVE_MAX_DAYS = float(os.environ.get('TURK_ARCHIVE_MAX_DAYS', 30))      # Segments older than this are deleted
+ARCHIVE_MAX_BYTES = int(float(os.environ.get('TURK_ARCHIVE_MAX_GB', 2)) * 1024 ** 3) # Oldest segments go beyond this
+SEGMENT_BYTES = 64 * 1024 * 1024    # A segment is closed once it reaches this size...
+SEGMENT_SECONDS = 3600              # ...or this age, so retention can drop old data an hour at a time
+RETENTION_INTERVAL = 600            # seconds between retention checks
+MAX_PENDING = 256                   # Artifacts queued for writing before new ones are dropped (and logged)
+MIN_COMPRESSION_SAVING = 0.1        # Records are stored zlib-compressed if that saves at least this fraction
+
+RECORD = struct.Struct('!4sBII')    # magic, flags, metadata length, data length
+RECORD_MAGIC = b'TKAR'
+FLAG_ZLIB = 1
+SEGMENT_NAME = re.compile(r'^seg-(\d+)-(\d+)-(\d+)\.bin$')  # seg-<opened>-<pid>-<n>.bin
+KINDS = ('audio_in', 'audio_out', 'code')
+LEGACY_CODEBLOCK_NAME = re.compile(r'^cb_\d+_([0-9a-f]{16})_\d+\.txt$')   # sandbox/cb_<minute>_<session>_<NN>.txt
+
+def encode_record(meta: dict, data: bytes) -> bytes:
+    stored, flags = data, 0
+    packed = zlib.compress(data, 6)
+    if len(packed) <= len(data) * (1 - MIN_COMPRESSION_SAVING): stored, flags = packed, FLAG_ZLIB
+    meta_bytes = json.dumps({**meta, 'size': len(data)}).encode()
+    return RECORD.pack(RECORD_MAGIC, flags, len(meta_bytes), len(stored)) + meta_bytes + stored
+
+def read_record(file, offset: int):
+    # (metadata, data, offset of the next record); raises ValueError for a torn or corrupt record
+    file.seek(offset)
+    header = file.read(RECORD.size)
+    if len(header) < RECORD.size: raise ValueError('Truncated record header')
+    magic, flags, meta_length, data_length = RECORD.unpack(header)
+    if magic != RECORD_MAGIC: raise ValueError(f"Bad record at offset {offset}")
+    body = file.read(meta_length + data_length)
+    if len(body) < meta_length + data_length: raise ValueError('Truncated record')
+    data = body[meta_length:]
+    return json.loads(body[:meta_length]), zlib.decompress(data) if flags & FLAG_ZLIB else data, offset + RECORD.size + len(body)
+
+class ArchiveStore:
+    def __init__(self, root: str = ARCHIVE_STORE_DIR, max_age_days: float = ARCHIVE_MAX_DAYS, max_bytes: int = ARCHIVE_MAX_BYTES,
+                 segment_bytes: int = SEGMENT_BYTES, segment_seconds: float = SEGMENT_SECONDS):
+        self.root = root
+        self.max_age, self.max_bytes = max_age_days * 86400, max_bytes
+        self.segment_bytes, self.segment_seconds = segment_bytes, segment_seconds
+        self.by_turn = {}       # turn id -> [entry]; an entry is the record's metadata plus 'segment' and 'offset'
+        self.by_name = {}       # (kind, name) -> entry
+        self.index_read = {}    # .idx path -> bytes of it already loaded (segments other processes are writing grow)
+        self.pending = queue.Queue(maxsize=MAX_PENDING)
+        self.lock = threading.Lock()
+        self.segment, self.segment_file, self.index_file, self.segment_opened = None, None, None, 0
+        self.segments_opened = 0
+        self.written, self.dropped, self.removed_segments = 0, 0, 0
+        self.last_retention = 0
+        self.sync_failed = False    # A segment couldn't be synced since the last flush()
+
+    def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.refresh()
+        threading.Thread(target=self._work, name='archive-store', daemon=True).start()
+
+    def put(self, kind: str, name: str, data: bytes, turn_id: str = None, block: bool = False, on_written=None, owner: str = None) -> bool:
+        # Queues an artifact for archiving (the turn id defaults to the turn running on this thread). Doesn't block unless
+        # asked to; returns False if the queue was full and the artifact dropped. on_written(entry) runs on the archive
+        # thread once the record is in a segment (it's on disk for certain after the next flush()). `owner` (a session
+        # id, for recall) stays in the index and is never served.
+        if turn_id is None: turn_id = getattr(turk_trace.current(), 'turn_id', None)
+        meta = {'kind': kind, 'name': name, 'turn': turn_id, 'time': time.time()}
+        if owner: meta['owner'] = owner
+        try:
+            self.pending.put((meta, data, on_written), block)
+        except queue.Full:
+            self.dropped += 1
+            print_log(f"Archive queue full; {name} not archived.", turn = turn_id)
+            return False
+        return True
+
+    def flush(self, timeout: float = None) -> bool:
+        # Waits until everything queued before the call is written and fsynced; False if that failed or timed out
+        done, outcome = threading.Event(), []
+        self.pending.put((None, done, outcome))
+        return done.wait(timeout) and outcome == [True]
+
+    # --- Writing (archive thread) ---
+
+    def _work(self):
+        while True:
+            try:
+                meta, data, on_written = self.pending.get(timeout=RETENTION_INTERVAL)
+            except queue.Empty:
+                meta, data = None, None
+            if meta is None and data is not None:
+                self._flush(data, on_written)
+                continue
+            try:
+                if meta is not None: self._append(meta, data, on_written)
+                if self.segment and time.time() - self.segment_opened > self.segment_seconds: self._close_segment()
+                if time.time() - self.last_retention > RETENTION_INTERVAL: self.enforce_retention()
+            except Exception as e:
+                print_log(f"Failed to archive {meta['name'] if meta else 'artifacts'}: {e}", turn = meta and meta['turn'])
+                self._close_segment()
+
+    def _open_segment(self):
+        self.segments_opened += 1
+        self.segment_opened = time.time()
+        self.segment = os.path.join(self.root, f"seg-{int(self.segment_opened)}-{os.getpid()}-{self.segments_opened}.bin")
+        self.segment_file = open(self.segment, 'ab')
+        self.index_file = open(self.segment[:-4] + '.idx', 'a')
+
+    def _close_segment(self):
+        for file in (self.segment_file, self.index_file):
+            if file:
+                try:
+                    os.fsync(file.fileno())
+                except (OSError, ValueError):
+                    self.sync_failed = True
+                try:
+                    file.close()
+                except OSError:
+                    self.sync_failed = True
+        self.segment, self.segment_file, self.index_file = None, None, None
+
+    def _flush(self, done: threading.Event, outcome: list):
+        # Earlier records went either to closed segments (fsynced on closing) or to the current one, synced here
+        try:
+            for file in (self.segment_file, self.index_file):
+                if file: os.fsync(file.fileno())
+            outcome.append(not self.sync_failed)
+        except (OSError, ValueError) as e:
+            print_log(f"Archive flush failed: {e}")
+            outcome.append(False)
+            self._close_segment()
+        self.sync_failed = False
+        done.set()
+
+    def _append(self, meta: dict, data: bytes, on_written=None):
+        if self.segment is None: self._open_segment()
+        offset = self.segment_file.tell()
+        record = encode_record(meta, data)
+        self.segment_file.write(record)
+        self.segment_file.flush()
+        entry = {**meta, 'size': len(data), 'stored': len(record), 'segment': os.path.basename(self.segment), 'offset': offset}
+        line = json.dumps(entry) + '\n'
+        self.index_file.write(line)
+        self.index_file.flush()
+        with self.lock:
+            self._add(entry)
+            self.index_read[self.index_file.name] = self.index_read.get(self.index_file.name, 0) + len(line.encode())
+        self.written += 1
+        if on_written: on_written(entry)
+        if offset + len(record) >= self.segment_bytes: self._close_segment()
+
+    def _add(self, entry: dict):
+        if entry.get('turn'): self.by_turn.setdefault(entry['turn'], []).append(entry)
+        self.by_name[(entry['kind'], entry['name'])] = entry
+
+    # --- Index ---
+
+    def refresh(self):
+        # Loads index lines not seen yet: all of them at startup, then what other processes have written since
+        with self.lock:
+            for index_path in sorted(glob.glob(os.path.join(self.root, 'seg-*.idx'))):
+                if self.segment and index_path == self.segment[:-4] + '.idx': continue
+                self._load_index(index_path)
+
+    def _load_index(self, index_path: str):
+        start = self.index_read.get(index_path, 0)
+        try:
+            with open(index_path, 'rb') as f:
+                f.seek(start)
+                lines = f.read()
+        except OSError:
+            return
+        complete = lines[:lines.rfind(b'\n') + 1] # A line still being written is picked up next time
+        for line in complete.splitlines():
+            try:
+                self._add(json.loads(line))
+            except ValueError:
+                pass
+        self.index_read[index_path] = start + len(complete)
+
+    def turn(self, turn_id: str) -> list:
+        # Index entries of everything archived for a turn, oldest first
+        with self.lock:
+            entries = list(self.by_turn.get(turn_id, []))
+        if not entries:
+            self.refresh()
+            with self.lock:
+                entries = list(self.by_turn.get(turn_id, []))
+        return [entry for entry in entries if os.path.exists(os.path.join(self.root, entry['segment']))]
+
+    def find(self, kind: str, name: str):
+        with self.lock:
+            entry = self.by_name.get((kind, name))
+        if entry is None:
+            self.refresh()
+            with self.lock:
+                entry = self.by_name.get((kind, name))
+        return entry
+
+    def entries(self, kind: str = None) -> list:
+        with self.lock:
+            return [entry for (entry_kind, _), entry in self.by_name.items() if kind in (None, entry_kind)]
+
+    def read(self, entry: dict) -> bytes:
+        # The artifact's bytes, or None if its segment has since been removed by retention
+        try:
+            with open(os.path.join(self.root, entry['segment']), 'rb') as f:
+                return read_record(f, entry['offset'])[1]
+        except FileNotFoundError:
+            return None
+
+    def export(self, turn_id: str) -> bytes:
+        # A zip of everything archived for the turn, with its index entries as manifest.json
+        entries = self.turn(turn_id)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            manifest = []
+            for entry in entries:
+                data = self.read(entry)
+                if data is None: continue
+                archive.writestr(f"{entry['kind']}/{entry['name']}", data)
+                manifest.append({key: entry[key] for key in ('kind', 'name', 'turn', 'time', 'size')})
+            archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        return buffer.getvalue()
+
+    # --- Retention ---
+
+    def segments(self) -> list:
+        # (path, bytes, last modified) of every segment, oldest first
+        found = []
+        for entry in os.scandir(self.root):
+            if SEGMENT_NAME.match(entry.name):
+                stat = entry.stat()
+                found.append((entry.path, stat.st_size, stat.st_mtime))
+        return sorted(found, key=lambda segment: SEGMENT_NAME.match(os.path.basename(segment[0])).group(1, 3))
+
+    def enforce_retention(self):
+        # Whole segments go, oldest first, once past the age limit or while the store is over its size limit.
+        # Segments written to recently are never touched (they may be some process's current segment).
+        self.last_retention = time.time()
+        segments = self.segments()
+        total = sum(size for _, size, _ in segments)
+        now = time.time()
+        for path, size, modified in segments:
+            if now - modified < self.segment_seconds: break
+            if now - modified <= self.max_age and total <= self.max_bytes: break
+            try:
+                os.remove(path)
+                if os.path.exists(path[:-4] + '.idx'): os.remove(path[:-4] + '.idx')
+            except OSError as e:
+                print_log(f"Archive retention couldn't remove {os.path.basename(path)}: {e}")
+                continue
+            total -= size
+            self.removed_segments += 1
+            self._forget(os.path.basename(path))
+            print_log(f"Archive retention removed {os.path.basename(path)} ({size / 1024 ** 2:.1f} MB).")
+
+    def _forget(self, segment: str):
+        with self.lock:
+            self.index_read.pop(os.path.join(self.root, segment[:-4] + '.idx'), None)
+            self.by_name = {key: entry for key, entry in self.by_name.items() if entry['segment'] != segment}
+            for turn_id in [turn_id for turn_id, entries in self.by_turn.items() if entries[0]['segment'] == segment]:
+                entries = [entry for entry in self.by_turn[turn_id] if entry['segment'] != segment]
+                if entries: self.by_turn[turn_id] = entries
+                else: del self.by_turn[turn_id]
+
+    def stats(self) -> dict:
+        segments = self.segments() if os.path.isdir(self.root) else []
+        with self.lock:
+            artifacts, turns = len(self.by_name), len(self.by_turn)
+        return {
+            'segments': len(segments),
+            'bytes': sum(size for _, size, _ in segments),
+            'artifacts': artifacts,
+            'turns': turns,
+            'written': self.written,
+            'queued': self.pending.qsize(),
+            'dropped': self.dropped,
+            'removed_segments': self.removed_segments,
+            'max_days': self.max_age / 86400,
+            'max_bytes': self.max_bytes
+        }
+
+def import_loose_files(store: ArchiveStore, directories: list, remove: bool = False):
+    # Packs files archived one per file (audio_in/, audio_out/, sandbox/) into the store
+    kinds = {'audio_in': 'audio_in', 'audio_out': 'audio_out', 'sandbox': 'code'}
+    for directory in directories:
+        kind = kinds.get(os.path.basename(os.path.normpath(directory)))
+        if kind is None: raise SystemExit(f"Don't know what {directory} holds (expected one of {', '.join(kinds)})")
+        paths = sorted(entry.path for entry in os.scandir(directory) if entry.is_file())
+        written = []    # Paths whose records are in a segment
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            name = os.path.basename(path)
+            turn_id = os.path.splitext(name)[0] if kind == 'audio_in' else re.sub(r'_\d+$', '', os.path.splitext(name)[0]) if kind == 'audio_out' else None
+            owner = LEGACY_CODEBLOCK_NAME.match(name) if kind == 'code' else None
+            store.put(kind, name, data, turn_id, block=True, on_written=lambda entry, path=path: written.append(path), owner=owner and owner.group(1))
+        if not store.flush():
+            raise SystemExit(f"{directory}: couldn't confirm the archive was written; no files removed")
+        if remove:
+            for path in written: os.remove(path)
+        print(f"{directory}: {len(written)} of {len(paths)} file(s) packed{' and removed' if remove else ''}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='turk-chat artifact archive')
+    parser.add_argument('--import', dest='directories', nargs='+', metavar='DIR', help='pack loose files from audio_in/, audio_out/ or sandbox/')
+    parser.add_argument('--remove', action='store_true', help='delete the loose files once packed')
+    parser.add_argument('--export', metavar='TURN_ID', help='write a zip of everything archived for a turn')
+    parser.add_argument('--retention', action='store_true', help='apply the retention limits now')
+    args = parser.parse_args()
+
+    store = ArchiveStore()
+    store.start()
+    if args.directories: import_loose_files(store, args.directories, args.remove)
+    if args.export:
+        with open(f"{args.export}.zip", 'wb') as f: f.write(store.export(args.export))
+        print(f"Wrote {args.export}.zip")
+    if args.retention: store.enforce_retention()
+    print(json.dumps(store.stats(), indent=2))
@@ -0,0 +1,245 @@
+import importlib.util, io, struct, threading, time, wave
+import numpy as np
+
+import turk_trace
+
+# In-memory audio handling: uploads are decoded straight into float32 NumPy buffers at the recogniser's
+# 16 kHz rate, and archiving to disk happens on a background writer, off the request/turn path.
+
+SR_SAMPLE_RATE = 16000
+
+# Silence trimming ahead of recognition (the browser's VAD pads clips with pre-roll and ~1.5 s of trailing silence)
+TRIM_FRAME_MS = 20
+TRIM_PADDING_MS = 250           # Kept either side of the detected speech so word edges aren't clipped
+TRIM_FLOOR_MARGIN_DB = 12       # Speech frames are this far above the estimated noise floor...
+TRIM_MIN_LEVEL_DB = -50         # ...and at least this loud (dBFS)
+TRIM_MAX_FLOOR_DB = -45         # Cap on the floor estimate, so a clip that's speech throughout isn't mistaken for noise
+MIN_SPEECH_SECONDS = 0.25       # Clips with less speech than this are rejected as noise
+
+# Formats synthesised speech can be delivered in (also the served file extensions), and how clients ask for them
+AUDIO_MIMETYPES = {'wav': 'audio/wav', 'opus': 'audio/ogg; codecs=opus', 'mp3': 'audio/mpeg'}
+ACCEPT_ALIASES = {'audio/wav': 'wav', 'audio/wave': 'wav', 'audio/x-wav': 'wav', 'audio/ogg': 'opus', 'audio/opus': 'opus', 'audio/mpeg': 'mp3', 'audio/mp3': 'mp3'}
+DEFAULT_AUDIO_ACCEPT = 'audio/mpeg' # Clients that don't say what they can play get MP3, as before
+UPLOAD_EXTENSIONS = ('.wav', '.ogg', '.opus', '.webm') # Browsers upload 16 kHz WAV, or Ogg Opus where they can encode it
+PYAV_AVAILABLE = importlib.util.find_spec('av') is not None # PyAV (bundled with faster-whisper) encodes in-process
+OPUS_RATE = 48000
+OPUS_BITRATE = 32000
+MP3_BITRATE = 128000
+PLAYED_AUDIO_TTL = 300          # seconds synthesised audio waits in memory for the client before it's archived anyway
+
+def decode_audio_bytes(data: bytes, sample_rate: int = SR_SAMPLE_RATE) -> np.ndarray:
+    # Mono float32 samples in [-1, 1] at `sample_rate` from an uploaded clip
+    try:
+        samples, source_rate = decode_wav(data)
+    except (wave.Error, EOFError, ValueError):
+        # Not PCM WAV (e.g. Ogg Opus); PyAV decodes and resamples it in-process
+        return decode_with_pyav(data, sample_rate)
+    return resample(samples, source_rate, sample_rate)
+
+def decode_with_pyav(data: bytes, sample_rate: int) -> np.ndarray:
+    import av
+    with av.open(io.BytesIO(data), 'r') as container:
+        resampler = av.AudioResampler(format='flt', layout='mono', rate=sample_rate)
+        chunks = [resampled.to_ndarray().reshape(-1) for frame in container.decode(audio=0) for resampled in resampler.resample(frame)]
+        chunks += [resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(None)]
+    return np.concatenate(chunks).astype(np.float32, copy=False) if chunks else np.zeros(0, np.float32)
+
+def decode_wav(data: bytes):
+    with wave.open(io.BytesIO(data), 'rb') as wav:
+        channels, sample_width, source_rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    if sample_width == 2:
+        samples = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 4:
+        samples = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 2147483648
+    elif sample_width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {sample_width}")
+
+    if channels > 1: samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples, source_rate
+
+def lowpass_kernel(cutoff: float, taps: int = 63) -> np.ndarray:
+    # Hann-windowed sinc; `cutoff` is a fraction of the sample rate (0 - 0.5)
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hanning(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+def resample(samples: np.ndarray, source_rate: int, target_rate: int = SR_SAMPLE_RATE) -> np.ndarray:
+    if source_rate == target_rate or len(samples) == 0: return samples.astype(np.float32, copy=False)
+
+    if target_rate < source_rate:
+        # Band-limit before dropping samples so speech above the new Nyquist doesn't alias
+        samples = np.convolve(samples, lowpass_kernel(0.5 * target_rate / source_rate * 0.9), mode='same')
+        if source_rate % target_rate == 0:
+            return samples[::source_rate // target_rate].astype(np.float32, copy=False)
+
+    target_length = int(round(len(samples) * target_rate / source_rate))
+    positions = np.arange(target_length) * (source_rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def encode_wav(samples: np.ndarray, sample_rate: int = SR_SAMPLE_RATE) -> bytes:
+    # 16-bit mono PCM WAV
+    return pcm16_wav((np.clip(samples, -1, 1) * 32767).astype('<i2'), sample_rate)
+
+def pcm16_wav(pcm, sample_rate: int) -> bytes:
+    # WAV around 16-bit mono PCM that's already in shape (int16 samples or raw little-endian bytes): just a header, no conversion
+    data = memoryview(pcm).cast('B')
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16, b'data', len(data))
+    return b''.join((header, data))
+
+def encode_with_pyav(pcm: np.ndarray, sample_rate: int, container_format: str, codec: str, codec_rate: int, bit_rate: int) -> bytes:
+    # Encodes int16 samples in-process (no ffmpeg subprocess); PyAV resamples to codec_rate if need be
+    import av
+    buffer = io.BytesIO()
+    with av.open(buffer, 'w', format=container_format) as container:
+        stream = container.add_stream(codec, rate=codec_rate)
+        stream.bit_rate, stream.layout = bit_rate, 'mono'
+        frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(pcm, dtype=np.int16).reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame): container.mux(packet)
+        for packet in stream.encode(None): container.mux(packet)
+    return buffer.getvalue()
+
+def encode_opus(pcm: np.ndarray, sample_rate: int) -> bytes:
+    return encode_with_pyav(pcm, sample_rate, 'ogg', 'libopus', OPUS_RATE, OPUS_BITRATE)
+
+def encode_mp3(pcm: np.ndarray, sample_rate: int) -> bytes:
+    if PYAV_AVAILABLE: return encode_with_pyav(pcm, sample_rate, 'mp3', 'libmp3lame', sample_rate, MP3_BITRATE)
+    from pydub import AudioSegment
+    buffer = io.BytesIO()
+    AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=sample_rate, channels=1).export(buffer, format='mp3')
+    return buffer.getvalue()
+
+def crossfade_join(clips: list, overlap: int) -> np.ndarray:
+    # int16 clips joined in order, each join overlapped by up to `overlap` samples with a linear crossfade so there's no click
+    parts, tail = [], clips[0].astype(np.float32)
+    for clip in clips[1:]:
+        clip = clip.astype(np.float32)
+        n = min(overlap, len(tail), len(clip))
+        ramp = np.linspace(0, 1, n + 2, dtype=np.float32)[1:-1]
+        parts += [tail[:len(tail) - n], tail[len(tail) - n:] * (1 - ramp) + clip[:n] * ramp]
+        tail = clip[n:]
+    parts.append(tail)
+    return np.clip(np.concatenate(parts), -32768, 32767).astype(np.int16)
+
+AUDIO_ENCODERS = {'wav': pcm16_wav, 'opus': encode_opus, 'mp3': encode_mp3}
+
+def encode_audio(pcm: np.ndarray, sample_rate: int, audio_format: str) -> bytes:
+    with turk_trace.span(f"{audio_format}_encode"):
+        return AUDIO_ENCODERS[audio_format](pcm, sample_rate)
+
+def negotiate_audio_format(accept: str, available: tuple) -> str:
+    # The format in `available` (listed in the server's order of preference) that the client rates highest.
+    # `accept` is an Accept-style list, e.g. "audio/wav, audio/ogg; codecs=opus, audio/mpeg;q=0.5"
+    quality = {}
+    for entry in (accept or DEFAULT_AUDIO_ACCEPT).split(','):
+        media_type, *parameters = [part.strip().lower() for part in entry.split(';')]
+        q = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try: q = float(value)
+                except ValueError: q = 0
+            elif name.strip() == 'codecs' and 'opus' not in value: media_type = None # e.g. Ogg Vorbis only
+        if media_type in ('*/*', 'audio/*'):
+            for audio_format in available: quality.setdefault(audio_format, q)
+        elif media_type in ACCEPT_ALIASES:
+            audio_format = ACCEPT_ALIASES[media_type]
+            quality[audio_format] = max(quality.get(audio_format, 0), q)
+
+    acceptable = [audio_format for audio_format in available if quality.get(audio_format, 0) > 0]
+    if not acceptable: return 'mp3'
+    return max(acceptable, key=lambda audio_format: quality[audio_format]) # Ties go to the server's preference
+
+class PendingAudio:
+    # Synthesised clips waiting for the client, held in memory rather than written out and read back; each one is
+    # archived (in the background, under the turn that voiced it) when it's fetched, or once it has waited `ttl` seconds
+    def __init__(self, archive, ttl: float = PLAYED_AUDIO_TTL):
+        self.archive, self.ttl = archive, ttl
+        self.clips = {} # name -> (audio bytes, time added, turn id)
+        self.lock = threading.Lock()
+
+    def put(self, name: str, data: bytes):
+        with self.lock:
+            self._expire()
+            self.clips[name] = (data, time.time(), getattr(turk_trace.current(), 'turn_id', None))
+
+    def take(self, name: str):
+        with self.lock:
+            clip = self.clips.pop(name, None)
+        if clip is None: return None
+        self.archive.put('audio_out', name, clip[0], clip[2])
+        return clip[0]
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for name in [name for name, (_, added, _) in self.clips.items() if added < cutoff]:
+            data, _, turn_id = self.clips.pop(name)
+            self.archive.put('audio_out', name, data, turn_id)
+
+class PreprocessStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clips, self.rejected = 0, 0
+        self.seconds_in, self.seconds_out = 0.0, 0.0
+        self.uploads = {} # extension -> [count, bytes]
+
+    def record(self, seconds_in: float, seconds_out: float, rejected: bool):
+        with self.lock:
+            self.clips += 1
+            self.rejected += rejected
+            self.seconds_in += seconds_in
+            self.seconds_out += seconds_out
+
+    def record_upload(self, extension: str, size: int):
+        with self.lock:
+            upload = self.uploads.setdefault(extension, [0, 0])
+            upload[0] += 1
+            upload[1] += size
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                'clips': self.clips,
+                'rejected_as_noise': self.rejected,
+                'seconds_in': round(self.seconds_in, 3),
+                'seconds_out': round(self.seconds_out, 3),
+                'seconds_saved': round(self.seconds_in - self.seconds_out, 3),
+                'fraction_saved': round(1 - self.seconds_out / self.seconds_in, 4) if self.seconds_in else 0,
+                'uploads': {extension: {'count': count, 'bytes': size} for extension, (count, size) in self.uploads.items()},
+                'upload_bytes_per_second': round(sum(size for _, size in self.uploads.values()) / self.seconds_in) if self.seconds_in else 0
+            }
+
+preprocess_stats = PreprocessStats()
+
+def frame_levels(samples: np.ndarray, frame_length: int) -> np.ndarray:
+    # RMS level (dBFS) of each whole frame
+    frame_count = len(samples) // frame_length
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-6))
+
+def trim_silence(samples: np.ndarray, sample_rate: int = SR_SAMPLE_RATE):
+    # The speech-bearing part of a clip (plus padding), or None if it looks like noise throughout
+    frame_length = sample_rate * TRIM_FRAME_MS // 1000
+    if len(samples) < frame_length: return None
+
+    levels = frame_levels(samples, frame_length)
+    noise_floor = min(np.percentile(levels, 10), TRIM_MAX_FLOOR_DB)
+    speech = np.flatnonzero(levels > max(noise_floor + TRIM_FLOOR_MARGIN_DB, TRIM_MIN_LEVEL_DB))
+    if len(speech) * TRIM_FRAME_MS / 1000 < MIN_SPEECH_SECONDS: return None
+
+    padding = sample_rate * TRIM_PADDING_MS // 1000
+    start = max(0, speech[0] * frame_length - padding)
+    end = min(len(samples), (speech[-1] + 1) * frame_length + padding)
+    return samples[start:end]
+
+def prepare_for_recognition(samples: np.ndarray, sample_rate: int = SR_SAMPLE_RATE):
+    # Trim leading/trailing silence before any model sees the clip; None means "don't bother transcribing"
+    trimmed = trim_silence(samples, sample_rate)
+    seconds_out = 0 if trimmed is None else len(trimmed) / sample_rate
+    preprocess_stats.record(len(samples) / sample_rate, seconds_out, trimmed is None)
+    return trimmed
@@ -0,0 +1,116 @@
+import hashlib, os, threading
+from collections import OrderedDict
+
+# Content-addressed cache for synthesised speech, keyed on (engine, voice, normalised text).
+# A small in-memory tier sits in front of a size-bounded on-disk tier; both evict least recently used first.
+
+TTS_CACHE_DIR = 'tts_cache/'
+TTS_CACHE_MEMORY_LIMIT = 32 * 1024 * 1024 # bytes
+TTS_CACHE_DISK_LIMIT = 512 * 1024 * 1024  # bytes
+
+class AudioCache:
+    def __init__(self, cache_dir: str = TTS_CACHE_DIR, memory_limit: int = TTS_CACHE_MEMORY_LIMIT, disk_limit: int = TTS_CACHE_DISK_LIMIT):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict() # key -> audio bytes, least recently used first
+        self.memory_bytes = 0
+        self.disk = OrderedDict()   # key -> file size, least recently used first
+        self.disk_bytes = 0
+        self.hits_memory, self.hits_disk, self.misses = 0, 0, 0
+        self.lock = threading.Lock()
+
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+        # Rebuild the disk tier's LRU order from modification times (touched on every hit)
+        entries = [entry for entry in os.scandir(cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self.disk[entry.name] = entry.stat().st_size
+            self.disk_bytes += entry.stat().st_size
+        self._trim_disk()
+
+    @staticmethod
+    def key(engine: str, voice: str, text: str, audio_format: str = 'mp3') -> str:
+        normalized_text = ' '.join(text.split())
+        digest = hashlib.sha256(f"{engine}\0{voice}\0{normalized_text}".encode('utf-8')).hexdigest()
+        return f"{digest}.{audio_format}"
+
+    def get(self, key: str):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return self.memory[key]
+            if key not in self.disk:
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.disk_bytes -= self.disk.pop(key, 0)
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits_disk += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = os.path.join(self.cache_dir, key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.disk_bytes += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            self._remember(key, data)
+            self._trim_disk()
+
+    def get_or_create(self, key: str, synthesise):
+        # Cached audio for `key`, calling synthesise() -> bytes and storing the result on a miss
+        data = self.get(key)
+        if data is None:
+            data = synthesise()
+            if data: self.put(key, data)
+        return data
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'hit_rate': (self.hits_memory + self.hits_disk) / lookups if lookups else 0,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes
+            }
+
+    def _remember(self, key: str, data: bytes):
+        # Caller holds self.lock
+        if len(data) > self.memory_limit: return
+        self.memory_bytes += len(data) - len(self.memory.pop(key, b''))
+        self.memory[key] = data
+        while self.memory_bytes > self.memory_limit:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _trim_disk(self):
+        # Caller holds self.lock (or is the constructor)
+        while self.disk_bytes > self.disk_limit and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except OSError:
+                pass
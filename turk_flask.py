@@ -1,244 +1,461 @@
 VERSION = '0.8.0'
-# TODO: Compress conversation history near context limit ( and disable basic model if token total is close to its max)
 
-from flask import Flask, request, jsonify, send_from_directory, redirect
+from flask import Flask, Response, request, jsonify, send_from_directory, redirect, g
 from flask_cors import CORS  # Import CORS
-import json, requests, string, random
-import shutil, glob, time
-import sys, os, re
+import json, string, random
+import glob, threading, time, atexit
+import sys, os
 from werkzeug.utils import secure_filename
 
 sys.path.append(os.path.expanduser('~'))
-from my_env import API_KEY_ELEVENLABS
-from elevenlabs import generate, set_api_key, save
 
-from turk_lib import print_log, convert_complete_number_string
-from api_llm import MODELS, SYSTEM_PROMPT, request_response_openai
-from local_tts import text_to_mp3
+from turk_lib import print_log, SpeechNormalizer, SentenceChunker
+from api_llm import MODELS, SYSTEM_PROMPT, request_response, warm_model_connection
+import api_ollama
+from api_router import router, RoutedStream
+import api_clients
+import local_tts, local_sr
+from local_tts import text_to_audio_bytes
 from local_sr import fast_transcribe
 from api_sr import api_transcribe
+import api_tts
+from api_tts import get_voice_list, find_voice, elevenlabs_to_audio_bytes
+from turk_jobs import JobQueue, TurnCancelled, sse_stream
+from turk_session import SessionStore, Session, SESSION_COOKIE
+from turk_cache import AudioCache
+from turk_warmup import Warmup
+from turk_tokens import prompt_budget, build_prompt, prompt_tokens, compression_split, summary_request
+from turk_recall import RecallIndex
+from turk_archive import ArchiveStore
+import turk_audio, turk_trace, turk_sidecar
+from turk_log import engine_log, LOG_SERVED
+from turk_audio import decode_audio_bytes, encode_wav, encode_audio, prepare_for_recognition, negotiate_audio_format, PendingAudio
 
 LIBDIR = 'lib/'
 
 # TTS setup
-ELEVENLABS_API_URL = "https://api.elevenlabs.io/v1/voices"
-ELEVENLABS_HEADERS = {"xi-api-key": API_KEY_ELEVENLABS}
-ELEVENLABS_VOICE_LIST = json.loads(requests.request("GET", ELEVENLABS_API_URL, headers=ELEVENLABS_HEADERS).text)['voices']
-chosen_voice = None
-set_api_key(API_KEY_ELEVENLABS)
 DEFAULT_VOICE_NAME = '<LOCAL>'
-SELECTED_VOICE_NAME = DEFAULT_VOICE_NAME
 TTS_COST = 0.00025 # Per character
 
-# Whisper transcription setup
-LOCAL_SR = False
+# Synthesised speech is cached by (engine, voice, text) so repeated phrases aren't re-synthesised or re-billed
+tts_cache = AudioCache()
 
-MESSAGE_LOG_FILENAME = 'messages.json'
-ENGINE_LOG_FILENAME = os.path.splitext(os.path.basename(os.sys.argv[0]))[0] + '.log'
+# Stream completions and voice them a sentence at a time so playback can start before the reply is complete
+STREAM_TTS = True
+LONG_POLL_TIMEOUT = 25 # seconds
+SESSION_WAIT_POLL = 0.1 # seconds between cancellation checks while a turn waits for the session's previous one
 
-PLAYED_AUDIO_ARCHIVE = 'audio_out/'
-if not os.path.exists(PLAYED_AUDIO_ARCHIVE):  os.makedirs(PLAYED_AUDIO_ARCHIVE)
-RECORDED_AUDIO_ARCHIVE = 'audio_in/'
-if not os.path.exists(RECORDED_AUDIO_ARCHIVE):  os.makedirs(RECORDED_AUDIO_ARCHIVE)
+MESSAGE_LOG_SUFFIX = 'messages.json'
+
+PLAYED_AUDIO_ARCHIVE = 'audio_out/' # Where played speech was kept before the archive store (still served for replays)
+ARCHIVE_RECORDED_AUDIO = True # Uploads are kept in the archive store alongside the speech played back
 LOG_ARCHIVE = 'archive/'
 if not os.path.exists(LOG_ARCHIVE):  os.makedirs(LOG_ARCHIVE)
-SANDBOX_DIR = 'sandbox/'
-if not os.path.exists(SANDBOX_DIR):  os.makedirs(SANDBOX_DIR)
+SANDBOX_DIR = 'sandbox/' # Where code blocks were kept before the archive store (still indexed for recall)
 
-messages=[]
-response = ''
-model_index = 0
+# With TURK_MODEL_SERVER set, the local SR and TTS models live in a shared model server (turk_sidecar.py),
+# not in this process, so several web workers don't each load a copy
+model_server = turk_sidecar.SidecarClient(turk_sidecar.SIDECAR_SOCKET) if turk_sidecar.SIDECAR_SOCKET else None
 
+# Local TTS workers for long replies are forked first, while this is still the only thread
+if model_server is None: local_tts.start_pool()
 
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+# Models and the voice list load in the background; the UI is served straight away
+warmup = Warmup()
+if model_server:
+    warmup.register('local_tts', lambda: model_server.wait_for('local_tts'))
+    warmup.register('local_sr', lambda: model_server.wait_for('local_sr'))
+else:
+    warmup.register('local_tts', local_tts.get_tts)
+    if local_tts.pool: warmup.register('local_tts_pool', local_tts.wait_for_pool)
+    warmup.register('local_sr', local_sr.get_model)
+warmup.register('voice_list', api_tts.refresh_voice_list_if_stale)
+warmup.start()
 
-def extract_codeblocks(text):
-    strings = []
-    replaced_text = text
-
-    index = 0
-    while True:
-        start_index = replaced_text.find('```', index)
-        if start_index == -1:
-            break
-        end_index = replaced_text.find('```', start_index + 3)
-        if end_index == -1:
-            break
-        extracted_string = replaced_text[start_index + 3:end_index]
-        strings.append(extracted_string)
-        
-        replacement_string = f"\n(See code-block number {(len(strings)):02d})\n"
-        codeblock_filename = f"cb_{int(time.time()//60)}_{(len(strings)):02d}.txt"
-        with open(os.path.join(SANDBOX_DIR,f"{codeblock_filename}"), 'w') as snippet:
-            snippet.write(extracted_string)
-        
-        replaced_text = replaced_text[:start_index] + replacement_string + replaced_text[end_index + 3:]
-        index = start_index + len(replacement_string)
-
-    return strings, replaced_text
-
-def message_filter(msg: str = ''):
-    r = msg.replace('an AI language model, ','a droid ')
-    codeblocks, cleaned_text = extract_codeblocks(r)
-    if len(codeblocks)>0:
-        r = cleaned_text + f"\n\nYou'll find the {len(codeblocks) if len(codeblocks) > 1 else ''} code block{'s' if len(codeblocks) > 1 else ''} that I've generated in the sandbox."
-    r = r.replace('=',' equals ')
-    r = re.sub(r'\(?https?:\/\/[^\s)]*\)?', '', r) # Remove URLs and surrounding parentheses
-    return r
-
-def read_message_log(filename):
-    try:
-        with open(filename, 'r') as json_file:
-            print_log('Message history loaded.')
-            return json.load(json_file)
-    except:
-        print_log('No message history; system prompt has been re-initialised.')
-        return [{"role": "system", "content": SYSTEM_PROMPT}]
-        
-def write_message_log(filename):
-    with open(filename, 'w') as json_file:
-        json.dump(messages, json_file, indent=4)
-
-def response_to_mp3(response_text: str, filename: str):
-    # Generate TTS conversion of AI response
+# Recorded speech, played speech and code blocks are packed by turn into the archive store (turk_archive.py)
+archive_store = ArchiveStore()
+archive_store.start()
 
-    # Apply number, grammar, syntax etc. filters for improved TTS
-    voiced_response_text = convert_complete_number_string(message_filter(response_text))
+# Archived conversations and code blocks are indexed in the background, for recall into later prompts
+recall_index = RecallIndex(LOG_ARCHIVE, SANDBOX_DIR, store = archive_store)
+recall_index.start()
 
-    if '<LOCAL>' in SELECTED_VOICE_NAME:
-        # Use local TTS
-        text_to_mp3(voiced_response_text, filename.split('.')[0])
-    else:
-        # Use ElevenLabs API TTS
-        for voice in ELEVENLABS_VOICE_LIST:
-            if SELECTED_VOICE_NAME.upper() in voice['name'].upper(): chosen_voice = voice
-            
-        if not chosen_voice: chosen_voice = random.choice(ELEVENLABS_VOICE_LIST)
+# Conversation history and settings are per browser session
+sessions = SessionStore(SYSTEM_PROMPT, DEFAULT_VOICE_NAME, legacy_archive_dir = LOG_ARCHIVE)
+atexit.register(sessions.spill_all)
+
+# Turns are processed off the request thread; clients follow each job's stage transitions
+turn_jobs = JobQueue()
+# Synthesised clips are served from memory and archived once played
+pending_audio = PendingAudio(archive_store)
 
-        tts_audio = generate(
-            text = voiced_response_text,
-            voice = chosen_voice['name'],
-            model = "eleven_turbo_v2"
-            )
-            
-        save(tts_audio, filename.split('.')[0] + '.mp3')
 
-    return voiced_response_text
+app = Flask(__name__)
+CORS(app)  # Enable CORS for all routes
 
-def process_user_speech(filename):
-    global transcript, messages, model_index
+def save_codeblock(number: int, code: str, label: str, session_id: str):
+    # Code blocks from replies are archived with their turn (in the background), named for recall by their session
+    archive_store.put('code', f"{label}_cb_{number:02d}.txt", code.encode(), owner = session_id)
+
+def sandbox_note(codeblock_count: int) -> str:
+    return f"You'll find the {codeblock_count if codeblock_count > 1 else ''} code block{'s' if codeblock_count > 1 else ''} that I've generated with this turn in the archive."
+
+def voiced_text(text: str, label: str, session_id: str) -> str:
+    # Reply text as it should be spoken: code blocks, URLs, numbers etc. normalised in a single pass
+    normalizer = SpeechNormalizer(on_codeblock = lambda number, code: save_codeblock(number, code, label, session_id))
+    with turk_trace.span('normalize'):
+        voiced = normalizer.normalize(text)
+    if normalizer.codeblocks: voiced += f"\n\n{SpeechNormalizer().normalize(sandbox_note(len(normalizer.codeblocks)))}"
+    return voiced
+
+def current_session() -> Session:
+    # The requesting browser's session, identified by cookie (a new one is issued by set_session_cookie)
+    if 'session' not in g:
+        g.session = sessions.get(request.cookies.get(SESSION_COOKIE))
+    return g.session
+
+def synthesise_audio(voiced_text: str, voice_name: str = DEFAULT_VOICE_NAME, audio_accept: str = None):
+    # Audio bytes and their format for already-filtered text with the selected TTS engine, in whichever format the
+    # engine can produce that the client accepts; served from the TTS cache where possible
+    chosen_voice = None
+    if '<LOCAL>' not in voice_name:
+        chosen_voice = find_voice(voice_name)
+        if not chosen_voice and get_voice_list(): chosen_voice = random.choice(get_voice_list())
+
+    if chosen_voice:
+        # Use ElevenLabs API TTS
+        audio_format = negotiate_audio_format(audio_accept, api_tts.AUDIO_FORMATS)
+        cache_key = tts_cache.key(f"elevenlabs:{api_tts.ELEVENLABS_MODEL}", chosen_voice['voice_id'], voiced_text, audio_format)
+        return tts_cache.get_or_create(cache_key, lambda: elevenlabs_to_audio_bytes(voiced_text, chosen_voice, audio_format)), audio_format
+
+    # Use local TTS (also the fallback while the ElevenLabs voice list is unavailable)
+    audio_format = negotiate_audio_format(audio_accept, local_tts.AUDIO_FORMATS)
+    cache_key = tts_cache.key(f"balacoon:{local_tts.MODEL}", str(local_tts.SPEAKER_INDEX), voiced_text, audio_format)
+    return tts_cache.get_or_create(cache_key, lambda: local_audio_bytes(voiced_text, audio_format)), audio_format
+
+def local_audio_bytes(voiced_text: str, audio_format: str) -> bytes:
+    if model_server is None: return text_to_audio_bytes(voiced_text, audio_format)
+    # Encoded here, straight from the model server's shared buffer
+    return model_server.synthesize(voiced_text, lambda samples, sample_rate: encode_audio(samples, sample_rate, audio_format))
+
+def local_transcribe(samples):
+    return model_server.transcribe(samples) if model_server else fast_transcribe(samples)
+
+def voice_to_clip(voiced_text: str, label: str, voice_name: str = DEFAULT_VOICE_NAME, audio_accept: str = None):
+    # Synthesise already-filtered text and hold it for the client as <label>.<format>; returns that file name
+    if not voiced_text.strip(): return None
+    audio, audio_format = synthesise_audio(voiced_text, voice_name, audio_accept)
+    clip_name = f"{label}.{audio_format}"
+    pending_audio.put(clip_name, audio)
+    return clip_name
+
+def response_to_audio(session: Session, response_text: str, label: str):
+    # Generate TTS conversion of AI response
 
+    # Apply number, grammar, syntax etc. filters for improved TTS
+    voiced_response_text = voiced_text(response_text, label, session.session_id)
+    return voiced_response_text, voice_to_clip(voiced_response_text, label, session.voice_name, session.audio_accept)
+
+def traced_deltas(response_stream: RoutedStream):
+    # The stream's deltas, timing first token and total time spent waiting on the model (not the TTS work in between)
+    waiting = turk_trace.Stopwatch('llm')
+    deltas = iter(response_stream)
+    first_token = True
+    try:
+        while True:
+            with waiting:
+                delta = next(deltas, None)
+            if delta is None: return
+            if first_token:
+                turk_trace.current().add('llm_first_token', waiting.started, waiting.elapsed, model = response_stream.model['label'])
+                first_token = False
+            yield delta
+    finally:
+        waiting.record(model = response_stream.model['label'] if response_stream.model else None)
+
+def stream_response_to_audio(session: Session, response_stream: RoutedStream, label: str, job):
+    # Voice the reply a sentence at a time as completion deltas arrive: <label>_01.wav, <label>_02.wav, ...
+    # Deltas are normalised for speech as they stream in, then cut into sentences
+    normalizer = SpeechNormalizer(on_codeblock = lambda number, code: save_codeblock(number, code, label, session.session_id))
+    chunker = SentenceChunker()
+    normalizing = turk_trace.Stopwatch('normalize')
+    segment_count, voiced_characters = 0, 0
+
+    def voice_segment(voiced_text: str):
+        nonlocal segment_count, voiced_characters
+        if not voiced_text.strip(): return
+        job.raise_if_cancelled() # Nothing more is synthesised for a turn the user has moved on from
+        segment_count += 1
+        segment_name = f"{label}_{segment_count:02d}"
+        clip_name = voice_to_clip(voiced_text, segment_name, session.voice_name, session.audio_accept)
+        voiced_characters += len(voiced_text)
+        job.publish('audio', file = clip_name)
+
+    job.on_cancel(response_stream.cancel)
+    try:
+        for delta in traced_deltas(response_stream):
+            with normalizing:
+                sentences = chunker.feed(normalizer.feed(delta))
+            for sentence in sentences:
+                voice_segment(sentence)
+        with normalizing:
+            sentences = chunker.feed(normalizer.flush()) + chunker.flush()
+        normalizing.record()
+        for sentence in sentences:
+            voice_segment(sentence)
+        if normalizer.codeblocks:
+            voice_segment(SpeechNormalizer().normalize(sandbox_note(len(normalizer.codeblocks))))
+        job.raise_if_cancelled()
+
+        session.add_message({'role': 'assistant', 'content': response_stream.text})
+        job.publish('responded', text = response_stream.text)
+        log_response_costs(response_stream.model, response_stream.prompt_tokens, response_stream.response_tokens, response_stream.total_tokens, estimated = response_stream.estimated_usage)
+        log_tts_costs(response_stream.model, session.voice_name, voiced_characters, response_stream.response_tokens)
+
+    except TurnCancelled:
+        raise
+    except Exception as e:
+        print_log(f"Streamed response failed after {segment_count} segment(s): {e}", stage = 'llm', segments = segment_count)
+        raise
+
+def log_response_costs(model: dict, prompt_tokens: int, response_tokens: int, total_tokens: int, estimated: bool = False):
+    prompt_cost, response_cost = prompt_tokens * model['prompt_token_cost'], response_tokens * model['response_token_cost']
+    cost = prompt_cost + response_cost
+    response_cost = f"Response cost: ${(prompt_cost):.4f} +  ${(response_cost):.4f} = ${(prompt_cost + response_cost):.4f}{' (est.)' if estimated else ''}"
+
+    token_level = f"Token level: {total_tokens} / {model['token_limit']:,}  ({( total_tokens / model['token_limit'] * 100):.2f}%)"
+    print_log(f"{token_level}  |  {response_cost}", stage = 'llm', model = model['label'], prompt_tokens = prompt_tokens, response_tokens = response_tokens, cost = round(cost, 6), estimated = estimated)
+    if model['request_fee'] > 0:
+        print_log(f"{model['label']} request fee: ${model['request_fee']:.4f}")
+
+def log_tts_costs(model: dict, voice_name: str, response_characters: int, response_tokens: int):
+    response_cost_report = '0.0000' if voice_name == '<LOCAL>' else f"{(response_characters * TTS_COST):.4f}  "
+    voice_description = ' local voice' if voice_name == '<LOCAL>' else f" voice '{voice_name}'"
+    print_log(f"{model['label']} responded with {response_characters:,} characters (from {response_tokens} tokens) using{voice_description}. | TTS cost: ${response_cost_report}  ", stage = 'tts', voice = voice_name, characters = response_characters)
+
+def process_user_speech(session: Session, filename, audio_bytes: bytes, job):
+    # Waits for the session's previous turn, but gives up (freeing the worker) as soon as this one is cancelled
+    while not session.lock.acquire(timeout = SESSION_WAIT_POLL): job.raise_if_cancelled()
+    try:
+        # Every stage of the turn is timed under the job id (the wait for a worker and the session is 'queued')
+        with turk_trace.turn(job.job_id, job.created) as trace:
+            try:
+                process_session_speech(session, filename, audio_bytes, job)
+            except TurnCancelled:
+                trace.outcome = 'cancelled'
+        job.raise_if_cancelled()
+        if not job.is_finished: job.publish('done')
+    finally:
+        session.lock.release()
+    # Summarising happens in the background once the reply has been delivered, so it never delays a turn
+    session.begin_turn() # Not spilled from under the summariser
+    threading.Thread(target = compress_history, args = (session, MODELS[session.model_index]), name = 'summarise', daemon = True).start()
+
+def session_prompt(session: Session, model: dict, recalled: str = '') -> list:
+    # The messages actually sent: system prompt, summary of older turns, anything recalled from archived conversations
+    # and the recent turns that fit the budget
+    return build_prompt(session.messages, session.summary, session.summarised_count, prompt_budget(model), recalled)
+
+def compress_history(session: Session, model: dict):
+    # Roll older turns into the session's summary once the history nears the model's prompt budget. The session is
+    # locked only to read the history and to store the summary, never for the summarising request itself; a summary
+    # is dropped if the history was summarised or reset meanwhile. Ends the turn count begun for it.
+    try:
+        with session.lock:
+            split = compression_split(session.messages, session.summarised_count, session.summary, prompt_budget(model))
+            if split is None or session.summarising: return
+            session.summarising = True
+            to_summarise = session.messages[max(1, session.summarised_count):split]
+            previous_summary, summary_seq, first_seq = session.summary, session.summary_seq, session.journal.first_seq
+        try:
+            summary, _, _, _ = request_response(model, summary_request(previous_summary, to_summarise))
+        except Exception as e:
+            print_log(f"History compression failed: {e}", stage = 'summary')
+            return
+        finally:
+            session.summarising = False
+        with session.lock:
+            if (session.summary_seq, session.journal.first_seq) != (summary_seq, first_seq):
+                print_log("History changed while it was being summarised; summary discarded.", stage = 'summary')
+                return
+            session.set_summary(summary.strip(), split)
+    finally:
+        session.end_turn()
+    print_log(f"Compressed {len(to_summarise)} older messages into a summary; prompt is now {prompt_tokens(session_prompt(session, model)):,} / {prompt_budget(model):,} tokens.", stage = 'summary', summarised = len(to_summarise))
+
+def process_session_speech(session: Session, filename, audio_bytes: bytes, job):
     def empty_string(s):
         stripped = s.replace(chr(46),'').strip()
         return ( s == stripped.translate( (str.maketrans('', '', string.punctuation))) )
 
+    # Archive recorded user speech (in the background)
+    if ARCHIVE_RECORDED_AUDIO: archive_store.put('audio_in', filename, audio_bytes)
+    job.raise_if_cancelled() # Cancelled while waiting for a worker or for the session's previous turn
+
+    # Decode straight to 16 kHz samples; nothing touches the disk on the way to the recogniser
+    # Leading/trailing silence is trimmed first, and clips that are all noise never reach a model
+    with turk_trace.span('decode', format = os.path.splitext(filename)[1][1:].lower()):
+        samples = prepare_for_recognition(decode_audio_bytes(audio_bytes))
+
     # Obtain transcript of user speech
-    if LOCAL_SR:
-        transcript_text, no_speech_prob = fast_transcribe(filename)
+    if samples is None:
+        transcript_text, no_speech_prob = '', 1
+    elif session.local_sr:
+        with turk_trace.span('sr', engine = 'faster-whisper'):
+            transcript_text, no_speech_prob = local_transcribe(samples)
     else:
-        transcript_text, no_speech_prob = api_transcribe(filename)
+        with turk_trace.span('sr', engine = 'whisper-api'):
+            transcript_text, no_speech_prob = api_transcribe(encode_wav(samples), filename = filename.split('.')[0] + '.wav')
 
-    # Archive recorded user speech
-    shutil.move(filename, RECORDED_AUDIO_ARCHIVE + filename) 
-   
     # Obtain response to tanscribed user speech
-    if not empty_string(transcript_text):
-        print_log(f"Heard: {transcript_text}{'' if LOCAL_SR else ' (API SR)'}")
-        messages.append({'role': 'user', 'content': transcript_text})
-
-        model_label = MODELS[model_index]['label']
-        model_name = MODELS[model_index]['model_name']
-        model_endpoint = MODELS[model_index]['endpoint']
+    label = filename.split('.')[0]
+    job.raise_if_cancelled()
+    job.publish('transcribed', text = transcript_text)
 
-        response_text, prompt_tokens, response_tokens, total_tokens = request_response_openai(model_name = model_name, messages=messages, endpoint = model_endpoint)
-
-        messages.append({'role': 'assistant', 'content': response_text})
-
-        prompt_cost, response_cost = prompt_tokens * MODELS[model_index]['prompt_token_cost'], response_tokens * MODELS[model_index]['response_token_cost']
-        response_cost = f"Response cost: ${(prompt_cost):.4f} +  ${(response_cost):.4f} = ${(prompt_cost + response_cost):.4f}"
-
-        token_level = f"Token level: {total_tokens} / {MODELS[model_index]['token_limit']:,}  ({( total_tokens / MODELS[model_index]['token_limit'] * 100):.2f}%)"
-        print_log(f"{token_level}  |  {response_cost}")
-        if MODELS[model_index]['request_fee'] > 0:
-            print_log(f"{MODELS[model_index]['label']} request fee: ${MODELS[model_index]['request_fee']:.4f}")
-
-        # Update conversation record
-        write_message_log(MESSAGE_LOG_FILENAME)
+    if not empty_string(transcript_text):
+        print_log(f"Heard: {transcript_text}{'' if session.local_sr else ' (API SR)'}", stage = 'sr', local_sr = session.local_sr)
+        session.add_message({'role': 'user', 'content': transcript_text})
+
+        # Past conversations relevant to what was just said are recalled into the prompt (within a fixed token budget)
+        with turk_trace.span('recall'):
+            recalled = recall_index.context(transcript_text, session.session_id)
+
+        # The router starts with the session's model, hedging or falling back to others if it's slow or failing
+        prompt_for = lambda model: session_prompt(session, model, recalled)
+
+        if STREAM_TTS:
+            # Voice the reply a sentence at a time; each segment is announced as soon as it exists
+            response_stream = router.stream(session.model_index, prompt_for)
+            stream_response_to_audio(session, response_stream, label, job)
+            return
+
+        llm_started = time.perf_counter()
+        response_stream = router.stream(session.model_index, prompt_for)
+        job.on_cancel(response_stream.cancel)
+        response_text = ''.join(response_stream)
+        job.raise_if_cancelled()
+        prompt_token_count, response_tokens, total_tokens, model = response_stream.prompt_tokens, response_stream.response_tokens, response_stream.total_tokens, response_stream.model
+        turk_trace.current().add('llm', llm_started, time.perf_counter() - llm_started, model = model['label'])
+
+        session.add_message({'role': 'assistant', 'content': response_text})
+        job.publish('responded', text = response_text)
+        log_response_costs(model, prompt_token_count, response_tokens, total_tokens)
 
         # Generate TTS conversion of AI response
-        voiced_response_text = response_to_mp3(response_text, filename)
-
-        response_characters = len(voiced_response_text)
-        response_cost_report = '0.0000' if SELECTED_VOICE_NAME == '<LOCAL>' else f"{(response_characters * TTS_COST):.4f}  "
-        voice_description = ' local voice' if SELECTED_VOICE_NAME == '<LOCAL>' else f" voice '{SELECTED_VOICE_NAME}'"
-        print_log(f"{MODELS[model_index]['label']} responded with {response_characters:,} characters (from {response_tokens} tokens) using{voice_description}. | TTS cost: ${response_cost_report}  ")
-
-        #TODO: If token total is approaching max context length, send message log to OpenAI API for summarisation/compression
+        voiced_response_text, clip_name = response_to_audio(session, response_text, label)
+        log_tts_costs(model, session.voice_name, len(voiced_response_text), response_tokens)
+        if clip_name: job.publish('audio', file = clip_name)
     else:
-        text_to_mp3(f"I'm sorry, I didn't quite catch that.", filename.split('.')[0])
+        clip_name = voice_to_clip(f"I'm sorry, I didn't quite catch that.", label, DEFAULT_VOICE_NAME, session.audio_accept)
+        job.publish('audio', file = clip_name)
+
+@app.after_request
+def set_session_cookie(response):
+    if 'session' in g and request.cookies.get(SESSION_COOKIE) != g.session.session_id:
+        response.set_cookie(SESSION_COOKIE, g.session.session_id, max_age=60 * 60 * 24 * 365, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def index():
+    current_session()
     return send_from_directory(LIBDIR, 'index.html')
 
 @app.route('/lite')
 def lite_index():
+    current_session()
     return send_from_directory(LIBDIR, 'lite.html')
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global SELECTED_VOICE_NAME, model_index, LOCAL_SR
-    print_log('Audio submission received.')
+    print_log('Audio submission received.', stage = 'upload')
     if 'audio' in request.files:
+        session = current_session()
 
         audio = request.files['audio']
         original_filename = audio.filename
 
-        base_name, ext = os.path.splitext(original_filename)
-        truncated_name = base_name[:10]  # Keep only the first 10 characters of the filename prefix
+        ext = os.path.splitext(original_filename)[1].lower()
+        if ext not in turk_audio.UPLOAD_EXTENSIONS: return jsonify({'message': f"Unsupported audio format: {ext}"}), 415
 
-        safe_filename = f"{truncated_name}{ext}"
-        
-        audio.save(safe_filename)
+        # The turn gets a random id (its job id, and the name of its audio); the session records that it owns it
+        safe_filename = session.new_turn_id() + ext
+        audio_bytes = audio.read()
+        turk_audio.preprocess_stats.record_upload(ext, len(audio_bytes))
 
         sr_host = request.form.get('sr_host')
-        LOCAL_SR = True if sr_host == 'on' else False
+        session.local_sr = True if sr_host == 'on' else False
 
         desired_model = request.form.get('model_ID')
-        model_index = int(desired_model)
-
-        # print(f"DESIRED MODEL: {desired_model} ({MODELS[model_index]['label']})")
+        if desired_model and 0 <= int(desired_model) < len(MODELS): session.model_index = int(desired_model)
 
         desired_voice_name = request.form.get('voice_name')
         if desired_voice_name:
             if '<LOCAL>' in desired_voice_name:
-                SELECTED_VOICE_NAME = desired_voice_name
+                session.voice_name = desired_voice_name
             else:                
-                for voice in ELEVENLABS_VOICE_LIST:
-                    if desired_voice_name.upper() in voice['name'].upper(): 
-                        SELECTED_VOICE_NAME = voice['name']
+                voice = find_voice(desired_voice_name)
+                if voice: session.voice_name = voice['name']
       
-        else: SELECTED_VOICE_NAME = DEFAULT_VOICE_NAME    
+        else: session.voice_name = DEFAULT_VOICE_NAME    
 
-        process_user_speech(safe_filename)
+        session.save() # Settings, and the new turn's ownership (so its archive stays reachable after a restart)
 
-        return jsonify({'message': f'Successfully saved {safe_filename}'}), 200
-    else:
-        return jsonify({'message': 'No audio file part'}), 400
+        # Audio types the browser can play (e.g. "audio/wav, audio/ogg; codecs=opus, audio/mpeg"); replies are voiced in one of them
+        session.audio_accept = request.form.get('audio_accept') or turk_audio.DEFAULT_AUDIO_ACCEPT
 
-# Route to accept any filename with .mp3 extension
-@app.route('/<filename>.mp3')
-def response_file(filename):
-    try:
-        secure_filename_str = secure_filename(f"{filename}.mp3")
+        # Speaking again supersedes whatever this session's previous turn was still doing (barge-in)
+        superseded = session.cancel_jobs('superseded')
+        for job_id in superseded: print_log("Cancelled: superseded by a new utterance.", turn = job_id)
 
-        shutil.move(secure_filename_str, PLAYED_AUDIO_ARCHIVE + secure_filename_str)
-        return send_from_directory(PLAYED_AUDIO_ARCHIVE, secure_filename_str)
+        session.begin_turn()
+        job = turn_jobs.submit(os.path.splitext(safe_filename)[0], process_user_speech, session, safe_filename, audio_bytes, cleanup = session.end_turn)
+        session.track_job(job)
 
-    except FileNotFoundError:
-        # Log an error message or return a custom 404 error
-        return "File not found", 404
+        return jsonify({'message': f'Successfully received {safe_filename}', 'job_id': job.job_id}), 202
+    else:
+        return jsonify({'message': 'No audio file part'}), 400
+
+# Synthesised speech, in whichever format it was negotiated in
+@app.route('/<filename>.mp3', defaults={'audio_format': 'mp3'})
+@app.route('/<filename>.wav', defaults={'audio_format': 'wav'})
+@app.route('/<filename>.opus', defaults={'audio_format': 'opus'})
+def response_file(filename, audio_format):
+    secure_filename_str = secure_filename(f"{filename}.{audio_format}")
+    if not current_session().owns(secure_filename_str): return "File not found", 404
+
+    # Straight from memory the first time; replays come from the archive store (or, for older clips, the old archive)
+    audio = pending_audio.take(secure_filename_str)
+    if audio is None:
+        entry = archive_store.find('audio_out', secure_filename_str)
+        audio = archive_store.read(entry) if entry else None
+    if audio is None: return send_from_directory(PLAYED_AUDIO_ARCHIVE, secure_filename_str, mimetype=turk_audio.AUDIO_MIMETYPES[audio_format])
+    return Response(audio, content_type=turk_audio.AUDIO_MIMETYPES[audio_format])
+
+@app.route('/cancel', methods=['POST'])
+def cancel_turn():
+    # Stops this session's turn `job_id` (or all its unfinished turns): provider requests are abandoned and no more
+    # audio is synthesised. Sent by the page when the user interrupts, stops listening or leaves.
+    job_id = request.form.get('job_id') or None
+    if job_id and not current_session().owns(job_id): return jsonify({'message': 'Unknown job'}), 404
+    cancelled = current_session().cancel_jobs('cancelled by client', job_id)
+    for job_id in cancelled: print_log("Cancelled at the client's request.", turn = job_id)
+    return jsonify({'cancelled': cancelled})
+
+@app.route('/events/<job_id>')
+def job_events(job_id):
+    # Server-Sent Events: queued, transcribed, audio (per voiced segment), responded, done/failed
+    job = turn_jobs.get(job_id)
+    if job is None or not current_session().owns(job_id): return jsonify({'message': 'Unknown job'}), 404
+    resume_from = request.headers.get('Last-Event-ID', -1, type=int) + 1 # A malformed id resumes from the start
+    return Response(sse_stream(job, resume_from), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>')
+def job_poll(job_id):
+    # Long-poll alternative to /events: blocks until there are events after `since` (or the timeout passes)
+    job = turn_jobs.get(job_id)
+    if job is None or not current_session().owns(job_id): return jsonify({'message': 'Unknown job'}), 404
+    since = request.args.get('since', 0, type=int)
+    return jsonify({'events': job.events_since(since, timeout=LONG_POLL_TIMEOUT), 'finished': job.is_finished})
 
 @app.route('/<filename>.js')
 def serve_js(filename):
@@ -269,6 +486,7 @@ def message_log_file(filename):
 
 @app.route('/<filename>.log')
 def engine_log_file(filename):
+    if not LOG_SERVED: return "File not found", 404 # Every session's turns are in it
     try:
         secure_filename_str = secure_filename(f"{filename}.log")
         return send_from_directory('.', secure_filename_str)
@@ -276,26 +494,137 @@ def engine_log_file(filename):
         # Log an error message or return a custom 404 error
         return "File not found", 404
 
+@app.route('/messages')
+def message_log():
+    # This session's conversation from sequence number `since` on; `reset` tells the client to discard what it has
+    messages, stale = current_session().journal.since(request.args.get('since', 0, type=int))
+    return jsonify({'messages': messages, 'next_seq': current_session().journal.next_seq, 'reset': stale})
+
 @app.route('/reset')
 def reset():
-    global messages
+    # Archive this session's conversation and start afresh; the engine log is shared, so it stays put
+    session = current_session()
     archiveTime = int(time.time())
-    try:
-        shutil.move(MESSAGE_LOG_FILENAME, LOG_ARCHIVE + f"{archiveTime}_{MESSAGE_LOG_FILENAME}")
-        shutil.move(ENGINE_LOG_FILENAME, LOG_ARCHIVE + f"{archiveTime}_{ENGINE_LOG_FILENAME}")
-        messages=[{"role": "system", "content": SYSTEM_PROMPT}]
-        return redirect('/')
-    except:
-        return redirect('/?note=empty_logs')
+    with session.lock:
+        if len(session.messages) <= 1: return redirect('/?note=empty_logs')
+        with open(LOG_ARCHIVE + f"{archiveTime}_{session.session_id}_{MESSAGE_LOG_SUFFIX}", 'w') as json_file:
+            json.dump(session.messages, json_file, indent=4)
+        session.reset_messages()
+    recall_index.notify()
+    return redirect('/')
 
 @app.route('/voices')
 def voice_list():
-    return ['<LOCAL>'] + [d['name'] for d in ELEVENLABS_VOICE_LIST]
+    return ['<LOCAL>'] + [d['name'] for d in get_voice_list()]
 
 @app.route('/models')
 def model_list():
     return [d['label'] for d in MODELS]
 
+@app.route('/models/select', methods=['GET', 'POST'])
+def select_model():
+    # POSTed when the model dropdown changes: remember the choice and warm a connection to its provider.
+    # GET (on page load) reports the session's current choice and warms it, without changing anything.
+    session = current_session()
+    if request.method == 'GET':
+        warm_model_connection(MODELS[session.model_index])
+        return jsonify({'model_ID': session.model_index, 'model': MODELS[session.model_index]['label']})
+    desired_model = request.form.get('model_ID', type=int)
+    if desired_model is None or not 0 <= desired_model < len(MODELS): return jsonify({'message': 'Unknown model'}), 400
+    if session.model_index != desired_model:
+        session.model_index = desired_model
+        session.save()
+    warm_model_connection(MODELS[desired_model])
+    return jsonify({'model': MODELS[desired_model]['label']})
+
+@app.route('/log/tail')
+def log_tail():
+    # The newest `n` engine log records (after sequence number `since`), served from memory however long the file is;
+    # a session sees its own turns' records and those that belong to no turn
+    n = min(request.args.get('n', 20, type=int), 1000)
+    session = current_session()
+    visible = lambda turn: turn is None or session.owns(turn)
+    return jsonify({'entries': engine_log.tail(n, request.args.get('since', 0, type=int), visible), 'next_seq': engine_log.seq + 1})
+
+@app.route('/log/stats')
+def log_stats():
+    return jsonify(engine_log.stats())
+
+@app.route('/clients/stats')
+def client_stats():
+    # Per-provider connection setup and time-to-first-byte timings
+    return jsonify(api_clients.timings.stats())
+
+@app.route('/ollama/stats')
+def ollama_stats():
+    # Local models: keep-alive setting, per-model load / prompt-eval / eval timings and what's loaded right now
+    status = api_ollama.stats.as_dict()
+    try:
+        status['loaded'] = api_ollama.loaded_models()
+    except Exception as e:
+        status['loaded'] = None
+        status['error'] = str(e)
+    return jsonify(status)
+
+@app.route('/router/stats')
+def model_router_stats():
+    # Routing policy plus per-model first-token latency, error rate and hedge outcomes
+    return jsonify(router.status())
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus histograms: per-stage durations (labelled by model / voice engine), turn time and time to first audio
+    return Response(turk_trace.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/turns/recent')
+def recent_turns():
+    # Per-stage breakdown of this session's most recent turns, newest first (timings across all sessions are at /metrics)
+    return jsonify(turk_trace.recent(request.args.get('n', turk_trace.RECENT_TURNS, type=int), current_session().owns))
+
+@app.route('/sr/stats')
+def sr_pool_stats():
+    # Local speech recognition pool: queue depth, batching and real-time factors
+    return jsonify(model_server.sr_stats() if model_server else local_sr.sr_stats())
+
+@app.route('/recall/stats')
+def recall_stats():
+    # Long-term recall index: files and snippets indexed, scan timing and searches served
+    return jsonify(recall_index.stats())
+
+@app.route('/archive/turns/<turn_id>')
+def archived_turn(turn_id):
+    # What the archive store holds for one of this session's turns (recorded speech, played speech, code blocks)
+    if not current_session().owns(turn_id): return jsonify({'error': 'Turn not found'}), 404
+    entries = archive_store.turn(turn_id)
+    if not entries: return jsonify({'error': 'Turn not found'}), 404
+    return jsonify([{key: entry[key] for key in ('kind', 'name', 'time', 'size')} for entry in entries])
+
+@app.route('/archive/turns/<turn_id>/export')
+def export_turn(turn_id):
+    # Everything archived for the turn as a zip (with a manifest.json)
+    if not current_session().owns(turn_id) or not archive_store.turn(turn_id): return jsonify({'error': 'Turn not found'}), 404
+    return Response(archive_store.export(turn_id), mimetype='application/zip', headers={'Content-Disposition': f'attachment; filename="{secure_filename(turn_id)}.zip"'})
+
+@app.route('/archive/stats')
+def archive_stats():
+    # Archive store: segments, bytes on disk against the retention limits, artifacts and turns indexed, queue drops
+    return jsonify(archive_store.stats())
+
+@app.route('/audio/stats')
+def audio_preprocess_stats():
+    # Audio trimmed ahead of recognition (seconds that SR and the Whisper API didn't have to process)
+    return jsonify(turk_audio.preprocess_stats.as_dict())
+
+@app.route('/tts_cache')
+def tts_cache_stats():
+    return jsonify(tts_cache.stats())
+
+@app.route('/ready')
+def readiness():
+    # Per-engine warm-up state and timings; 503 until everything is ready
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route('/version')
 def get_version():
     return f"v{VERSION}"
@@ -306,6 +635,5 @@ def favicon():
 
 if __name__ == '__main__':
     print_log(f"v{VERSION}: Initialising...")
-    messages = read_message_log(MESSAGE_LOG_FILENAME)
     app.run(debug=True, host='0.0.0.0', ssl_context='adhoc')
 
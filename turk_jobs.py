@@ -0,0 +1,121 @@
+import json, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from turk_lib import print_log
+import turk_trace
+
+# Turn jobs run the SR -> LLM -> TTS pipeline off the request thread and record each stage transition,
+# so clients can follow along over Server-Sent Events (or long-poll) instead of guessing when audio exists.
+
+JOB_WORKERS = 4
+JOB_RETENTION = 300 # seconds a finished job's events are kept for late or reconnecting clients
+FINAL_STAGES = ('done', 'failed', 'cancelled')
+
+class TurnCancelled(Exception):
+    pass
+
+class TurnJob:
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.events = []
+        self.created = time.time()
+        self.finished = None
+        self.condition = threading.Condition()
+        self.cancelled = threading.Event()
+        self.cancel_callbacks = []
+
+    def publish(self, stage: str, **fields):
+        with self.condition:
+            if self.finished is not None: return # e.g. a cancelled turn's worker still winding down
+            self.events.append({'seq': len(self.events), 'stage': stage, 'time': time.time(), **fields})
+            if stage in FINAL_STAGES: self.finished = time.time()
+            self.condition.notify_all()
+        turk_trace.mark(stage)
+
+    def events_since(self, seq: int = 0, timeout: float = 0) -> list:
+        # Events from `seq` onwards, waiting up to `timeout` seconds for one to arrive
+        with self.condition:
+            if len(self.events) <= seq and self.finished is None and timeout > 0:
+                self.condition.wait(timeout)
+            return self.events[seq:]
+
+    def cancel(self, reason: str = 'cancelled') -> bool:
+        # Stops the turn where it stands: clients hear 'cancelled' at once, in-flight work is abandoned through the
+        # registered callbacks, and the worker gives up at its next check. False if the turn had already finished.
+        with self.condition:
+            if self.finished is not None or self.cancelled.is_set(): return False
+            self.cancelled.set()
+            callbacks = list(self.cancel_callbacks)
+        self.publish('cancelled', reason = reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print_log(f"Cancelling failed: {e}", turn = self.job_id)
+        return True
+
+    def on_cancel(self, callback):
+        # Runs callback() if the turn is cancelled (straight away if it already has been)
+        with self.condition:
+            if not self.cancelled.is_set():
+                self.cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self):
+        if self.cancelled.is_set(): raise TurnCancelled(self.job_id)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.finished is not None
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='turn')
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, job_id: str, target, *args, cleanup=None) -> TurnJob:
+        # target(*args, job) runs on a worker; cleanup() runs afterwards however the job ends (even if it never ran)
+        job = TurnJob(job_id)
+        with self.lock:
+            self._prune()
+            self.jobs[job_id] = job
+        job.publish('queued')
+        self.executor.submit(self._run, job, target, *args, cleanup=cleanup)
+        return job
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job: TurnJob, target, *args, cleanup=None):
+        try:
+            if job.cancelled.is_set(): return # Cancelled while queued (and already reported): the worker moves straight on
+            target(*args, job)
+            if not job.is_finished: job.publish('done')
+        except TurnCancelled:
+            print_log("Turn cancelled.", turn = job.job_id)
+        except Exception as e:
+            print_log(f"Turn failed: {e}", turn = job.job_id)
+            job.publish('failed', error=str(e))
+        finally:
+            if cleanup: cleanup()
+
+    def _prune(self):
+        expired = [job_id for job_id, job in self.jobs.items() if job.is_finished and time.time() - job.finished > JOB_RETENTION]
+        for job_id in expired: del self.jobs[job_id]
+
+def sse_stream(job: TurnJob, seq: int = 0, heartbeat: float = 15):
+    # Server-Sent Events for a job: one `event: <stage>` per transition, ending after the final stage.
+    # Event ids are the job's sequence numbers, so a reconnecting EventSource resumes where it left off.
+    while True:
+        events = job.events_since(seq, timeout=heartbeat)
+        if not events:
+            if job.is_finished: return
+            yield ': keep-alive\n\n'
+            continue
+        for event in events:
+            yield f"id: {event['seq']}\nevent: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+            if event['stage'] in FINAL_STAGES: return
+        seq = events[-1]['seq'] + 1
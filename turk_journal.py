@@ -0,0 +1,105 @@
+import json, os, threading
+
+from turk_lib import print_log
+
+# Append-only conversation journal: each message is one JSON line, so a turn costs two small appends rather
+# than a rewrite of the whole history. The journal is periodically compacted into a snapshot, and recovery
+# replays snapshot + journal, discarding a torn final line left by a crash mid-write.
+
+COMPACT_EVERY = 200 # Journal records before they're folded into the snapshot
+FSYNC_APPENDS = False
+
+class MessageJournal:
+    def __init__(self, basename: str):
+        self.journal_filename = basename + '.jsonl'
+        self.snapshot_filename = basename + '.snapshot.json'
+        self.messages = []
+        self.first_seq = 0      # Sequence number of messages[0]; keeps increasing across resets
+        self.journal_records = 0
+        self.lock = threading.RLock()
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + len(self.messages)
+
+    def recover(self) -> bool:
+        # Rebuild messages from the snapshot and journal; False if there's no saved history
+        with self.lock:
+            found = False
+            try:
+                with open(self.snapshot_filename, 'r') as json_file:
+                    snapshot = json.load(json_file)
+                self.first_seq, self.messages = snapshot['first_seq'], snapshot['messages']
+                found = True
+            except (OSError, ValueError, KeyError):
+                pass
+
+            try:
+                with open(self.journal_filename, 'rb') as journal:
+                    lines = journal.readlines()
+            except OSError:
+                return found
+
+            good_bytes = 0
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print_log(f"Discarding torn journal record in {self.journal_filename}.")
+                    break
+                good_bytes += len(line)
+                self._apply(record)
+                found = True
+
+            if good_bytes < sum(len(line) for line in lines):
+                with open(self.journal_filename, 'r+b') as journal:
+                    journal.truncate(good_bytes)
+            self.journal_records = len(lines)
+            return found
+
+    def _apply(self, record: dict):
+        # Records already folded into the snapshot (a crash between snapshot and truncate) are skipped
+        if record['seq'] < self.next_seq: return
+        if record.get('op') == 'reset':
+            self.first_seq, self.messages = record['seq'], []
+        else:
+            self.messages.append({'role': record['role'], 'content': record['content']})
+
+    def append(self, message: dict):
+        with self.lock:
+            self._write({'seq': self.next_seq, 'role': message['role'], 'content': message['content']})
+            self.messages.append(message)
+            if self.journal_records >= COMPACT_EVERY: self.compact()
+
+    def reset(self, messages: list):
+        # Start a new conversation; sequence numbers carry on so clients notice the history was replaced
+        with self.lock:
+            self._write({'op': 'reset', 'seq': self.next_seq})
+            self.first_seq, self.messages = self.next_seq, []
+            for message in messages: self.append(message)
+
+    def since(self, seq: int):
+        # Messages (with their sequence numbers) from `seq` on, and whether the caller's view predates a reset
+        with self.lock:
+            stale = seq < self.first_seq
+            start = 0 if stale else seq - self.first_seq
+            return [{'seq': self.first_seq + i, **message} for i, message in enumerate(self.messages[start:], start)], stale
+
+    def _write(self, record: dict):
+        with open(self.journal_filename, 'a') as journal:
+            journal.write(json.dumps(record) + '\n')
+            if FSYNC_APPENDS:
+                journal.flush()
+                os.fsync(journal.fileno())
+        self.journal_records += 1
+
+    def compact(self):
+        with self.lock:
+            temp_filename = self.snapshot_filename + '.tmp'
+            with open(temp_filename, 'w') as json_file:
+                json.dump({'first_seq': self.first_seq, 'messages': self.messages}, json_file)
+                json_file.flush()
+                os.fsync(json_file.fileno())
+            os.replace(temp_filename, self.snapshot_filename)
+            open(self.journal_filename, 'w').close()
+            self.journal_records = 0
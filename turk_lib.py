@@ -1,14 +1,16 @@
-import sys, time, re
+import time, re
+from functools import lru_cache
 
-def print_log(log_string = '',log_to_file=True, noStdOut = True):
-    LOG_FILENAME = sys.argv[0].split('.')[0] + '.log'
+from turk_log import engine_log
 
+def print_log(log_string = '',log_to_file=True, noStdOut = True, stage = None, turn = None, **fields):
+    # The file is written in the background (turk_log.py); stage and fields are kept with the record for /log/tail, and
+    # turn (by default, the current turn's id) decides which session sees it there
     timestamp = time.strftime("%m/%d/%y  %H:%M:%S", time.localtime(time.time()))
     if not noStdOut: print(f"[ {timestamp} ] {log_string}")
 
     if(log_to_file):
-        with open(LOG_FILENAME, "a") as file:
-            file.write(f"[ {timestamp} ] {log_string}\n")   
+        engine_log.log(str(log_string), stage, turn, **fields)
 
 # Precomputed lists
 ONES = ["", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]
@@ -57,9 +59,8 @@ def convert_to_words(number) -> str:
 
     return ' '.join(parts)
 
+@lru_cache(maxsize=4096)
 def number_to_words(input_str: str) -> str:
-    # if_negative = 'minus ' if input_str.startswith('-') else ''
-
     # Handle negatives
     if input_str.startswith('-'):
         if_negative = 'minus '
@@ -67,29 +68,161 @@ def number_to_words(input_str: str) -> str:
     else:
         # Not negative; handle possible years
         if_negative = ''
-        if ',' not in input_str and '.' not in input_str and len(input_str) == 4:
+        if len(input_str) == 4 and input_str.isdigit():
             # Might be a year
             year = int(input_str)
             if year < 2000 or year > 2009:
-                return number_to_words(input_str[:2]) + ' ' + number_to_words(input_str[-2:])
+                return f"{SMALL_NUMBERS[year // 100]} {SMALL_NUMBERS[year % 100]}"
 
     parts = input_str.replace(',', '').split('.')
-    integer_part = int(parts[0])
+    integer_part = int(parts[0]) if parts[0] else 0
     words = if_negative + convert_to_words(integer_part)
 
     if len(parts) > 1:
-        decimal_digits = [ONES[int(digit)] if digit != '0' else 'zero' for digit in parts[1]]
-        words += ' point ' + ' '.join(decimal_digits)
+        words += ' point ' + ' '.join(DIGIT_WORDS[int(digit)] for digit in parts[1])
 
     return words
 
-def convert_complete_number_string(number_string: str) -> str:
-    number_regex = r'(?<!\d)-?\d+(?:,\d{3})*(?:\.\d+)?|\b-?\d*\.\d+\b'
-
-    def replace_match(match):
-        number_value = match.group(0)
-        return number_to_words(number_value)
+SMALL_NUMBERS = [convert_to_words(n) for n in range(100)]
+DIGIT_WORDS = ['zero'] + ONES[1:]
+NUMBER_PATTERN = r'(?<!\d)-?\d+(?:,\d{3})*(?:\.\d+)?|\b-?\d*\.\d+\b'
+NUMBER_REGEX = re.compile(NUMBER_PATTERN)
 
-    return re.sub(number_regex, replace_match, number_string)
+def convert_complete_number_string(number_string: str) -> str:
+    return NUMBER_REGEX.sub(lambda match: number_to_words(match.group(0)), number_string)
+
+FILTERED_PHRASE, FILTERED_PHRASE_REPLACEMENT = 'an AI language model, ', 'a droid '
+
+class SpeechNormalizer:
+    # Rewrites reply text for TTS in one left-to-right pass of a single compiled tokenizer: ``` code blocks become
+    # a spoken reference (the code goes to on_codeblock), URLs are dropped, '=' is spoken and numbers, years and
+    # decimals become words. Text can be fed as it streams in; only a possibly incomplete tail (a partial word or
+    # an unclosed code block) is held back, and nothing already emitted is scanned again.
+
+    # The leading look-ahead lets the scanner skip ordinary characters without trying each alternative
+    TOKENS = re.compile(
+        r'(?=[`(ah=\-.\d])(?:(?P<code>```.*?```)|(?P<fence>```)'
+        r'|(?P<phrase>' + re.escape(FILTERED_PHRASE) + r')'
+        r'|(?P<url>\(?https?:\/\/[^\s)]*\)?)'
+        r'|(?P<equals>=)'
+        r'|(?P<number>' + NUMBER_PATTERN + r'))', re.DOTALL)
+    PARTIAL_PHRASE = re.compile('(?:' + '|'.join(re.escape(FILTERED_PHRASE[:length]) for length in range(len(FILTERED_PHRASE) - 1, 0, -1)) + r')\Z')
+    WHITESPACE = re.compile(r'\s')
+
+    def __init__(self, first_codeblock: int = 1, on_codeblock = None):
+        self.first_codeblock = first_codeblock
+        self.on_codeblock = on_codeblock # Called with (block number, code) as each block completes
+        self.codeblocks = []
+        self.buffer = ''
+        self.pos = 0                # buffer[:pos] has been emitted (one character is kept for look-behind context)
+        self.open_fence = None      # Offset of an unclosed ``` we're waiting on
+        self.fence_search_from = 0
+
+    def feed(self, delta: str) -> str:
+        # Normalised text for as much of the input as can't change with more input
+        self.buffer += delta
+        # Until a word is completed, nothing more can be emitted
+        if not self.WHITESPACE.search(delta): return ''
+        if self.open_fence is not None:
+            if self.buffer.find('```', self.fence_search_from) == -1:
+                self.fence_search_from = max(self.open_fence + 3, len(self.buffer) - 2)
+                return ''
+            self.open_fence = None
+        return self._drain(self._safe_end(), final = False)
+
+    def flush(self) -> str:
+        # Everything that's left; an unclosed ``` is spoken as-is, as if it weren't a code block
+        text = self._drain(len(self.buffer), final = True)
+        self.buffer, self.pos, self.open_fence = '', 0, None
+        return text
+
+    def normalize(self, text: str) -> str:
+        return self.feed(text) + self.flush()
+
+    def _safe_end(self) -> int:
+        # Hold back a trailing partial word (a number, URL or ``` may continue) and any start of FILTERED_PHRASE
+        buffer, end = self.buffer, len(self.buffer)
+        while end > self.pos and not buffer[end - 1].isspace(): end -= 1
+        partial = self.PARTIAL_PHRASE.search(buffer, max(self.pos, len(buffer) - len(FILTERED_PHRASE)))
+        return min(end, partial.start()) if partial else end
+
+    def _drain(self, end: int, final: bool) -> str:
+        buffer, pos, out = self.buffer, self.pos, []
+        for match in self.TOKENS.finditer(buffer, pos, end):
+            if match.lastgroup == 'fence' and not final:
+                # Any closing ``` lies in the held-back tail, so later searches needn't revisit the block
+                self.fence_search_from = max(match.end(), end - 2)
+                end = self.open_fence = match.start()
+                break
+            out.append(buffer[pos:match.start()])
+            out.append(self._speak(match))
+            pos = match.end()
+        out.append(buffer[pos:end])
+
+        # Drop emitted text, keeping one character so look-behinds still see what preceded the held-back tail
+        trim = max(0, end - 1)
+        self.buffer, self.pos = buffer[trim:], end - trim
+        if self.open_fence is not None:
+            self.open_fence -= trim
+            self.fence_search_from -= trim
+        return ''.join(out)
+
+    def _speak(self, match) -> str:
+        kind, token = match.lastgroup, match.group(0)
+        if kind == 'number': return number_to_words(token)
+        if kind == 'equals': return ' equals '
+        if kind == 'url': return ''
+        if kind == 'phrase': return FILTERED_PHRASE_REPLACEMENT
+        if kind == 'fence': return token
+        number = self.first_codeblock + len(self.codeblocks)
+        self.codeblocks.append(token[3:-3])
+        if self.on_codeblock: self.on_codeblock(number, token[3:-3])
+        return f"\n(See code-block number {number_to_words(f'{number:02d}')})\n"
 
 # if __name__ == '__main__':
+
+class SentenceChunker:
+    # Cuts streamed completion text into speakable sentences as the deltas arrive.
+    # Sentences end at . ! ? (followed by whitespace) or at a line break, never inside a ``` code block,
+    # and very short sentences are held back and joined to the next so TTS isn't called per word.
+
+    SENTENCE_END = re.compile(r'[.!?]+["\')\]]*(?=\s)|\n+')
+    ABBREVIATIONS = {'mr', 'mrs', 'ms', 'dr', 'st', 'vs', 'etc', 'approx', 'no'}
+
+    def __init__(self, min_chars: int = 24):
+        self.min_chars = min_chars
+        self.buffer = ''
+        self.scan_from = 0
+
+    def feed(self, delta: str) -> list:
+        self.buffer += delta
+        sentences = []
+        while True:
+            end = self._next_boundary()
+            if end is None: break
+            sentence, self.buffer = self.buffer[:end], self.buffer[end:]
+            self.scan_from = 0
+            if sentence.strip(): sentences.append(sentence.strip())
+        return sentences
+
+    def flush(self) -> list:
+        remainder, self.buffer, self.scan_from = self.buffer.strip(), '', 0
+        return [remainder] if remainder else []
+
+    def _next_boundary(self):
+        # Earliest cut point at or beyond min_chars that isn't inside an open code block
+        for match in self.SENTENCE_END.finditer(self.buffer, self.scan_from):
+            end = match.end()
+            # The last character may still be followed by more of the same token (e.g. '3.' -> '3.14')
+            if end >= len(self.buffer): break
+            if self.buffer.count('```', 0, end) % 2: continue
+            if match.group(0).startswith('.') and self._is_abbreviation(match.start()): continue
+            if len(self.buffer[:end].strip()) < self.min_chars: continue
+            return end
+        # Nothing to emit yet; rescan only the tail next time (a boundary may need its following whitespace)
+        self.scan_from = max(0, len(self.buffer) - 8)
+        return None
+
+    def _is_abbreviation(self, dot_index: int) -> bool:
+        word = self.buffer[:dot_index].rsplit(None, 1)[-1].lower() if self.buffer[:dot_index].strip() else ''
+        return word in self.ABBREVIATIONS or re.fullmatch(r'(?:[a-z]\.)*[a-z]', word) is not None
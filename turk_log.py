@@ -0,0 +1,118 @@
+import atexit, json, os, queue, sys, threading, time
+from collections import deque
+
+import turk_trace
+
+# The engine log. Records (time, turn id, stage, message, fields) go into an in-memory ring, which /log/tail serves,
+# and onto a queue that a background thread appends to the log file in batches, through a handle kept open, rotating
+# it by size. Logging costs the caller a dict and a queue put, however big the log gets.
+
+LOG_MAX_BYTES = int(os.environ.get('TURK_LOG_MAX_BYTES', 5 * 1024 * 1024))    # Size at which the file is rotated
+LOG_BACKUPS = int(os.environ.get('TURK_LOG_BACKUPS', 3))                       # <log>.1 ... <log>.N are kept
+LOG_FORMAT = os.environ.get('TURK_LOG_FORMAT', 'text')                         # text: "[ time ] message" lines | json
+LOG_SERVED = os.environ.get('TURK_LOG_SERVED', '0') == '1'                     # Serve the file at /<name>.log (it holds every session's turns)
+LOG_RING = 1000         # Recent records kept in memory
+WRITE_BATCH = 500       # Most records written per flush
+
+def log_filename() -> str:
+    # Named for the running script (turk_flask.py -> turk_flask.log), as it always has been
+    return sys.argv[0].split('.')[0] + '.log'
+
+def timestamp(at: float) -> str:
+    return time.strftime("%m/%d/%y  %H:%M:%S", time.localtime(at))
+
+def text_line(record: dict) -> str:
+    turn = f"({record['turn']}) " if record.get('turn') else ''
+    return f"[ {timestamp(record['time'])} ] {turn}{record['message']}\n"
+
+def json_line(record: dict) -> str:
+    return json.dumps(record, default=str) + '\n'
+
+class EngineLog:
+    def __init__(self, path: str = None, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS, log_format: str = LOG_FORMAT):
+        if log_format not in ('text', 'json'): raise ValueError(f"Unknown log format: {log_format}")
+        self.path = path
+        self.max_bytes, self.backups = max_bytes, backups
+        self.format_line = text_line if log_format == 'text' else json_line
+        self.recent = deque(maxlen=LOG_RING)
+        self.written, self.rotations, self.dropped = 0, 0, 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset) # Forked workers (e.g. the TTS pool) start their own writer
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+        self.writer = None
+        self.seq = self.recent[-1]['seq'] if self.recent else 0
+
+    def log(self, message: str, stage: str = None, turn: str = None, **fields) -> dict:
+        trace = turk_trace.current()
+        record = {'time': time.time(), 'turn': turn or getattr(trace, 'turn_id', None), 'stage': stage, 'message': message, 'fields': fields}
+        with self.lock:
+            self.seq += 1
+            record['seq'] = self.seq
+            self.recent.append(record)
+            if self.writer is None: self._start_writer()
+        self.queue.put(record)
+        return record
+
+    def _start_writer(self):
+        if self.path is None: self.path = log_filename()
+        self.writer = threading.Thread(target=self._write, name='engine-log', daemon=True)
+        self.writer.start()
+
+    def _write(self):
+        file = None
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in batch
+            try:
+                if file is None: file = open(self.path, 'a')
+                file.write(''.join(self.format_line(record) for record in batch if record is not None))
+                file.flush()
+                self.written += len(batch) - closing
+                if file.tell() >= self.max_bytes:
+                    file.close()
+                    file = None
+                    self._rotate()
+            except OSError as e:
+                self.dropped += len(batch) - closing
+                print(f"Engine log write failed: {e}", file=sys.stderr)
+                file = None
+            if closing:
+                if file: file.close()
+                return
+
+    def _rotate(self):
+        # <log> -> <log>.1 -> ... -> <log>.N (the oldest is dropped)
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"): os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backups: os.replace(self.path, f"{self.path}.1")
+        else: os.remove(self.path)
+        self.rotations += 1
+
+    def close(self, timeout: float = 5):
+        # Writes whatever is queued (called at exit)
+        with self.lock:
+            writer = self.writer
+        if writer is None or not writer.is_alive(): return
+        self.queue.put(None)
+        writer.join(timeout)
+
+    def tail(self, count: int = 20, since: int = 0, visible = None) -> list:
+        # The newest `count` records (after sequence number `since`), oldest first; visible(turn), if given, limits them to what a caller may see
+        with self.lock:
+            records = [record for record in self.recent if record['seq'] > since and (visible is None or visible(record['turn']))]
+        return records[-count:] if count > 0 else []
+
+    def stats(self) -> dict:
+        return {'path': self.path, 'format': 'text' if self.format_line is text_line else 'json', 'records': self.seq, 'written': self.written,
+                'queued': self.queue.qsize(), 'dropped': self.dropped, 'rotations': self.rotations, 'max_bytes': self.max_bytes, 'backups': self.backups}
+
+engine_log = EngineLog()
+atexit.register(engine_log.close)
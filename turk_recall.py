@@ -0,0 +1,191 @@
+import json, math, os, re, threading, time
+from collections import Counter, defaultdict
+
+from turk_lib import print_log
+from turk_tokens import count_tokens
+
+# Long-term recall: a BM25 index over archived conversations (archive/*_messages.json) and the code blocks kept in the
+# archive store (or, from before it, in sandbox/), brought up to date in the background as they appear. Each turn's
+# transcript pulls the few most relevant past snippets into the prompt within RECALL_TOKEN_BUDGET, so continuity
+# doesn't need one ever-growing live history.
+
+RECALL_ENABLED = os.environ.get('TURK_RECALL', '1') != '0'
+RECALL_SCOPE = os.environ.get('TURK_RECALL_SCOPE', 'session')          # session: a session's own archives only | all
+RECALL_TOKEN_BUDGET = int(os.environ.get('TURK_RECALL_TOKENS', 400))    # Prompt tokens given over to recalled snippets
+RECALL_MIN_SCORE = float(os.environ.get('TURK_RECALL_MIN_SCORE', 1.0))  # BM25 score below which a snippet isn't used
+RECALL_MAX_SNIPPETS = 3
+RECALL_SCAN_INTERVAL = 60   # seconds between checks for new archives (a reset triggers one straight away)
+SNIPPET_CHARACTERS = 1200   # Longest passage kept as one document
+BM25_K1, BM25_B = 1.2, 0.75
+
+RECALL_PREFIX = 'Excerpts from earlier, archived conversations that may be relevant (use them only if they help):\n'
+ARCHIVE_NAME = re.compile(r'^(\d+)_(?:([0-9a-f]{16})_)?messages\.json$')  # <time>[_<session>]_messages.json
+CODEBLOCK_NAME = re.compile(r'^cb_(\d+)_(?:([0-9a-f]{16})_)?(\d+)\.txt$')  # cb_<minute>[_<session>]_<NN>.txt (sandbox/)
+CODEBLOCK_NUMBER = re.compile(r'_(\d+)\.txt$')    # <turn>_cb_<NN>.txt in the archive store (or an imported sandbox/ name)
+STORE_KEY_PREFIX = 'archive-store:'   # Index keys of code blocks read from the archive store, not from files
+TERM = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset('''a about after again all also am an and any are as at be because been before being but by can could
+did do does doing don for from had has have having he her here hers him his how i if in into is it its just me more most my
+no nor not now of off on once only or other our out over own please same she should so some such than that the their them
+then there these they this those through to too under until up very was we were what when where which while who whom why
+will with would you your yours yes okay ok tell know like get got think'''.split())
+
+def terms(text: str) -> list:
+    return [term for term in TERM.findall(text.lower()) if term not in STOPWORDS and len(term) > 1]
+
+class RecallIndex:
+    def __init__(self, archive_dir: str, sandbox_dir: str, scope: str = RECALL_SCOPE, store=None):
+        if scope not in ('session', 'all'): raise ValueError(f"Unknown recall scope: {scope}")
+        self.archive_dir, self.sandbox_dir, self.scope, self.store = archive_dir, sandbox_dir, scope, store
+        self.docs = []                      # doc id -> {'owner', 'source', 'text', 'length', 'terms'}, or None once replaced
+        self.postings = defaultdict(dict)   # term -> {doc id: term frequency}
+        self.live_docs, self.total_length = 0, 0
+        self.indexed = {}                   # path (or store key) -> (mtime, doc ids)
+        self.last_scan, self.scan_seconds, self.searches = None, None, 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._work, name='recall-index', daemon=True).start()
+
+    def notify(self):
+        # Something new has been archived; index it now rather than at the next interval
+        self.wake.set()
+
+    def _work(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:
+                print_log(f"Recall index scan failed: {e}")
+            self.wake.wait(RECALL_SCAN_INTERVAL)
+            self.wake.clear()
+
+    def scan(self):
+        # Indexes files that are new or changed since they were last seen
+        started = time.perf_counter()
+        added = 0
+        for directory, pattern, documents in ((self.archive_dir, ARCHIVE_NAME, self._archive_documents), (self.sandbox_dir, CODEBLOCK_NAME, self._codeblock_documents)):
+            if not os.path.isdir(directory): continue
+            for entry in os.scandir(directory):
+                match = pattern.match(entry.name)
+                if not match or not entry.is_file(): continue
+                mtime = entry.stat().st_mtime
+                if self.indexed.get(entry.path, (None,))[0] == mtime: continue
+                try:
+                    new_documents = documents(entry.path, match)
+                except (OSError, ValueError, UnicodeDecodeError) as e:
+                    print_log(f"Recall index skipped {entry.name}: {e}")
+                    new_documents = []
+                self._replace(entry.path, mtime, new_documents)
+                added += len(new_documents)
+        if self.store: added += self._scan_store()
+        self.last_scan, self.scan_seconds = time.time(), time.perf_counter() - started
+        if added: print_log(f"Recall index: {added} new snippet(s) indexed in {self.scan_seconds:.2f}s ({self.live_docs} in all).")
+
+    def _archive_documents(self, path: str, match) -> list:
+        # One document per exchange (a user message and the reply to it)
+        with open(path, 'r') as f:
+            messages = json.load(f)
+        when = time.strftime('%d %b %Y', time.localtime(int(match.group(1))))
+        documents, exchange = [], []
+        for message in messages:
+            if message.get('role') == 'user' and exchange:
+                documents.append(exchange)
+                exchange = []
+            if message.get('role') in ('user', 'assistant'):
+                exchange.append(f"{message['role'].capitalize()}: {message['content']}")
+        if exchange: documents.append(exchange)
+        return [{'owner': match.group(2), 'source': f"Conversation of {when}", 'text': '\n'.join(exchange)[:SNIPPET_CHARACTERS]} for exchange in documents]
+
+    def _scan_store(self) -> int:
+        # Indexes code blocks new to the archive store, and drops those whose segments retention has removed
+        added, current = 0, set()
+        for entry in self.store.entries('code'):
+            number = CODEBLOCK_NUMBER.search(entry['name'])
+            if not number: continue
+            key = f"{STORE_KEY_PREFIX}{entry['segment']}:{entry['offset']}"
+            current.add(key)
+            if key in self.indexed: continue
+            data = self.store.read(entry)
+            if data is None: continue
+            documents = self._code_documents(data.decode(errors='replace'), entry.get('owner'), entry['time'], number.group(1))
+            self._replace(key, entry['time'], documents)
+            added += len(documents)
+        for key in [key for key in self.indexed if key.startswith(STORE_KEY_PREFIX) and key not in current]:
+            self._replace(key, None, [])
+            del self.indexed[key]
+        return added
+
+    def _codeblock_documents(self, path: str, match) -> list:
+        with open(path, 'r') as f:
+            return self._code_documents(f.read(), match.group(2), int(match.group(1)) * 60, match.group(3))
+
+    def _code_documents(self, code: str, owner: str, saved: float, number: str) -> list:
+        when = time.strftime('%d %b %Y', time.localtime(saved))
+        return [{'owner': owner, 'source': f"Code block {number} from {when}", 'text': code[:SNIPPET_CHARACTERS]}]
+
+    def _replace(self, path: str, mtime: float, documents: list):
+        with self.lock:
+            for doc_id in self.indexed.get(path, (None, []))[1]:
+                self.live_docs -= 1
+                self.total_length -= self.docs[doc_id]['length']
+                for term in self.docs[doc_id]['terms']:
+                    postings = self.postings[term]
+                    del postings[doc_id]
+                    if not postings: del self.postings[term]
+                self.docs[doc_id] = None
+            doc_ids = []
+            for document in documents:
+                counts = Counter(terms(document['text']))
+                if not counts: continue
+                doc_id = len(self.docs)
+                self.docs.append({**document, 'length': sum(counts.values()), 'terms': tuple(counts)})
+                for term, count in counts.items(): self.postings[term][doc_id] = count
+                self.live_docs += 1
+                self.total_length += self.docs[doc_id]['length']
+                doc_ids.append(doc_id)
+            self.indexed[path] = (mtime, doc_ids)
+
+    def search(self, query: str, owner: str = None, limit: int = RECALL_MAX_SNIPPETS) -> list:
+        # (score, source, text) of the best-matching snippets visible to `owner`, best first
+        with self.lock:
+            self.searches += 1
+            if not self.live_docs: return []
+            average_length = self.total_length / self.live_docs
+            scores = defaultdict(float)
+            for term in set(terms(query)):
+                postings = self.postings.get(term)
+                if not postings: continue
+                idf = math.log(1 + (self.live_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    document = self.docs[doc_id]
+                    if document is None or (self.scope == 'session' and document['owner'] != owner): continue
+                    scores[doc_id] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * document['length'] / average_length))
+            ranked = sorted((score, doc_id) for doc_id, score in scores.items() if score >= RECALL_MIN_SCORE)[::-1][:limit]
+            return [(score, self.docs[doc_id]['source'], self.docs[doc_id]['text']) for score, doc_id in ranked]
+
+    def context(self, query: str, owner: str = None, budget: int = RECALL_TOKEN_BUDGET) -> str:
+        # Recalled snippets as prompt text, as many of the best as fit `budget` tokens ('' if nothing is relevant)
+        if not RECALL_ENABLED or not query.strip(): return ''
+        text, remaining = '', budget - count_tokens(RECALL_PREFIX)
+        for score, source, snippet in self.search(query, owner):
+            passage = f"[{source}]\n{snippet}\n"
+            cost = count_tokens(passage)
+            if cost > remaining: break
+            text += passage
+            remaining -= cost
+        return RECALL_PREFIX + text if text else ''
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'enabled': RECALL_ENABLED,
+                'scope': self.scope,
+                'files': len(self.indexed),
+                'snippets': self.live_docs,
+                'terms': len(self.postings),
+                'searches': self.searches,
+                'last_scan': self.last_scan,
+                'scan_seconds': round(self.scan_seconds, 4) if self.scan_seconds is not None else None
+            }
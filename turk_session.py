@@ -0,0 +1,205 @@
+import json, os, re, secrets, threading, time
+from collections import OrderedDict
+
+from turk_lib import print_log
+from turk_journal import MessageJournal
+
+# Per-browser conversation state: message history, settings and an audio file namespace.
+# Active sessions live in memory; idle ones are spilled to SESSION_DIR and reloaded on their next request.
+# History is kept in an append-only journal (<id>.jsonl); <id>.json holds only the small settings record.
+
+SESSION_DIR = 'sessions/'
+SESSION_COOKIE = 'turk_session'
+MAX_SESSIONS = 256          # Sessions held in memory before the least recently used are spilled to disk
+SESSION_IDLE_TIMEOUT = 1800 # seconds
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+TURN_ID_PATTERN = re.compile(r'^([0-9a-f]{16})(?:[_.]|$)')  # <turn id>[_<n>][.<ext>]
+MAX_OWNED_TURNS = 1000      # Turn ids remembered per session (their jobs, audio and archived artifacts stay reachable)
+LEGACY_MESSAGE_LOG = 'messages.json'    # The single conversation kept before sessions existed
+
+class Session:
+    def __init__(self, session_id: str, system_prompt: str, default_voice_name: str):
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        self.journal = MessageJournal(os.path.join(SESSION_DIR, session_id))
+        self.journal.messages = [{"role": "system", "content": system_prompt}]
+        self.persisted = False # A new session's history is only written once it has a conversation to keep
+        self.model_index = 0
+        self.voice_name = default_voice_name
+        self.local_sr = False
+        self.audio_accept = 'audio/mpeg' # Playback formats the browser sent with its latest upload (not persisted)
+        self.summary = ''       # Rolling summary of the turns before summary_seq
+        self.summary_seq = 0
+        self.summarising = False # A summary request is in flight (compress_history)
+        self.turn_ids = {}      # Ids of this session's turns, oldest first (a dict used as an ordered set)
+        self.last_seen = time.time()
+        self.active_turns = 0
+        self.jobs = []          # Turns submitted and not yet finished, oldest first
+        self.lock = threading.RLock() # Held for the duration of a turn so a session's turns don't interleave
+        self.turn_count_lock = threading.Lock()
+
+    @property
+    def messages(self) -> list:
+        return self.journal.messages
+
+    def add_message(self, message: dict):
+        with self.lock:
+            if not self.persisted:
+                self.journal.messages = []
+                self.journal.append({"role": "system", "content": self.system_prompt})
+                self.persisted = True
+            self.journal.append(message)
+
+    def reset_messages(self):
+        with self.lock:
+            self.journal.reset([{"role": "system", "content": self.system_prompt}])
+            self.persisted = True
+            self.summary, self.summary_seq = '', 0
+            self.save()
+
+    @property
+    def summarised_count(self) -> int:
+        # How many of self.messages (from the start) the summary stands in for
+        return max(0, self.summary_seq - self.journal.first_seq)
+
+    def set_summary(self, summary: str, summarised_count: int):
+        with self.lock:
+            self.summary, self.summary_seq = summary, self.journal.first_seq + summarised_count
+            self.save()
+
+    def begin_turn(self):
+        # Counted from upload so a session with queued turns is never spilled from under them
+        with self.turn_count_lock: self.active_turns += 1
+
+    def end_turn(self):
+        with self.turn_count_lock: self.active_turns -= 1
+
+    def track_job(self, job):
+        with self.turn_count_lock:
+            self.jobs = [tracked for tracked in self.jobs if not tracked.is_finished] + [job]
+
+    def cancel_jobs(self, reason: str, job_id: str = None) -> list:
+        # Cancels this session's unfinished turns (or just `job_id`); returns the ids actually cancelled
+        with self.turn_count_lock:
+            jobs = [job for job in self.jobs if not job.is_finished and job_id in (None, job.job_id)]
+        return [job.job_id for job in jobs if job.cancel(reason)]
+
+    def new_turn_id(self) -> str:
+        # A turn's public name (its job id, and the prefix of its audio and archived artifacts) is random, not derived
+        # from the session id, which is the session's credential; ownership is this session's record of the ids
+        turn_id = secrets.token_hex(8)
+        with self.turn_count_lock:
+            self.turn_ids[turn_id] = None
+            while len(self.turn_ids) > MAX_OWNED_TURNS: del self.turn_ids[next(iter(self.turn_ids))]
+        return turn_id
+
+    def owns(self, name: str) -> bool:
+        # Whether a job id, turn id or file name (<turn id>[_<n>][.<ext>]) belongs to one of this session's turns
+        match = TURN_ID_PATTERN.match(name)
+        return bool(match) and match.group(1) in self.turn_ids
+
+    @property
+    def filename(self) -> str:
+        return os.path.join(SESSION_DIR, f"{self.session_id}.json")
+
+    @property
+    def exists(self) -> bool:
+        # Whether this id was issued here (every issued session's settings record is saved straight away)
+        return os.path.exists(self.filename) or os.path.exists(self.journal.journal_filename)
+
+    def save(self):
+        with self.lock:
+            state = {'model_index': self.model_index, 'voice_name': self.voice_name, 'local_sr': self.local_sr, 'summary': self.summary, 'summary_seq': self.summary_seq,
+                     'turn_ids': list(self.turn_ids)}
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as json_file:
+                json.dump(state, json_file, indent=4)
+            os.replace(temp_filename, self.filename)
+
+    def load(self) -> bool:
+        if self.journal.recover(): self.persisted = True
+        try:
+            with open(self.filename, 'r') as json_file:
+                state = json.load(json_file)
+        except (OSError, ValueError):
+            return self.persisted
+        if 'messages' in state and not self.persisted:
+            # Sessions saved before the journal kept their whole history in the settings record
+            self.journal.messages = []
+            for message in state['messages']: self.journal.append(message)
+            self.persisted = True
+        self.model_index = state.get('model_index', self.model_index)
+        self.voice_name = state.get('voice_name', self.voice_name)
+        self.local_sr = state.get('local_sr', self.local_sr)
+        self.summary = state.get('summary', self.summary)
+        self.summary_seq = state.get('summary_seq', self.summary_seq)
+        self.turn_ids = dict.fromkeys(state.get('turn_ids', []))
+        return True
+
+class SessionStore:
+    def __init__(self, system_prompt: str, default_voice_name: str, max_sessions: int = MAX_SESSIONS, idle_timeout: float = SESSION_IDLE_TIMEOUT,
+                 legacy_log: str = LEGACY_MESSAGE_LOG, legacy_archive_dir: str = None):
+        self.system_prompt = system_prompt
+        self.legacy_log, self.legacy_archive_dir = legacy_log, legacy_archive_dir
+        self.default_voice_name = default_voice_name
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict() # Least recently used first
+        self.lock = threading.Lock()
+        if not os.path.exists(SESSION_DIR): os.makedirs(SESSION_DIR)
+
+    @staticmethod
+    def new_session_id() -> str:
+        return secrets.token_hex(8)
+
+    def get(self, session_id: str = None) -> Session:
+        # The caller's session, reloaded from disk if it was spilled. Ids are only ever issued here: one this server
+        # didn't issue (unknown or malformed) gets a fresh session with a new id, so a client can't choose its own.
+        with self.lock:
+            session = self.sessions.pop(session_id, None) if session_id else None
+            if session is None and session_id and SESSION_ID_PATTERN.match(session_id):
+                session = Session(session_id, self.system_prompt, self.default_voice_name)
+                if not session.exists: session = None
+                elif session.load(): print_log("Session restored from disk.") # Session ids are credentials, so they never go in the log
+            if session is None: session = self._new_session()
+            session_id = session.session_id
+            self.sessions[session_id] = session
+            session.last_seen = time.time()
+            self._evict()
+        return session
+
+    def _new_session(self) -> Session:
+        session = Session(self.new_session_id(), self.system_prompt, self.default_voice_name)
+        self._adopt_legacy_log(session)
+        session.save() # Marks the id as issued, for this and any other worker
+        return session
+
+    def _adopt_legacy_log(self, session: Session):
+        # The conversation from before sessions goes to the first browser to connect after the upgrade; the file
+        # itself is moved to the archive (moving it first means only one worker can take it)
+        if not self.legacy_log or not os.path.exists(self.legacy_log): return
+        archived = os.path.join(self.legacy_archive_dir or os.path.dirname(self.legacy_log), f"{int(time.time())}_{os.path.basename(self.legacy_log)}")
+        try:
+            os.replace(self.legacy_log, archived)
+            with open(archived, 'r') as json_file:
+                messages = json.load(json_file)
+        except (OSError, ValueError) as e:
+            print_log(f"Couldn't import {self.legacy_log}: {e}")
+            return
+        for message in messages:
+            if message.get('role') in ('user', 'assistant'): session.add_message(message)
+        print_log(f"Imported {len(messages)} messages from {self.legacy_log} into a new session (original archived as {archived}).")
+
+    def _evict(self):
+        # Spill sessions that have been idle too long, then the least recently used until we're within bounds
+        now = time.time()
+        for session_id, session in list(self.sessions.items()):
+            over_capacity = len(self.sessions) > self.max_sessions
+            if not over_capacity and now - session.last_seen < self.idle_timeout: break
+            if session.active_turns: continue
+            session.save()
+            del self.sessions[session_id]
+
+    def spill_all(self):
+        with self.lock:
+            for session in self.sessions.values(): session.save()
@@ -0,0 +1,209 @@
+import argparse, json, os, socket, socketserver, struct, threading, time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+from turk_lib import print_log
+import turk_trace
+
+# Optional model server: one process owns the faster-whisper and balacoon models, and any number of web workers use
+# them over a Unix socket instead of each loading its own copy. Messages are length-prefixed JSON; sample buffers
+# travel in shared memory, so only segment names cross the socket. Start it, then point the web tier at it:
+#   python turk_sidecar.py --socket /tmp/turk-models.sock
+#   TURK_MODEL_SERVER=/tmp/turk-models.sock python turk_flask.py
+
+SIDECAR_SOCKET = os.environ.get('TURK_MODEL_SERVER', '')    # Empty: models are loaded in-process, as before
+DEFAULT_SOCKET = '/tmp/turk-models.sock'
+STARTUP_TIMEOUT = 300   # seconds a web worker waits for the model server to come up and warm its engines
+REQUEST_TIMEOUT = 120   # seconds for a single transcription or synthesis
+HEADER = struct.Struct('!I')
+
+def send_message(connection: socket.socket, message: dict):
+    data = json.dumps(message).encode()
+    connection.sendall(HEADER.pack(len(data)) + data)
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk: raise ConnectionError('Model server connection closed')
+        data += chunk
+    return bytes(data)
+
+def receive_message(connection: socket.socket) -> dict:
+    size, = HEADER.unpack(receive_exactly(connection, HEADER.size))
+    return json.loads(receive_exactly(connection, size))
+
+def untracked(segment: shared_memory.SharedMemory) -> shared_memory.SharedMemory:
+    # Before Python 3.13 every process that creates or attaches a segment registers it with its resource tracker, which
+    # unlinks it when that process exits. The server never unlinks: segments are unlinked by the web worker when done.
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+def share_samples(samples: np.ndarray) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(create=True, size=max(1, samples.nbytes))
+    np.ndarray(samples.shape, samples.dtype, buffer=segment.buf)[:] = samples
+    return segment
+
+def release_segment(name: str):
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+# --- Server (the process that owns the models) ---
+
+class SidecarHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.connection)
+            except (ConnectionError, OSError):
+                return
+            try:
+                response = getattr(self, 'op_' + request['op'])(request)
+            except Exception as e:
+                response = {'error': f"{type(e).__name__}: {e}"}
+            try:
+                send_message(self.connection, response)
+            except OSError:
+                # The worker has gone (e.g. it timed out), so nothing else would unlink a segment it was sent
+                if 'segment' in response: release_segment(response['segment'])
+                return
+
+    def op_status(self, request: dict) -> dict:
+        return self.server.warmup.status()
+
+    def op_sr_stats(self, request: dict) -> dict:
+        import local_sr
+        return local_sr.sr_stats()
+
+    def op_transcribe(self, request: dict) -> dict:
+        # Copied out of the web worker's segment into memory this process owns, since the recognition pool can hold
+        # on to buffers after the reply has gone (and a segment can't be closed while a view of it is alive)
+        import local_sr
+        segment = untracked(shared_memory.SharedMemory(name=request['segment']))
+        try:
+            samples = np.array(np.ndarray((request['count'],), np.float32, buffer=segment.buf))
+        finally:
+            segment.close()
+        text, no_speech_prob = local_sr.fast_transcribe(samples)
+        return {'text': text, 'no_speech_prob': no_speech_prob}
+
+    def op_synthesize(self, request: dict) -> dict:
+        # The samples are left in a new segment for the web worker to encode from and unlink
+        import local_tts
+        samples, sample_rate = local_tts.text_to_samples(request['text'])
+        segment = untracked(share_samples(samples))
+        segment.close()
+        return {'segment': segment.name, 'count': len(samples), 'dtype': samples.dtype.str, 'sample_rate': sample_rate}
+
+class SidecarServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def serve(socket_path: str):
+    import local_tts, local_sr
+    from turk_warmup import Warmup
+
+    # The TTS worker pool is forked before any other thread exists, as in the web app
+    local_tts.start_pool()
+    warmup = Warmup()
+    warmup.register('local_tts', local_tts.get_tts)
+    warmup.register('local_sr', local_sr.get_model)
+    if local_tts.pool: warmup.register('local_tts_pool', local_tts.wait_for_pool)
+    warmup.start()
+
+    if os.path.exists(socket_path): os.unlink(socket_path)
+    server = SidecarServer(socket_path, SidecarHandler)
+    os.chmod(socket_path, 0o600)
+    server.warmup = warmup
+    print_log(f"Model server listening on {socket_path}", noStdOut = False)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+# --- Client (used by each web worker) ---
+
+class SidecarClient:
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.local = threading.local() # One connection per thread; the server handles each on its own thread
+
+    def _connect(self) -> socket.socket:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(REQUEST_TIMEOUT)
+        connection.connect(self.socket_path)
+        return connection
+
+    def _drop(self, connection: socket.socket):
+        self.local.connection = None
+        if connection: connection.close()
+
+    def call(self, request: dict) -> dict:
+        # A request that never reached the server (a stale connection to a restarted server fails on connect or send)
+        # is retried once. Once sent it never is: a slow transcription or synthesis isn't run twice.
+        for attempt in range(2):
+            connection = getattr(self.local, 'connection', None)
+            try:
+                if connection is None: connection = self.local.connection = self._connect()
+                send_message(connection, request)
+                break
+            except socket.timeout:
+                self._drop(connection)
+                raise
+            except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError, FileNotFoundError):
+                self._drop(connection)
+                if attempt: raise
+        try:
+            response = receive_message(connection)
+        except (ConnectionError, OSError):
+            self._drop(connection) # A late reply would otherwise be read as the next request's (the server cleans it up)
+            raise
+        if 'error' in response: raise RuntimeError(f"Model server: {response['error']}")
+        return response
+
+    def wait_for(self, engine: str):
+        # Warm-up for this worker: blocks until the model server has `engine` ready (raising if it failed)
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                state = self.call({'op': 'status'})['engines'][engine]
+                if state['state'] == 'ready': return
+                if state['state'] == 'failed': raise RuntimeError(f"Model server: {state['error']}")
+            except (ConnectionError, OSError):
+                if time.time() > deadline: raise
+            if time.time() > deadline: raise TimeoutError(f"Model server didn't warm {engine} in {STARTUP_TIMEOUT}s")
+            time.sleep(0.5)
+
+    def sr_stats(self) -> dict:
+        return self.call({'op': 'sr_stats'})
+
+    def transcribe(self, samples: np.ndarray):
+        samples = samples.astype(np.float32, copy=False)
+        segment = share_samples(samples)
+        try:
+            response = self.call({'op': 'transcribe', 'segment': segment.name, 'count': len(samples)})
+        finally:
+            segment.close()
+            segment.unlink()
+        return response['text'], response['no_speech_prob']
+
+    def synthesize(self, text: str, encode):
+        # encode(samples, sample_rate) is run over the server's buffer in place; the segment is released afterwards
+        with turk_trace.span('tts_synthesis', engine = 'balacoon'):
+            response = self.call({'op': 'synthesize', 'text': text})
+        segment = shared_memory.SharedMemory(name=response['segment'])
+        try:
+            return encode(np.ndarray((response['count'],), np.dtype(response['dtype']), buffer=segment.buf), response['sample_rate'])
+        finally:
+            segment.close()
+            segment.unlink()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the local SR and TTS models to turk-chat web workers')
+    parser.add_argument('--socket', default=SIDECAR_SOCKET or DEFAULT_SOCKET, help='Unix socket path')
+    args = parser.parse_args()
+    serve(args.socket)
@@ -0,0 +1,81 @@
+import re
+from functools import lru_cache
+
+# Local token counting and prompt budgeting. The prompt sent to the model is the system prompt, a rolling
+# summary of older turns (if any) and as many recent turns, verbatim, as fit the model's prompt budget.
+
+MESSAGE_OVERHEAD_TOKENS = 4   # Role and separator tokens added per chat message
+PROMPT_BUDGET_FRACTION = 0.5  # Default budget as a fraction of the context window (room is left for the reply)
+COMPRESS_AT = 0.8             # Summarise older turns once the prompt passes this fraction of its budget
+KEEP_RECENT_MESSAGES = 6      # Always kept verbatim (three exchanges)
+
+SUMMARY_PREFIX = 'Summary of the earlier conversation (older turns have been condensed):\n'
+SUMMARY_INSTRUCTIONS = \
+"Condense the following conversation between a user and their voice assistant into a brief summary. " \
+"Keep names, facts, decisions, open questions and anything the user asked to be remembered; drop pleasantries. " \
+"Write it as plain prose of no more than 200 words."
+
+try:
+    import tiktoken
+    ENCODING = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    ENCODING = None
+
+WORD_PIECES = re.compile(r"\w+|[^\w\s]")
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    if ENCODING is not None: return len(ENCODING.encode(text, disallowed_special=()))
+    # Without tiktoken: a word is about one token per four characters, punctuation one token each
+    return sum((len(piece) + 3) // 4 for piece in WORD_PIECES.findall(text))
+
+def message_tokens(message: dict) -> int:
+    # Cached by content, so each message is only ever counted once
+    return count_tokens(str(message['content'])) + MESSAGE_OVERHEAD_TOKENS
+
+def prompt_budget(model: dict) -> int:
+    # Explicit per-model budget if configured, never more than the default share of the context window
+    default_budget = int(model['token_limit'] * PROMPT_BUDGET_FRACTION)
+    return min(model.get('prompt_budget', default_budget), default_budget)
+
+def build_prompt(messages: list, summary: str, summarised_count: int, budget: int, recalled: str = '') -> list:
+    # System prompt + summary + recalled snippets + the newest unsummarised turns that fit the budget (oldest dropped first)
+    system, turns = messages[0], messages[max(1, summarised_count):]
+    head = [system] + ([{'role': 'system', 'content': SUMMARY_PREFIX + summary}] if summary else [])
+    recall = [{'role': 'system', 'content': recalled}] if recalled else []
+
+    remaining = budget - sum(message_tokens(m) for m in head + recall)
+    kept = []
+    for message in reversed(turns):
+        cost = message_tokens(message)
+        if cost > remaining and kept: break
+        kept.append(message)
+        remaining -= cost
+    kept.reverse()
+    # Recalled snippets change every turn, so they go just before the newest message: everything ahead of them is
+    # the same as last turn's prompt, which lets a provider's prompt cache (e.g. Ollama's KV cache) be reused
+    return head + kept[:-1] + recall + kept[-1:]
+
+def prompt_tokens(messages: list) -> int:
+    return sum(message_tokens(m) for m in messages)
+
+def compression_split(messages: list, summarised_count: int, summary: str, budget: int):
+    # How many messages (from the start) should be folded into the summary, or None if we're within budget
+    head_tokens = message_tokens(messages[0]) + (count_tokens(summary) if summary else 0)
+    turns = messages[max(1, summarised_count):]
+    if head_tokens + prompt_tokens(turns) < budget * COMPRESS_AT: return None
+    if len(turns) <= KEEP_RECENT_MESSAGES: return None
+
+    # Keep the most recent turns verbatim, using at most half the budget
+    keep, kept_tokens = 0, 0
+    for message in reversed(turns):
+        if keep >= KEEP_RECENT_MESSAGES and kept_tokens + message_tokens(message) > budget // 2: break
+        keep += 1
+        kept_tokens += message_tokens(message)
+    if keep >= len(turns): return None
+    return len(messages) - keep
+
+def summary_request(summary: str, messages: list) -> list:
+    transcript = '\n'.join(f"{m['role']}: {m['content']}" for m in messages)
+    if summary: transcript = f"(Earlier summary) {summary}\n{transcript}"
+    return [{'role': 'system', 'content': SUMMARY_INSTRUCTIONS}, {'role': 'user', 'content': transcript}]
@@ -0,0 +1,166 @@
+import threading, time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Per-turn span tracing. Each turn gets a TurnTrace (keyed by its job id) that's current on the thread running
+# the turn, so any stage - SR, the LLM call, normalisation, TTS synthesis, MP3 encoding - can time itself with
+# span() without the trace being passed around. Finished turns feed Prometheus histograms and a recent-turns ring.
+
+RECENT_TURNS = 50
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TURN_BUCKETS = (0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60)
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name, self.description, self.buckets = name, description, buckets
+        self.series = {} # sorted label pairs -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted((name, label) for name, label in labels.items() if label))
+        with self.lock:
+            series = self.series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def exposition(self) -> list:
+        def label_text(pairs):
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{label_text(key + (('le', str(bound)),))} {count}")
+                lines.append(f"{self.name}_bucket{label_text(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{label_text(key)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{label_text(key)} {series[-1]}")
+        return lines
+
+stage_seconds = Histogram('turk_stage_duration_seconds', 'Time spent in each turn pipeline stage.', STAGE_BUCKETS)
+turn_seconds = Histogram('turk_turn_duration_seconds', 'Whole turn time, upload to last audio.', TURN_BUCKETS)
+first_audio_seconds = Histogram('turk_time_to_first_audio_seconds', 'Upload to the first playable audio of a turn.', TURN_BUCKETS)
+turn_outcomes = defaultdict(int)
+recent_turns = deque(maxlen=RECENT_TURNS)
+recent_lock = threading.Lock()
+
+class TurnTrace:
+    def __init__(self, turn_id: str, created: float = None):
+        self.turn_id = turn_id
+        self.created = created or time.time() # Wall clock time the turn was queued
+        self.started = time.perf_counter() - (time.time() - self.created)
+        self.spans = []
+        self.marks = {}
+        self.outcome = None # Set by the turn to report something other than 'ok' (e.g. 'cancelled')
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, started, time.perf_counter() - started, **labels)
+
+    def add(self, stage: str, started: float, duration: float, **labels):
+        with self.lock:
+            self.spans.append({'stage': stage, 'start': started - self.started, 'duration': duration, **{k: v for k, v in labels.items() if v}})
+
+    def mark(self, name: str):
+        # First occurrence only (e.g. the first 'audio' event of a turn)
+        with self.lock:
+            self.marks.setdefault(name, time.perf_counter() - self.started)
+
+    def finish(self, outcome: str) -> dict:
+        total = time.perf_counter() - self.started
+        with self.lock:
+            spans = list(self.spans)
+            for span in spans:
+                stage_seconds.observe(span['duration'], stage = span['stage'], model = span.get('model'), engine = span.get('engine'))
+            turn_seconds.observe(total)
+            if 'audio' in self.marks: first_audio_seconds.observe(self.marks['audio'])
+
+        stages = defaultdict(float)
+        for span in spans: stages[span['stage']] += span['duration']
+        summary = {
+            'turn_id': self.turn_id,
+            'queued_at': self.created,
+            'outcome': outcome,
+            'total': round(total, 4),
+            'marks': {name: round(offset, 4) for name, offset in self.marks.items()},
+            'stages': {stage: round(duration, 4) for stage, duration in stages.items()},
+            'spans': [{**span, 'start': round(span['start'], 4), 'duration': round(span['duration'], 4)} for span in spans]
+        }
+        with recent_lock:
+            turn_outcomes[outcome] += 1
+            recent_turns.append(summary)
+        return summary
+
+class Stopwatch:
+    # Accumulates many short intervals (per-delta work, waits on a stream) into a single span
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.entered = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed += time.perf_counter() - self.entered
+
+    def record(self, **labels):
+        current().add(self.stage, self.started, self.elapsed, **labels)
+
+class NullTrace:
+    # Stands in when code runs outside a turn (warm-up, __main__ tests), so callers needn't check
+    @contextmanager
+    def span(self, stage: str, **labels):
+        yield
+
+    def add(self, stage: str, started: float, duration: float, **labels): pass
+    def mark(self, name: str): pass
+
+local = threading.local()
+NULL_TRACE = NullTrace()
+
+def current():
+    return getattr(local, 'trace', NULL_TRACE)
+
+def span(stage: str, **labels):
+    return current().span(stage, **labels)
+
+def mark(name: str):
+    current().mark(name)
+
+@contextmanager
+def turn(turn_id: str, created: float = None):
+    # Makes a new trace current on this thread for the duration of a turn
+    trace = TurnTrace(turn_id, created)
+    if created: trace.add('queued', trace.started, time.perf_counter() - trace.started)
+    local.trace = trace
+    outcome = 'failed'
+    try:
+        yield trace
+        outcome = trace.outcome or 'ok'
+    finally:
+        local.trace = NULL_TRACE
+        trace.finish(outcome)
+
+def recent(count: int = RECENT_TURNS, visible = None) -> list:
+    # Newest first; visible(turn_id), if given, limits them to the turns a caller may see
+    with recent_lock:
+        turns = list(recent_turns)[::-1]
+    return [turn for turn in turns if visible is None or visible(turn['turn_id'])][:count]
+
+def prometheus_text() -> str:
+    lines = []
+    for histogram in (stage_seconds, turn_seconds, first_audio_seconds):
+        lines += histogram.exposition()
+    lines += ['# HELP turk_turns_total Turns processed, by outcome.', '# TYPE turk_turns_total counter']
+    with recent_lock:
+        lines += [f'turk_turns_total{{outcome="{outcome}"}} {count}' for outcome, count in sorted(turn_outcomes.items())]
+    return '\n'.join(lines) + '\n'
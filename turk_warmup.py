@@ -0,0 +1,41 @@
+import threading, time
+
+from turk_lib import print_log
+
+# Slow engines (model downloads and loads, remote voice lists) are warmed in background threads
+# so the web server can bind and serve the UI immediately; /ready reports how far along each one is.
+
+class Warmup:
+    def __init__(self):
+        self.engines = {} # name -> {'state', 'started', 'duration', 'error'}
+        self.loaders = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, loader):
+        with self.lock:
+            self.loaders[name] = loader
+            self.engines[name] = {'state': 'pending', 'started': None, 'duration': None, 'error': None}
+
+    def start(self):
+        for name in list(self.loaders):
+            threading.Thread(target=self._warm, args=(name,), name=f"warmup-{name}", daemon=True).start()
+
+    def _warm(self, name: str):
+        self._update(name, state='warming', started=time.time())
+        started = time.perf_counter()
+        try:
+            self.loaders[name]()
+            self._update(name, state='ready', duration=time.perf_counter() - started)
+            print_log(f"{name} warmed up in {time.perf_counter() - started:.2f}s.")
+        except Exception as e:
+            self._update(name, state='failed', duration=time.perf_counter() - started, error=str(e))
+            print_log(f"{name} warm-up failed: {e}")
+
+    def _update(self, name: str, **fields):
+        with self.lock:
+            self.engines[name].update(fields)
+
+    def status(self) -> dict:
+        with self.lock:
+            engines = {name: dict(engine) for name, engine in self.engines.items()}
+        return {'ready': all(engine['state'] == 'ready' for engine in engines.values()), 'engines': engines}